@@ -1,10 +1,20 @@
 from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, Response
 from io import BytesIO
 from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
-from telethon.tl.types import DocumentAttributeVideo, User, Chat, Channel
+from telethon.errors import SessionPasswordNeededError, FileReferenceExpiredError, FilerefUpgradeNeededError
+from telethon.tl.types import DocumentAttributeVideo, User, Chat, Channel, Document, PhotoSize, PhotoCachedSize, PhotoSizeProgressive, PhotoStrippedSize
 from telethon.tl.functions.messages import GetDialogFiltersRequest
-from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.functions.upload import GetFileRequest, SaveFilePartRequest, SaveBigFilePartRequest
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.help import GetConfigRequest
+from telethon.tl.alltlobjects import LAYER
+from telethon.network import MTProtoSender
+from telethon.utils import get_input_location, stripped_photo_to_jpg, get_appropriated_part_size, get_attributes
+from telethon.helpers import generate_random_long
+from telethon.tl.types import InputFile, InputFileBig, InputDocument
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
 import asyncio
 import os
 import json
@@ -16,6 +26,26 @@ import threading
 import pymysql
 from contextlib import contextmanager
 import tempfile
+import atexit
+import base64
+import bisect
+import copy
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import queue
+import shutil
+import struct
+import subprocess
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Windows: los locks de subidas reanudables solo excluyen dentro del proceso
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
@@ -29,7 +59,7 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 86400  # 24 horas
 # Crear carpetas necesarias
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('sessions', exist_ok=True)
-# NO crear video_cache_temp - todo se sirve directamente desde la nube de Telegram
+# Los chunks de video descargados de Telegram se guardan en VIDEO_CACHE_DIR (caché LRU en disco)
 
 # Helper para calcular limit válido para GetFileRequest
 # Telegram requiere que limit sea múltiplo de 1024 y máximo 1MB
@@ -141,7 +171,6 @@ telegram_clients = {}
 # Lock para prevenir creación concurrente de clientes con la misma sesión SQLite
 _client_creation_lock = threading.Lock()
 upload_progress = {}  # Almacenar progreso de subidas
-video_memory_cache = {}  # Caché en memoria de videos (como Telegram - pre-cargados)
 CONFIG_FILE = 'telegram_config.json'  # Archivo para guardar configuración
 DB_CONFIG_FILE = 'db_config.json'  # Archivo de configuración de MySQL
 
@@ -300,6 +329,32 @@ def get_video_from_db(video_id):
         # Relanzar la excepción para que el llamador pueda manejarla
         raise
 
+def get_videos_from_db(video_ids):
+    """Obtener varios videos desde MySQL con una sola consulta. Devuelve {video_id: info}"""
+    if not video_ids:
+        return {}
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                placeholders = ', '.join(['%s'] * len(video_ids))
+                cursor.execute(
+                    f"SELECT * FROM videos WHERE video_id IN ({placeholders})",
+                    tuple(video_ids)
+                )
+                videos = {}
+                for row in cursor.fetchall():
+                    videos[row['video_id']] = {
+                        'message_id': row['message_id'],
+                        'chat_id': row['chat_id'],
+                        'filename': row['filename'],
+                        'timestamp': row['timestamp'].timestamp() if isinstance(row['timestamp'], datetime) else row['timestamp'],
+                        'file_size': row.get('file_size')
+                    }
+                return videos
+    except Exception as e:
+        print(f"❌ Error obteniendo videos desde DB: {e}")
+        return {}
+
 def find_video_by_message(chat_id, message_id, phone):
     """Buscar video existente por chat_id, message_id y phone"""
     try:
@@ -355,132 +410,3331 @@ def save_video_to_db(video_id, chat_id, message_id, filename, timestamp, file_si
         print(f"❌ Error guardando video en DB: {e}")
         return False
 
-def get_all_videos_from_db():
-    """Obtener todos los videos desde MySQL"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT * FROM videos ORDER BY timestamp DESC")
-                results = cursor.fetchall()
-                videos = {}
-                for row in results:
-                    video_id = row['video_id']
-                    videos[video_id] = {
-                        'message_id': row['message_id'],
-                        'chat_id': row['chat_id'],
-                        'filename': row['filename'],
-                        'timestamp': row['timestamp'].timestamp() if isinstance(row['timestamp'], datetime) else row['timestamp'],
-                        'file_size': row.get('file_size')
-                    }
-                return videos
-    except Exception as e:
-        print(f"❌ Error obteniendo todos los videos desde DB: {e}")
-        return {}
+def get_all_videos_from_db():
+    """Obtener todos los videos desde MySQL"""
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT * FROM videos ORDER BY timestamp DESC")
+                results = cursor.fetchall()
+                videos = {}
+                for row in results:
+                    video_id = row['video_id']
+                    videos[video_id] = {
+                        'message_id': row['message_id'],
+                        'chat_id': row['chat_id'],
+                        'filename': row['filename'],
+                        'timestamp': row['timestamp'].timestamp() if isinstance(row['timestamp'], datetime) else row['timestamp'],
+                        'file_size': row.get('file_size')
+                    }
+                return videos
+    except Exception as e:
+        print(f"❌ Error obteniendo todos los videos desde DB: {e}")
+        return {}
+
+def find_uploaded_documents(phone, content_hash, file_size):
+    """Subidas anteriores del mismo contenido en esta cuenta (una por chat), la más reciente primero"""
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """SELECT * FROM video_hashes WHERE content_hash = %s AND file_size = %s AND phone = %s
+                       ORDER BY updated_at DESC""",
+                    (content_hash, file_size, phone)
+                )
+                return cursor.fetchall()
+    except Exception as e:
+        print(f"❌ Error buscando subidas con el mismo contenido: {e}")
+        return []
+
+def save_uploaded_document(content_hash, file_size, phone, chat_id, message, video_id):
+    """Recordar el documento de Telegram de una subida para reutilizarlo si se vuelve a subir"""
+    document = getattr(getattr(message, 'media', None), 'document', None)
+    if not content_hash or document is None:
+        return False
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO video_hashes (content_hash, file_size, phone, chat_id, message_id, video_id,
+                           document_id, access_hash, file_reference)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE message_id = VALUES(message_id), video_id = VALUES(video_id),
+                           document_id = VALUES(document_id), access_hash = VALUES(access_hash),
+                           file_reference = VALUES(file_reference), updated_at = NOW()""",
+                    (content_hash, file_size, phone, str(chat_id), message.id, video_id,
+                     document.id, document.access_hash, document.file_reference)
+                )
+                conn.commit()
+                return True
+    except Exception as e:
+        print(f"❌ Error guardando hash de subida en DB: {e}")
+        return False
+
+# Verificar conexión a MySQL al iniciar
+if db_config:
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) as count FROM videos")
+                result = cursor.fetchone()
+                print(f"✅ Conexión a MySQL exitosa. Videos en DB: {result['count']}")
+    except Exception as e:
+        print(f"⚠️ Advertencia: No se pudo conectar a MySQL: {e}")
+        print("⚠️ La aplicación continuará pero algunas funciones pueden no funcionar correctamente.")
+
+# Almacenar loops por thread
+_thread_loops = {}
+_thread_lock = threading.Lock()
+
+def get_event_loop():
+    """Obtener o crear un event loop para el thread actual"""
+    thread_id = threading.current_thread().ident
+    
+    with _thread_lock:
+        if thread_id in _thread_loops:
+            loop = _thread_loops[thread_id]
+            if loop.is_closed():
+                del _thread_loops[thread_id]
+            else:
+                # CRÍTICO: Asegurarse de que el loop esté establecido como el loop actual del thread
+                # Esto es necesario porque Flask puede reutilizar threads y el loop puede no estar configurado
+                try:
+                    asyncio.set_event_loop(loop)
+                except RuntimeError:
+                    # Si hay un error, crear un nuevo loop
+                    pass
+                else:
+                    return loop
+        
+        # Crear nuevo loop para este thread
+        loop = asyncio.new_event_loop()
+        # CRÍTICO: Establecer el loop como el loop actual del thread ANTES de guardarlo
+        asyncio.set_event_loop(loop)
+        _thread_loops[thread_id] = loop
+        return loop
+
+def run_async(coro, loop=None, timeout=None):
+    """Ejecutar una corrutina en un event loop para el thread actual
+    
+    Args:
+        coro: Corrutina a ejecutar
+        loop: Event loop a usar (opcional)
+        timeout: Timeout en segundos (opcional, por defecto 300 para operaciones largas)
+    """
+    if timeout is None:
+        timeout = 300  # 5 minutos por defecto para operaciones como subir videos
+    
+    if loop is None:
+        loop = get_event_loop()
+    
+    # Asegurarse de que el loop no esté cerrado
+    if loop.is_closed():
+        # Si el loop está cerrado, crear uno nuevo
+        thread_id = threading.current_thread().ident
+        with _thread_lock:
+            if thread_id in _thread_loops:
+                del _thread_loops[thread_id]
+        loop = get_event_loop()
+    
+    # CRÍTICO: Establecer el loop como el loop actual del thread SIEMPRE
+    # Esto previene el error "no current event loop" cuando Flask reutiliza threads
+    try:
+        current_loop = asyncio.get_event_loop()
+        # Si el loop actual es diferente o está cerrado, establecer el nuevo loop
+        if current_loop != loop or current_loop.is_closed():
+            asyncio.set_event_loop(loop)
+    except RuntimeError:
+        # No hay loop actual, establecer este
+        asyncio.set_event_loop(loop)
+    
+    try:
+        # Verificar si el loop ya está corriendo
+        if loop.is_running():
+            # Si el loop está corriendo, usar run_coroutine_threadsafe para ejecutar en ese loop
+            # NO crear un nuevo loop porque el cliente detectaría el cambio
+            import concurrent.futures
+            
+            future = asyncio.run_coroutine_threadsafe(coro, loop)
+            try:
+                result = future.result(timeout=timeout)
+                return result
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise asyncio.TimeoutError(f"Operación excedió el timeout de {timeout} segundos")
+        else:
+            # Si el loop no está corriendo, usar run_until_complete normalmente
+            return loop.run_until_complete(coro)
+    except Exception as e:
+        # Re-raise la excepción para que se maneje arriba
+        raise
+    finally:
+        # NO cerrar el loop - mantenerlo vivo para Telethon
+        # Asegurarse de que el loop sigue siendo el loop actual
+        try:
+            asyncio.set_event_loop(loop)
+        except:
+            pass
+
+# ==================== CACHÉ DE CHUNKS DE VIDEO EN DISCO ====================
+# Los bytes de los videos se guardan en chunks de 1MB alineados (el máximo que permite
+# GetFileRequest), indexados por el id del documento de Telegram y el offset alineado.
+# Así un seek que otro espectador ya pidió no vuelve a costar ancho de banda de Telegram.
+
+VIDEO_CHUNK_SIZE = 1024 * 1024  # 1MB - máximo de GetFileRequest, offsets alineados a este tamaño
+VIDEO_CACHE_DIR = os.getenv('VIDEO_CACHE_DIR', 'video_cache')
+VIDEO_CACHE_MAX_BYTES = int(os.getenv('VIDEO_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024))  # 10GB por defecto
+# Streaming real de Range requests (chunk a chunk) en lugar de bufferizar la respuesta completa
+VIDEO_STREAMING_ENABLED = os.getenv('VIDEO_STREAMING', 'true').lower() == 'true'
+VIDEO_STREAM_MAX_RANGE = int(os.getenv('VIDEO_STREAM_MAX_RANGE', 16 * 1024 * 1024))  # 16MB por respuesta en modo streaming
+VIDEO_CHUNK_FETCH_TIMEOUT = 30  # Segundos por chunk de 1MB (o ventana paralela) en modo streaming
+# Descarga paralela: conexiones extra al DC del archivo y GetFileRequest en vuelo por conexión
+PARALLEL_DOWNLOAD_SENDERS = int(os.getenv('PARALLEL_DOWNLOAD_SENDERS', 4))
+PARALLEL_DOWNLOAD_REQUESTS_PER_SENDER = int(os.getenv('PARALLEL_DOWNLOAD_REQUESTS_PER_SENDER', 2))
+PARALLEL_DOWNLOAD_WINDOW = max(1, PARALLEL_DOWNLOAD_SENDERS * PARALLEL_DOWNLOAD_REQUESTS_PER_SENDER)
+# Modo X-Accel-Redirect: los documentos completos en disco los sirve nginx (sendfile + Range)
+# desde una location internal que apunta a VIDEO_CACHE_DIR (ver nginx-config.conf)
+VIDEO_ACCEL_REDIRECT_ENABLED = os.getenv('VIDEO_ACCEL_REDIRECT', 'false').lower() == 'true'
+VIDEO_ACCEL_REDIRECT_PREFIX = os.getenv('VIDEO_ACCEL_REDIRECT_PREFIX', '/_video_cache/')
+# Unir en un solo archivo los documentos que quedan completos en disco (necesario para X-Accel-Redirect
+# y para servirlos con sendfile/mmap sin copiar los bytes en Python)
+VIDEO_MATERIALIZE_ENABLED = VIDEO_ACCEL_REDIRECT_ENABLED or os.getenv('VIDEO_MATERIALIZE', 'true').lower() == 'true'
+
+_download_sender_pools = {}  # (client, dc_id) -> DownloadSenderPool
+_download_sender_pools_lock = threading.Lock()
+
+class DiskChunkCache:
+    """Caché persistente de chunks de video en disco con expulsión LRU por presupuesto de bytes.
+
+    Cada chunk vive en <cache_dir>/<doc_id>/<offset>.chunk. Un documento con todos sus
+    chunks en disco se puede materializar en <cache_dir>/<doc_id>/document.bin (una sola
+    entrada LRU, con offset DOCUMENT_OFFSET) para que nginx lo sirva directamente.
+    El orden LRU se guarda en index.json para que sobreviva a reinicios; al arrancar se
+    reconcilia con los archivos que realmente existen en disco.
+
+    Varios workers (procesos) pueden compartir el directorio y el presupuesto es del
+    directorio, no de cada proceso: las escrituras y expulsiones se hacen bajo un flock
+    sobre <cache_dir>/.lock y cada proceso rehace su vista del índice con lo que hay en
+    disco cada SYNC_INTERVAL segundos. La recencia compartida es la fecha de modificación
+    de cada archivo (se actualiza al leerlo). Entre dos resincronizaciones el disco puede
+    pasarse del presupuesto en lo que hayan escrito los otros workers en ese intervalo.
+    """
+
+    INDEX_FILE = 'index.json'
+    INDEX_SAVE_INTERVAL = 10  # Segundos mínimos entre escrituras del índice
+    SYNC_INTERVAL = 5  # Segundos máximos entre resincronizaciones con el disco
+    LOCK_FILE = '.lock'
+    DOCUMENT_FILE = 'document.bin'
+    DOCUMENT_OFFSET = -1  # Clave (doc_id, -1) = documento completo materializado
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (doc_id, offset) -> tamaño; el final es lo más reciente
+        self._total_bytes = 0
+        self._reserved_bytes = 0  # Espacio apartado para documentos que se están materializando
+        self._dirty = False
+        self._last_index_save = 0
+        self._last_sync = 0
+        self._materializing = set()  # doc_ids que se están uniendo en document.bin
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _chunk_path(self, doc_id, offset):
+        if offset == self.DOCUMENT_OFFSET:
+            return os.path.join(self.cache_dir, str(doc_id), self.DOCUMENT_FILE)
+        return os.path.join(self.cache_dir, str(doc_id), f"{offset}.chunk")
+
+    @contextmanager
+    def _shared_lock(self):
+        """flock exclusivo entre todos los procesos (y hilos) que usan el directorio de caché"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.cache_dir, self.LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield  # Cerrar el descriptor libera el flock
+
+    def _scan_disk(self):
+        """(doc_id, offset) -> (tamaño, mtime) de los chunks y documentos presentes en disco"""
+        on_disk = {}
+        try:
+            for doc_dir in os.listdir(self.cache_dir):
+                doc_path = os.path.join(self.cache_dir, doc_dir)
+                if not os.path.isdir(doc_path) or not doc_dir.lstrip('-').isdigit():
+                    continue
+                for name in os.listdir(doc_path):
+                    if name == self.DOCUMENT_FILE:
+                        offset = self.DOCUMENT_OFFSET
+                    elif name.endswith('.chunk') and name[:-6].isdigit():
+                        offset = int(name[:-6])
+                    else:
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(doc_path, name))
+                    except FileNotFoundError:
+                        continue  # Expulsado por otro worker mientras se listaba
+                    on_disk[(int(doc_dir), offset)] = (stat.st_size, stat.st_mtime)
+        except Exception as e:
+            print(f"⚠️ Error escaneando caché de video en disco: {e}", flush=True)
+        return on_disk
+
+    def _load_index(self):
+        """Cargar el índice LRU y reconciliarlo con los chunks presentes en disco"""
+        on_disk = self._scan_disk()
+
+        ordered_keys = []
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    for doc_id, offset in json.load(f).get('entries', []):
+                        if (doc_id, offset) in on_disk:
+                            ordered_keys.append((doc_id, offset))
+            except Exception as e:
+                print(f"⚠️ Índice de caché de video corrupto, reconstruyendo desde disco: {e}", flush=True)
+                ordered_keys = []
+
+        # Los chunks que no estaban en el índice (p.ej. tras un cierre abrupto) se consideran
+        # los menos recientes, ordenados por fecha de modificación
+        known = set(ordered_keys)
+        orphans = sorted((key for key in on_disk if key not in known), key=lambda key: on_disk[key][1])
+        for key in orphans + ordered_keys:
+            self._entries[key] = on_disk[key][0]
+            self._total_bytes += on_disk[key][0]
+
+        with self._shared_lock(), self._lock:
+            self._last_sync = time.time()
+            self._evict_locked()
+        print(f"✅ Caché de video en disco: {len(self._entries)} chunks, {self._total_bytes / (1024*1024):.1f}MB / {self.max_bytes / (1024*1024):.0f}MB", flush=True)
+
+    def _sync_with_disk(self):
+        """Rehacer la vista del índice con lo que hay en disco, incluidos los chunks que han
+        escrito o expulsado otros workers (requiere el flock compartido)"""
+        on_disk = self._scan_disk()
+        entries = OrderedDict((key, on_disk[key][0]) for key in sorted(on_disk, key=lambda key: on_disk[key][1]))
+        with self._lock:
+            self._entries = entries
+            self._total_bytes = sum(entries.values())
+            self._last_sync = time.time()
+            self._dirty = True
+
+    def save_index(self, force=False):
+        """Escribir el índice LRU en disco (limitado a una escritura cada INDEX_SAVE_INTERVAL)"""
+        with self._lock:
+            if not self._dirty and not force:
+                return
+            if not force and time.time() - self._last_index_save < self.INDEX_SAVE_INTERVAL:
+                return
+            entries = [list(key) for key in self._entries]
+            self._dirty = False
+            self._last_index_save = time.time()
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'chunk_size': VIDEO_CHUNK_SIZE, 'entries': entries}, f)
+            os.replace(tmp_path, index_path)
+        except Exception as e:
+            print(f"⚠️ Error guardando índice de caché de video: {e}", flush=True)
+
+    def _evict_locked(self):
+        """Expulsar lo menos reciente hasta que lo guardado más lo reservado quepa en el
+        presupuesto (requiere self._lock). Los chunks de un documento que se está
+        materializando no se expulsan: se están copiando."""
+        if self._total_bytes + self._reserved_bytes <= self.max_bytes:
+            return
+        for key in list(self._entries):
+            if self._total_bytes + self._reserved_bytes <= self.max_bytes:
+                break
+            doc_id, offset = key
+            if doc_id in self._materializing and offset != self.DOCUMENT_OFFSET:
+                continue
+            self._total_bytes -= self._entries.pop(key)
+            self._dirty = True
+            try:
+                os.remove(self._chunk_path(doc_id, offset))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️ Error eliminando chunk expulsado {doc_id}@{offset}: {e}", flush=True)
+
+    def _forget(self, key):
+        """Quitar del índice una entrada cuyo archivo ya no existe (la expulsó otro worker)"""
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self._total_bytes -= size
+
+    def contains(self, doc_id, offset):
+        with self._lock:
+            return (doc_id, offset) in self._entries or (doc_id, self.DOCUMENT_OFFSET) in self._entries
+
+    def get(self, doc_id, offset):
+        """Leer un chunk de la caché (suelto o dentro del documento materializado). None si no está."""
+        key = (doc_id, offset)
+        with self._lock:
+            if key not in self._entries:
+                key = (doc_id, self.DOCUMENT_OFFSET)
+                if key not in self._entries:
+                    return None
+            self._entries.move_to_end(key)
+            self._dirty = True
+        path = self._chunk_path(*key)
+        try:
+            os.utime(path)  # Recencia visible para los otros workers
+            with open(path, 'rb') as f:
+                if key[1] == self.DOCUMENT_OFFSET:
+                    f.seek(offset)
+                    return f.read(VIDEO_CHUNK_SIZE) or None
+                return f.read()
+        except FileNotFoundError:
+            # Expulsado (por este u otro worker) entre la consulta del índice y la lectura
+            self._forget(key)
+            return None
+
+    def put(self, doc_id, offset, data):
+        """Guardar un chunk en la caché (escritura atómica) y expulsar lo necesario"""
+        if not data or len(data) > self.max_bytes:
+            return
+        if self.document_path(doc_id) is not None:
+            return  # Ya está dentro del documento materializado
+        key = (doc_id, offset)
+        chunk_path = self._chunk_path(doc_id, offset)
+        try:
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            tmp_path = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, chunk_path)
+        except Exception as e:
+            print(f"⚠️ Error guardando chunk {doc_id}@{offset} en caché: {e}", flush=True)
+            return
+        with self._shared_lock():
+            if time.time() - self._last_sync >= self.SYNC_INTERVAL:
+                self._sync_with_disk()
+            with self._lock:
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self._total_bytes -= previous
+                self._entries[key] = len(data)
+                self._total_bytes += len(data)
+                self._dirty = True
+                self._evict_locked()
+        self.save_index()
+
+    def is_complete(self, doc_id, document_size):
+        """True si todos los chunks del documento están en disco (sueltos, sin materializar)"""
+        with self._lock:
+            return document_size > 0 and all((doc_id, offset) in self._entries for offset in range(0, document_size, VIDEO_CHUNK_SIZE))
+
+    def document_path(self, doc_id):
+        """Ruta del documento materializado (y lo marca como reciente), o None si no existe"""
+        key = (doc_id, self.DOCUMENT_OFFSET)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            self._dirty = True
+        path = self._chunk_path(*key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        return path
+
+    def materialize(self, doc_id, document_size):
+        """Unir los chunks de un documento completo en document.bin y borrar los chunks sueltos.
+        Devuelve True si el documento queda materializado.
+
+        Mientras se copia, el documento ocupa el doble en disco: su tamaño se reserva en el
+        presupuesto antes de empezar (expulsando lo necesario) y no se materializan documentos
+        que no quepan dos veces."""
+        offsets = range(0, document_size, VIDEO_CHUNK_SIZE)
+        with self._lock:
+            if (doc_id, self.DOCUMENT_OFFSET) in self._entries:
+                return True
+            if doc_id in self._materializing or document_size <= 0 or document_size * 2 > self.max_bytes:
+                return False
+            if any((doc_id, offset) not in self._entries for offset in offsets):
+                return False
+            self._materializing.add(doc_id)
+        document_path = self._chunk_path(doc_id, self.DOCUMENT_OFFSET)
+        tmp_path = f"{document_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        reserved = False
+        try:
+            with self._shared_lock(), self._lock:
+                self._reserved_bytes += document_size
+                reserved = True
+                self._evict_locked()
+            try:
+                with open(tmp_path, 'wb') as out:
+                    for offset in offsets:
+                        with open(self._chunk_path(doc_id, offset), 'rb') as f:
+                            out.write(f.read())
+                if os.path.getsize(tmp_path) != document_size:
+                    raise IOError(f"tamaño {os.path.getsize(tmp_path)} != {document_size}")
+                os.replace(tmp_path, document_path)
+            except Exception as e:
+                # Normalmente un chunk expulsado por otro worker mientras se copiaba
+                print(f"⚠️ No se pudo materializar el documento {doc_id}: {e}", flush=True)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return False
+            with self._shared_lock():
+                with self._lock:
+                    for offset in offsets:
+                        size = self._entries.pop((doc_id, offset), None)
+                        if size is not None:
+                            self._total_bytes -= size
+                    self._reserved_bytes -= document_size
+                    reserved = False
+                    self._materializing.discard(doc_id)
+                    self._entries[(doc_id, self.DOCUMENT_OFFSET)] = document_size
+                    self._total_bytes += document_size
+                    self._dirty = True
+                    self._evict_locked()
+                for offset in offsets:
+                    try:
+                        os.remove(self._chunk_path(doc_id, offset))
+                    except FileNotFoundError:
+                        pass
+        finally:
+            with self._lock:
+                if reserved:
+                    self._reserved_bytes -= document_size
+                self._materializing.discard(doc_id)
+        self.save_index()
+        print(f"📦 Documento {doc_id} materializado en disco ({document_size / (1024*1024):.1f}MB)", flush=True)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'chunks': len(self._entries),
+                'documents': sum(1 for _, offset in self._entries if offset == self.DOCUMENT_OFFSET),
+                'bytes': self._total_bytes,
+                'reserved_bytes': self._reserved_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+video_chunk_cache = DiskChunkCache(VIDEO_CACHE_DIR, VIDEO_CACHE_MAX_BYTES)
+atexit.register(lambda: video_chunk_cache.save_index(force=True))
+
+# Caché en memoria por delante de la de disco (chunks calientes, con presupuesto de bytes)
+VIDEO_MEMORY_CACHE_MAX_BYTES = int(os.getenv('VIDEO_MEMORY_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 256MB por defecto
+VIDEO_MEMORY_CACHE_POLICY = os.getenv('VIDEO_MEMORY_CACHE_POLICY', 'lru').lower()  # 'lru' o 'lfu'
+# Al listar mensajes solo se pre-carga el inicio de cada video, nunca más de 1/4 del presupuesto
+VIDEO_MEMORY_PRELOAD_BYTES = min(int(os.getenv('VIDEO_MEMORY_PRELOAD_BYTES', 4 * 1024 * 1024)), VIDEO_MEMORY_CACHE_MAX_BYTES // 4)
+VIDEO_PREFETCH_WORKERS = max(1, int(os.getenv('VIDEO_PREFETCH_WORKERS', 2)))  # Descargas de pre-carga simultáneas (total)
+
+class MemoryChunkCache:
+    """Caché en memoria de chunks de video con presupuesto de bytes y expulsión LRU o LFU.
+
+    Es el nivel más rápido delante de la caché de disco: guarda chunks alineados
+    (doc_id, offset) y lleva contadores de aciertos, fallos y expulsiones.
+    """
+
+    def __init__(self, max_bytes, policy='lru'):
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in ('lru', 'lfu') else 'lru'
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (doc_id, offset) -> bytes; el final es lo más reciente
+        self._frequency = {}  # (doc_id, offset) -> número de accesos (para LFU)
+        self._pinned = OrderedDict()  # doc_id -> set(offsets) que no se expulsan (p. ej. el moov)
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def contains(self, doc_id, offset):
+        with self._lock:
+            return (doc_id, offset) in self._entries
+
+    def get(self, doc_id, offset):
+        key = (doc_id, offset)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._frequency[key] = self._frequency.get(key, 0) + 1
+            return data
+
+    def put(self, doc_id, offset, data):
+        if not data or len(data) > self.max_bytes:
+            return
+        key = (doc_id, offset)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= len(previous)
+            self._entries[key] = data
+            self._frequency.setdefault(key, 1)
+            self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                if not self._evict_one_locked(protect=key):
+                    break
+
+    def pin(self, doc_id, offsets):
+        """Marcar chunks de un documento como no expulsables (aunque aún no estén en caché).
+        Los pins ocupan como mucho 1/4 del presupuesto; si no caben se suelta el documento más antiguo."""
+        max_pinned_chunks = max(1, self.max_bytes // 4 // VIDEO_CHUNK_SIZE)
+        offsets = set(offsets)
+        if len(offsets) > max_pinned_chunks:
+            return False
+        with self._lock:
+            self._pinned.pop(doc_id, None)
+            self._pinned[doc_id] = offsets
+            while sum(len(pinned) for pinned in self._pinned.values()) > max_pinned_chunks:
+                self._pinned.popitem(last=False)
+        return True
+
+    def _is_pinned_locked(self, key):
+        pinned = self._pinned.get(key[0])
+        return pinned is not None and key[1] in pinned
+
+    def _evict_one_locked(self, protect=None):
+        candidates = [k for k in self._entries if k != protect and not self._is_pinned_locked(k)]
+        if not candidates:
+            return False
+        if self.policy == 'lfu':
+            # Menor frecuencia; a igualdad, el menos reciente (orden del OrderedDict)
+            victim = min(candidates, key=lambda k: self._frequency.get(k, 0))
+        else:
+            victim = candidates[0]
+        data = self._entries.pop(victim)
+        self._frequency.pop(victim, None)
+        self._total_bytes -= len(data)
+        self.evictions += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'policy': self.policy,
+                'chunks': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'pinned_chunks': sum(len(pinned) for pinned in self._pinned.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+video_memory_cache = MemoryChunkCache(VIDEO_MEMORY_CACHE_MAX_BYTES, VIDEO_MEMORY_CACHE_POLICY)
+
+def get_cached_chunk(doc_id, offset):
+    """Buscar un chunk en memoria y después en disco (subiéndolo a memoria si estaba en disco)"""
+    data = video_memory_cache.get(doc_id, offset)
+    if data is None:
+        data = video_chunk_cache.get(doc_id, offset)
+        if data is not None:
+            video_memory_cache.put(doc_id, offset, data)
+    return data
+
+def is_chunk_cached(doc_id, offset):
+    return video_memory_cache.contains(doc_id, offset) or video_chunk_cache.contains(doc_id, offset)
+
+def store_chunk(doc_id, offset, data, document_size=None):
+    """Guardar un chunk descargado de Telegram en la caché de memoria y en la de disco.
+    Al completar un documento se materializa en un solo archivo en segundo plano."""
+    video_memory_cache.put(doc_id, offset, data)
+    video_chunk_cache.put(doc_id, offset, data)
+    if VIDEO_MATERIALIZE_ENABLED and document_size and video_chunk_cache.is_complete(doc_id, document_size):
+        threading.Thread(target=video_chunk_cache.materialize, args=(doc_id, document_size), daemon=True).start()
+
+def aligned_chunk_offsets(start, end):
+    """Offsets alineados a VIDEO_CHUNK_SIZE que cubren el rango [start, end] (end inclusivo)"""
+    first = start - (start % VIDEO_CHUNK_SIZE)
+    return list(range(first, end + 1, VIDEO_CHUNK_SIZE))
+
+async def _fetch_document_chunks_sequential(client, media, offsets):
+    """Descargar chunks alineados por la conexión principal del cliente.
+
+    Los offsets consecutivos se agrupan en una sola iteración de iter_download
+    (que maneja DC, file_reference y límites de GetFileRequest).
+    Devuelve un dict {offset: bytes}.
+    """
+    results = {}
+    runs = []
+    for offset in sorted(offsets):
+        if runs and offset == runs[-1][0] + runs[-1][1] * VIDEO_CHUNK_SIZE:
+            runs[-1][1] += 1
+        else:
+            runs.append([offset, 1])
+
+    for run_start, run_count in runs:
+        index = 0
+        async for chunk in client.iter_download(media, offset=run_start, request_size=VIDEO_CHUNK_SIZE, limit=run_count):
+            results[run_start + index * VIDEO_CHUNK_SIZE] = bytes(chunk)
+            index += 1
+    return results
+
+class DownloadSenderPool:
+    """Pool de conexiones MTProto adicionales hacia el DC donde vive un archivo.
+
+    La conexión principal de TelegramClient procesa las partes de una en una; con varias
+    conexiones propias (autorizadas con ExportAuthorization/ImportAuthorization si el DC no es
+    el de la cuenta) se pueden tener varias GetFileRequest en vuelo a la vez.
+    """
+
+    def __init__(self, client, dc_id, size, label='descarga'):
+        self.client = client
+        self.dc_id = dc_id
+        self.size = size
+        self.label = label
+        self._senders = []
+        self._lock = None
+
+    async def _create_sender(self):
+        client = self.client
+        dc = await client._get_dc(self.dc_id)
+        is_home_dc = self.dc_id == client.session.dc_id
+        # En el DC propio se reutiliza la auth_key de la sesión; en otro DC se genera una nueva
+        sender = MTProtoSender(client.session.auth_key if is_home_dc else None, loggers=client._log)
+        await sender.connect(client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=client._log,
+            proxy=client._proxy,
+            local_addr=client._local_addr
+        ))
+        # Copia del initConnection del cliente para no alterar el que usa la conexión principal
+        init_request = copy.copy(client._init_request)
+        if is_home_dc:
+            init_request.query = GetConfigRequest()
+        else:
+            auth = await client(ExportAuthorizationRequest(self.dc_id))
+            init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+        await sender.send(InvokeWithLayerRequest(LAYER, init_request))
+        return sender
+
+    async def get_senders(self):
+        """Devolver las conexiones del pool, creando las que falten"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._senders = [sender for sender in self._senders if sender.is_connected()]
+            while len(self._senders) < self.size:
+                try:
+                    self._senders.append(await self._create_sender())
+                    print(f"🔌 Conexión de {self.label} paralela {len(self._senders)}/{self.size} lista para DC {self.dc_id}", flush=True)
+                except Exception as e:
+                    print(f"⚠️ No se pudo crear conexión de {self.label} para DC {self.dc_id}: {type(e).__name__}: {e}", flush=True)
+                    break
+            return list(self._senders)
+
+    async def discard(self, sender):
+        if sender in self._senders:
+            self._senders.remove(sender)
+        try:
+            await sender.disconnect()
+        except Exception:
+            pass
+
+    async def close(self):
+        senders, self._senders = self._senders, []
+        for sender in senders:
+            try:
+                await sender.disconnect()
+            except Exception:
+                pass
+
+def get_download_sender_pool(client, dc_id):
+    """Obtener (o crear) el pool de conexiones de descarga de un cliente para un DC"""
+    key = (client, dc_id)
+    with _download_sender_pools_lock:
+        pool = _download_sender_pools.get(key)
+        if pool is None:
+            pool = DownloadSenderPool(client, dc_id, PARALLEL_DOWNLOAD_SENDERS)
+            _download_sender_pools[key] = pool
+        return pool
+
+def get_upload_sender_pool(client):
+    """Pool de conexiones de subida hacia el DC de la cuenta (separado del de descargas para
+    que una subida grande no quite conexiones a los espectadores)"""
+    key = (client, ('upload', client.session.dc_id))
+    with _download_sender_pools_lock:
+        pool = _download_sender_pools.get(key)
+        if pool is None:
+            pool = DownloadSenderPool(client, client.session.dc_id, UPLOAD_PARALLEL_SENDERS, label='subida')
+            _download_sender_pools[key] = pool
+        return pool
+
+async def close_download_sender_pools(client):
+    """Desconectar todas las conexiones paralelas (descarga y subida) de un cliente"""
+    with _download_sender_pools_lock:
+        pools = [pool for (pool_client, _), pool in _download_sender_pools.items() if pool_client is client]
+        for key in [key for key in _download_sender_pools if key[0] is client]:
+            del _download_sender_pools[key]
+    for pool in pools:
+        await pool.close()
+
+async def _fetch_document_chunks_parallel(client, media, offsets):
+    """Descargar chunks alineados con varias GetFileRequest en vuelo repartidas entre las
+    conexiones del pool del DC del archivo. Las partes que fallen se reintentan por la
+    conexión principal."""
+    dc_id, location = get_input_location(media)
+    if not dc_id:
+        return await _fetch_document_chunks_sequential(client, media, offsets)
+
+    pool = get_download_sender_pool(client, dc_id)
+    senders = await pool.get_senders()
+    if not senders:
+        return await _fetch_document_chunks_sequential(client, media, offsets)
+
+    semaphore = asyncio.Semaphore(len(senders) * PARALLEL_DOWNLOAD_REQUESTS_PER_SENDER)
+    results = {}
+    failed = []
+
+    async def fetch_part(index, offset):
+        sender = senders[index % len(senders)]
+        async with semaphore:
+            try:
+                result = await sender.send(GetFileRequest(location=location, offset=offset, limit=VIDEO_CHUNK_SIZE))
+                results[offset] = bytes(result.bytes)
+            except (FileReferenceExpiredError, FilerefUpgradeNeededError):
+                raise
+            except Exception as e:
+                print(f"⚠️ Parte {offset} falló en conexión paralela (DC {dc_id}): {type(e).__name__}: {e}", flush=True)
+                failed.append(offset)
+                if not sender.is_connected():
+                    await pool.discard(sender)
+
+    await asyncio.gather(*(fetch_part(index, offset) for index, offset in enumerate(sorted(offsets))))
+
+    if failed:
+        results.update(await _fetch_document_chunks_sequential(client, media, failed))
+    return results
+
+async def fetch_document_chunks(client, media, offsets, refresh_media=None):
+    """Descargar de Telegram los chunks alineados indicados. Devuelve un dict {offset: bytes}.
+
+    Con más de un chunk se usan las conexiones paralelas del DC del archivo; un chunk suelto
+    va por la conexión principal, que ya está abierta. Si el file_reference expiró y se pasa
+    refresh_media (corrutina sin argumentos que devuelve el documento actualizado), se
+    refresca y se reintenta una vez.
+    """
+    async def fetch(current_media):
+        if len(offsets) > 1 and PARALLEL_DOWNLOAD_SENDERS > 1:
+            return await _fetch_document_chunks_parallel(client, current_media, offsets)
+        return await _fetch_document_chunks_sequential(client, current_media, offsets)
+
+    try:
+        return await fetch(media)
+    except (FileReferenceExpiredError, FilerefUpgradeNeededError) as e:
+        if refresh_media is None:
+            raise
+        print(f"🔄 file_reference expirado ({type(e).__name__}), refrescando documento y reintentando...", flush=True)
+        refreshed = await refresh_media()
+        if refreshed is None:
+            raise
+        return await fetch(refreshed)
+
+class _InflightChunk:
+    """Descarga de un chunk en curso que otros threads pueden esperar"""
+    __slots__ = ('event', 'data', 'error', 'ticket')
+
+    def __init__(self, ticket=None):
+        self.event = threading.Event()
+        self.data = None
+        self.error = None
+        self.ticket = ticket  # Turno del dueño en download_scheduler (para subirle la prioridad)
+
+class ChunkSingleFlight:
+    """Coalescencia de descargas idénticas (single-flight) por (doc_id, offset alineado).
+
+    Cuando muchos navegadores piden a la vez los mismos bytes (un link compartido en un grupo),
+    solo el primer thread va a Telegram; el resto espera su resultado en lugar de lanzar otra
+    GetFileRequest por el mismo loop del cliente.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.coalesced = 0  # Descargas ahorradas (para diagnóstico)
+
+    def claim(self, doc_id, offsets, ticket=None):
+        """Repartir offsets entre los que este thread debe descargar y los que ya están en vuelo.
+        Devuelve (propios, {offset: _InflightChunk ajeno}). ticket es el turno con el que este
+        thread descargará los propios."""
+        owned = []
+        waiting = {}
+        with self._lock:
+            for offset in offsets:
+                flight = self._inflight.get((doc_id, offset))
+                if flight is None:
+                    self._inflight[(doc_id, offset)] = _InflightChunk(ticket)
+                    owned.append(offset)
+                else:
+                    waiting[offset] = flight
+                    self.coalesced += 1
+        return owned, waiting
+
+    def complete(self, doc_id, offset, data=None, error=None):
+        with self._lock:
+            flight = self._inflight.pop((doc_id, offset), None)
+        if flight is not None:
+            flight.data = data
+            flight.error = error
+            flight.event.set()
+
+chunk_single_flight = ChunkSingleFlight()
+
+# ==================== REPARTO JUSTO DE DESCARGAS ====================
+# Todas las descargas de Telegram de una cuenta pasan por el mismo loop del cliente. Sin
+# reparto, un espectador bajando un archivo de 4GB en rangos grandes deja esperando los
+# seeks de todos los demás.
+
+DOWNLOAD_PRIORITY_INTERACTIVE = 0  # Primer chunk y seeks: alguien tiene el video parado esperando
+DOWNLOAD_PRIORITY_BULK = 1  # Lectura secuencial (el navegador va por delante de la reproducción)
+DOWNLOAD_PRIORITY_PREFETCH = 2  # Pre-cargas especulativas
+DOWNLOAD_SCHEDULER_SLOTS = max(1, int(os.getenv('DOWNLOAD_SCHEDULER_SLOTS', 4)))  # Descargas simultáneas hacia Telegram
+VIDEO_VIEWER_MAX_BYTES_PER_SECOND = int(os.getenv('VIDEO_VIEWER_MAX_BYTES_PER_SECOND', 0))  # 0 = sin límite por espectador
+
+class DownloadTicket:
+    """Turno pedido a FairDownloadScheduler. Su prioridad puede subir mientras espera, cuando
+    alguien más urgente se suma a la descarga compartida (ver FairDownloadScheduler.boost)."""
+    __slots__ = ('priority', 'entry')
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.entry = None  # Entrada en el heap mientras espera turno
+
+class FairDownloadScheduler:
+    """Turnos de descarga hacia Telegram repartidos entre espectadores (start-time fair queuing).
+
+    Solo `slots` descargas van a la vez al loop del cliente. Entre las que esperan gana la de
+    mayor prioridad (interactiva > secuencial > pre-carga) y, a igual prioridad, la de menor
+    etiqueta de inicio: cada espectador acumula etiqueta según los chunks que ya ha pedido,
+    así que el que más descarga cede el turno a los demás. Opcionalmente limita los bytes por
+    segundo de cada espectador en las descargas no interactivas.
+
+    Una descarga compartida (single-flight) espera con la prioridad de su dueño: si se le suma
+    un request más urgente, boost() sube el turno del dueño para no dejarlo detrás de la cola.
+    """
+
+    MAX_TRACKED_VIEWERS = 1000
+
+    def __init__(self, slots, viewer_rate=0):
+        self.slots = slots
+        self.viewer_rate = viewer_rate
+        self._cond = threading.Condition()
+        self._waiting = []  # heap de [prioridad, etiqueta de inicio, secuencia]
+        self._active = 0
+        self._sequence = 0
+        self._virtual_time = 0.0
+        self._finish_tags = {}  # viewer -> etiqueta de fin de su último pedido
+        self._next_allowed = {}  # viewer -> instante a partir del cual puede volver a descargar (límite de ritmo)
+        self._last_range_end = OrderedDict()  # (viewer, doc_id) -> último byte pedido
+        self.granted = [0, 0, 0]
+        self.boosted = 0
+        self.throttled_seconds = 0.0
+
+    def classify_range(self, viewer, doc_id, start, end):
+        """Prioridad de un Range: continuar donde terminó el anterior es lectura secuencial;
+        el inicio del archivo o un salto a otra posición es un seek interactivo."""
+        key = (viewer, doc_id)
+        with self._cond:
+            last_end = self._last_range_end.pop(key, None)
+            self._last_range_end[key] = end
+            while len(self._last_range_end) > self.MAX_TRACKED_VIEWERS:
+                self._last_range_end.popitem(last=False)
+        if start > 0 and last_end is not None and abs(start - (last_end + 1)) <= VIDEO_CHUNK_SIZE:
+            return DOWNLOAD_PRIORITY_BULK
+        return DOWNLOAD_PRIORITY_INTERACTIVE
+
+    @contextmanager
+    def slot(self, viewer, priority, cost, timeout=None, ticket=None):
+        """Esperar turno para descargar `cost` chunks. Lanza asyncio.TimeoutError si no llega a tiempo.
+        ticket (DownloadTicket) permite que otros threads suban la prioridad mientras espera."""
+        deadline = time.time() + timeout if timeout else None
+        ticket = ticket or DownloadTicket(priority)
+        with self._cond:
+            if self.viewer_rate and ticket.priority != DOWNLOAD_PRIORITY_INTERACTIVE:
+                throttle_started = time.time()
+                allowed_at = self._next_allowed.get(viewer, 0)
+                if deadline is not None and allowed_at > deadline:
+                    raise asyncio.TimeoutError(f"Límite de ritmo del espectador {viewer}: habría que esperar {allowed_at - throttle_started:.1f}s")
+                # Un boost a interactiva corta la espera del límite de ritmo
+                while ticket.priority != DOWNLOAD_PRIORITY_INTERACTIVE and allowed_at > time.time():
+                    self._cond.wait(allowed_at - time.time())
+                self.throttled_seconds += time.time() - throttle_started
+
+            start_tag = max(self._virtual_time, self._finish_tags.get(viewer, 0.0))
+            self._finish_tags[viewer] = start_tag + cost
+            self._sequence += 1
+            entry = [ticket.priority, start_tag, self._sequence]
+            ticket.entry = entry
+            heapq.heappush(self._waiting, entry)
+            while self._active >= self.slots or self._waiting[0] is not entry:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    ticket.entry = None
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    raise asyncio.TimeoutError("Timeout esperando turno de descarga hacia Telegram")
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            ticket.entry = None
+            self._active += 1
+            self._virtual_time = start_tag
+            self.granted[entry[0]] += 1
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                if self.viewer_rate:
+                    self._next_allowed[viewer] = max(time.time(), self._next_allowed.get(viewer, 0)) + cost * VIDEO_CHUNK_SIZE / self.viewer_rate
+                if len(self._finish_tags) > self.MAX_TRACKED_VIEWERS:
+                    # Los espectadores que ya no van por delante del tiempo virtual no necesitan etiqueta
+                    self._finish_tags = {v: tag for v, tag in self._finish_tags.items() if tag > self._virtual_time}
+                    self._next_allowed = {v: t for v, t in self._next_allowed.items() if t > time.time()}
+                self._cond.notify_all()
+
+    def boost(self, ticket, priority):
+        """Subir a `priority` el turno de una descarga que otro request más urgente está esperando
+        (herencia de prioridad). Si ya tiene turno o su prioridad es igual o mayor, no hace nada."""
+        if ticket is None:
+            return
+        with self._cond:
+            if priority >= ticket.priority:
+                return
+            ticket.priority = priority
+            if ticket.entry is not None:
+                ticket.entry[0] = priority
+                heapq.heapify(self._waiting)
+            self.boosted += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'slots': self.slots,
+                'active': self._active,
+                'waiting': len(self._waiting),
+                'granted': {'interactive': self.granted[0], 'bulk': self.granted[1], 'prefetch': self.granted[2]},
+                'boosted': self.boosted,
+                'viewer_max_bytes_per_second': self.viewer_rate,
+                'throttled_seconds': round(self.throttled_seconds, 1),
+            }
+
+download_scheduler = FairDownloadScheduler(DOWNLOAD_SCHEDULER_SLOTS, VIDEO_VIEWER_MAX_BYTES_PER_SECOND)
+
+# ==================== ESTIMACIÓN DE THROUGHPUT ====================
+# Media móvil exponencial de bytes/segundo por DC de Telegram (lo que tarda en llegar cada
+# descarga) y por espectador (lo que tarda su conexión en aceptar los bytes que le enviamos).
+# get_video dimensiona con ellas el tamaño de cada respuesta Range y los timeouts.
+
+VIDEO_RANGE_TARGET_SECONDS = float(os.getenv('VIDEO_RANGE_TARGET_SECONDS', 4))  # Duración objetivo de cada respuesta Range
+VIDEO_RANGE_MIN_BYTES = VIDEO_CHUNK_SIZE  # Nunca menos de un chunk alineado por respuesta
+VIDEO_TIMEOUT_SAFETY_FACTOR = 4  # Margen sobre el tiempo esperado según el throughput del DC
+VIDEO_TIMEOUT_MIN_SECONDS = 10
+VIDEO_TIMEOUT_MAX_SECONDS = 300
+
+class ThroughputEstimator:
+    """Media móvil exponencial de bytes/segundo por clave (DC o espectador), con límite de claves"""
+
+    MIN_SAMPLE_BYTES = 64 * 1024  # Muestras más pequeñas miden latencia, no ancho de banda
+
+    def __init__(self, alpha=0.3, max_keys=1000):
+        self.alpha = alpha
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._rates = OrderedDict()  # clave -> (bytes/s, muestras)
+
+    def record(self, key, nbytes, seconds):
+        if key is None or nbytes < self.MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        sample = nbytes / seconds
+        with self._lock:
+            previous = self._rates.pop(key, None)
+            if previous is None:
+                self._rates[key] = (sample, 1)
+            else:
+                rate, samples = previous
+                self._rates[key] = (rate + self.alpha * (sample - rate), samples + 1)
+            while len(self._rates) > self.max_keys:
+                self._rates.popitem(last=False)
+
+    def rate(self, key):
+        """bytes/segundo estimados para la clave, o None si aún no hay muestras"""
+        with self._lock:
+            entry = self._rates.get(key)
+        return entry[0] if entry else None
+
+    def stats(self, limit=20):
+        with self._lock:
+            items = list(self._rates.items())[-limit:]
+        return {str(key): {'mb_per_second': round(rate / (1024 * 1024), 2), 'samples': samples} for key, (rate, samples) in items}
+
+dc_throughput = ThroughputEstimator()
+viewer_throughput = ThroughputEstimator()
+
+def adaptive_range_bytes(dc_id, viewer, max_bytes):
+    """Bytes a servir en una respuesta Range: lo que el eslabón más lento (DC o espectador)
+    entrega en VIDEO_RANGE_TARGET_SECONDS, alineado a chunks y acotado a [1 chunk, max_bytes].
+    Sin estimaciones se usa max_bytes, como antes."""
+    rates = [rate for rate in (dc_throughput.rate(dc_id), viewer_throughput.rate(viewer)) if rate]
+    if not rates:
+        return max_bytes
+    target = int(min(rates) * VIDEO_RANGE_TARGET_SECONDS)
+    target = (target // VIDEO_CHUNK_SIZE) * VIDEO_CHUNK_SIZE
+    return max(min(VIDEO_RANGE_MIN_BYTES, max_bytes), min(target, max_bytes))
+
+def adaptive_timeout(dc_id, nbytes, default):
+    """Timeout para descargar nbytes del DC: el tiempo esperado según su throughput con margen,
+    acotado a [VIDEO_TIMEOUT_MIN_SECONDS, VIDEO_TIMEOUT_MAX_SECONDS]. Sin estimación, default."""
+    rate = dc_throughput.rate(dc_id)
+    if not rate:
+        return default
+    expected = nbytes / rate * VIDEO_TIMEOUT_SAFETY_FACTOR
+    return int(min(VIDEO_TIMEOUT_MAX_SECONDS, max(VIDEO_TIMEOUT_MIN_SECONDS, math.ceil(expected))))
+
+def adaptive_initial_bytes(viewer, file_size):
+    """Tamaño de la respuesta sin Range: 128KB por defecto; a un espectador rápido se le da
+    más del primer chunk (que ya está descargado entero) para ahorrarle un round trip."""
+    size = VIDEO_INITIAL_CHUNK_SIZE
+    rate = viewer_throughput.rate(viewer)
+    if rate:
+        size = max(size, min(VIDEO_CHUNK_SIZE, int(rate * 0.5)))
+    return min(size, file_size)
+
+def fetch_chunks_coalesced(client, client_loop, media, doc_id, offsets, timeout=None, refresh_media=None,
+                           viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Descargar los chunks indicados (que no están en caché) compartiendo las descargas
+    que otros requests ya tengan en curso. Los chunks descargados se guardan en la caché
+    de memoria y en la de disco. Devuelve un dict {offset: bytes}.
+    La descarga propia espera su turno en download_scheduler (viewer + priority); las ajenas
+    que se esperan heredan priority si es más urgente que la de su dueño."""
+    ticket = DownloadTicket(priority)
+    owned, waiting = chunk_single_flight.claim(doc_id, offsets, ticket)
+    results = {}
+    for flight in waiting.values():
+        download_scheduler.boost(flight.ticket, priority)
+
+    if owned:
+        try:
+            with download_scheduler.slot(viewer or 'anonimo', priority, len(owned), timeout=timeout, ticket=ticket):
+                fetch_started = time.time()
+                fetched = run_async(fetch_document_chunks(client, media, owned, refresh_media), client_loop, timeout=timeout)
+                dc_throughput.record(getattr(media, 'dc_id', None), sum(len(data) for data in fetched.values() if data), time.time() - fetch_started)
+        except BaseException as e:
+            for offset in owned:
+                chunk_single_flight.complete(doc_id, offset, error=e)
+            raise
+        for offset in owned:
+            data = fetched.get(offset)
+            if data:
+                store_chunk(doc_id, offset, data, getattr(media, 'size', None))
+            chunk_single_flight.complete(doc_id, offset, data=data)
+        results.update(fetched)
+
+    if waiting:
+        print(f"🤝 Documento {doc_id}: esperando {len(waiting)} chunk(s) que otro request ya está descargando", flush=True)
+    for offset, flight in waiting.items():
+        if not flight.event.wait(timeout):
+            raise asyncio.TimeoutError(f"Timeout esperando la descarga compartida del offset {offset}")
+        if flight.error is not None:
+            raise flight.error
+        if flight.data:
+            results[offset] = flight.data
+    return results
+
+def read_document_range(client, client_loop, media, doc_id, start, end, timeout=None, refresh_media=None,
+                        viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Leer el rango [start, end] de un documento combinando chunks cacheados (memoria/disco)
+    con los que falten, que se descargan de Telegram y se guardan en la caché."""
+    offsets = aligned_chunk_offsets(start, end)
+    chunks = {}
+    missing = []
+    for offset in offsets:
+        data = get_cached_chunk(doc_id, offset)
+        if data is None:
+            missing.append(offset)
+        else:
+            chunks[offset] = data
+
+    print(f"💾 Caché de video {doc_id}: {len(chunks)}/{len(offsets)} chunks en caché (memoria/disco), descargando {len(missing)} de Telegram", flush=True)
+
+    if missing:
+        chunks.update(fetch_chunks_coalesced(client, client_loop, media, doc_id, missing, timeout=timeout, refresh_media=refresh_media,
+                                             viewer=viewer, priority=priority))
+
+    parts = []
+    for offset in offsets:
+        data = chunks.get(offset)
+        if not data:
+            break
+        # memoryview: recortar el chunk sin copiarlo; la única copia es la del join
+        parts.append(memoryview(data)[max(start - offset, 0):end - offset + 1])
+        if len(data) < VIDEO_CHUNK_SIZE:
+            break  # Último chunk del archivo
+    return b''.join(parts)
+
+def iter_document_range(client, client_loop, media, doc_id, start, end, timeout=None, refresh_media=None,
+                        viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Generador que produce el rango [start, end] chunk a chunk.
+
+    Cada chunk se envía al socket en cuanto llega de Telegram (o de la caché de disco), y no se
+    pide más hasta que el servidor WSGI consume lo anterior: la memoria por request queda en
+    una ventana de PARALLEL_DOWNLOAD_WINDOW chunks y el tiempo al primer byte en un round trip.
+    Solo la primera descarga usa `priority`; las siguientes ventanas son lectura secuencial.
+    """
+    offsets = aligned_chunk_offsets(start, end)
+    window = {}  # Chunks descargados en paralelo pendientes de enviar, en orden
+    for position, offset in enumerate(offsets):
+        data = window.pop(offset, None)
+        if data is None:
+            data = get_cached_chunk(doc_id, offset)
+        if data is None:
+            # Descargar en paralelo este chunk y los siguientes que falten (ventana acotada)
+            batch = [offset]
+            for next_offset in offsets[position + 1:position + PARALLEL_DOWNLOAD_WINDOW]:
+                if is_chunk_cached(doc_id, next_offset):
+                    break
+                batch.append(next_offset)
+            fetched = fetch_chunks_coalesced(client, client_loop, media, doc_id, batch, timeout=timeout, refresh_media=refresh_media,
+                                             viewer=viewer, priority=priority)
+            priority = DOWNLOAD_PRIORITY_BULK
+            data = fetched.pop(offset, None)
+            if not data:
+                raise Exception(f"Telegram no devolvió datos para el offset {offset}")
+            window.update(fetched)
+
+        piece_start = max(start, offset) - offset
+        piece_end = min(end, offset + len(data) - 1) - offset + 1
+        if piece_end <= piece_start:
+            return
+        yield data[piece_start:piece_end]
+        if len(data) < VIDEO_CHUNK_SIZE:
+            return  # Último chunk del archivo
+
+def stream_document_range(client, client_loop, media, doc_id, start, end, timeout=None, refresh_media=None,
+                          viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Preparar un stream del rango [start, end] descargando ya el primer trozo.
+
+    Pedir el primer trozo antes de devolver la Response permite responder con un error
+    HTTP real si Telegram falla; los errores posteriores solo cortan la conexión y el
+    navegador vuelve a pedir el rango. Devuelve None si no hay datos.
+    """
+    pieces = iter_document_range(client, client_loop, media, doc_id, start, end, timeout=timeout, refresh_media=refresh_media,
+                                 viewer=viewer, priority=priority)
+    first_piece = next(pieces, None)
+    if not first_piece:
+        return None
+
+    def generate():
+        # El tiempo que el servidor WSGI tarda en volver tras cada yield es lo que tarda en
+        # escribir ese trozo en el socket: mide la conexión del espectador, no la de Telegram
+        sent = len(first_piece)
+        write_seconds = 0.0
+        write_started = time.time()
+        yield first_piece
+        write_seconds += time.time() - write_started
+        try:
+            for piece in pieces:
+                sent += len(piece)
+                write_started = time.time()
+                yield piece
+                write_seconds += time.time() - write_started
+        except Exception as e:
+            print(f"❌ Error durante el streaming del documento {doc_id} (enviados {sent} bytes desde {start}): {type(e).__name__}: {e}", flush=True)
+        finally:
+            pieces.close()
+            if viewer is not None:
+                viewer_throughput.record(viewer, sent, write_seconds)
+
+    return generate()
+
+# ==================== PRE-CARGA DE VIDEOS ====================
+# Al listar un chat se pre-carga el inicio y el moov (índice del MP4) de cada video con un número fijo de workers, en vez de un thread por video descargando
+# el archivo completo. Los trabajos se agrupan por contexto (el teléfono del usuario) y se
+# cancelan cuando ese usuario cambia de chat o sale de la página.
+
+def prefetch_offsets(document):
+    """Offsets alineados que conviene tener en caché para empezar a reproducir al instante"""
+    size = document.size or 0
+    if size <= 0:
+        return []
+    return aligned_chunk_offsets(0, min(size, VIDEO_MEMORY_PRELOAD_BYTES) - 1)
+
+class _PrefetchJob:
+    def __init__(self, context, phone, document, video_id, priority):
+        self.context = context
+        self.phone = phone
+        self.document = document
+        self.video_id = video_id
+        self.priority = priority
+        self.cancelled = threading.Event()
+
+class PrefetchScheduler:
+    """Cola con prioridad de pre-cargas atendida por un número fijo de workers.
+
+    Un mismo documento nunca se pre-carga dos veces a la vez, y todos los trabajos de un
+    contexto se pueden cancelar de golpe (los que están en curso paran entre lotes de chunks).
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._jobs = {}  # doc_id -> _PrefetchJob en cola o en curso
+        self._contexts = {}  # context -> set(doc_id)
+        self._sequence = 0
+        self._threads = []
+        self.completed = 0
+        self.cancelled = 0
+        self.deduplicated = 0
+
+    def _ensure_workers_locked(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            worker = threading.Thread(target=self._worker, name=f"video-prefetch-{len(self._threads)}", daemon=True)
+            worker.start()
+            self._threads.append(worker)
+
+    def submit(self, context, phone, document, video_id, priority=0):
+        """Encolar la pre-carga de un documento. Menor priority = antes. Devuelve False si ya estaba en curso."""
+        with self._lock:
+            job = self._jobs.get(document.id)
+            if job is not None and not job.cancelled.is_set():
+                # Ya en cola o descargándose: solo pasa a pertenecer al contexto actual
+                self._contexts.get(job.context, set()).discard(document.id)
+                job.context = context
+                self._contexts.setdefault(context, set()).add(document.id)
+                self.deduplicated += 1
+                return False
+            job = _PrefetchJob(context, phone, document, video_id, priority)
+            self._jobs[document.id] = job
+            self._contexts.setdefault(context, set()).add(document.id)
+            self._sequence += 1
+            self._queue.put((priority, self._sequence, job))
+            self._ensure_workers_locked()
+            return True
+
+    def cancel(self, context):
+        """Cancelar todas las pre-cargas de un contexto. Devuelve cuántas se cancelaron."""
+        with self._lock:
+            doc_ids = self._contexts.pop(context, set())
+            cancelled = 0
+            for doc_id in doc_ids:
+                job = self._jobs.pop(doc_id, None)
+                if job is not None and job.context == context:
+                    job.cancelled.set()
+                    cancelled += 1
+            self.cancelled += cancelled
+        if cancelled:
+            print(f"🛑 Pre-carga cancelada para {context}: {cancelled} video(s)", flush=True)
+        return cancelled
+
+    def _finish(self, job):
+        with self._lock:
+            if self._jobs.get(job.document.id) is job:
+                del self._jobs[job.document.id]
+                self._contexts.get(job.context, set()).discard(job.document.id)
+
+    def _worker(self):
+        while True:
+            _, _, job = self._queue.get()
+            try:
+                if not job.cancelled.is_set():
+                    self._run(job)
+            except Exception as e:
+                print(f"⚠️ Error pre-cargando video {job.video_id}: {type(e).__name__}: {e}", flush=True)
+            finally:
+                self._finish(job)
+                self._queue.task_done()
+
+    def _run(self, job):
+        document = job.document
+        client, client_loop = get_background_client(job.phone)
+        if client is None:
+            print(f"⚠️ Pre-carga de {job.video_id} omitida: cliente de {job.phone} no disponible", flush=True)
+            return
+        # Los chunks que ya estén en disco solo se suben a memoria
+        missing = [offset for offset in prefetch_offsets(document) if get_cached_chunk(document.id, offset) is None]
+        if missing:
+            print(f"🔄 Pre-cargando video {job.video_id}: {len(missing)} chunk(s)", flush=True)
+        fetched = 0
+        for i in range(0, len(missing), PARALLEL_DOWNLOAD_WINDOW):
+            if job.cancelled.is_set():
+                print(f"🛑 Pre-carga de {job.video_id} interrumpida tras {fetched} bytes", flush=True)
+                return
+            batch = missing[i:i + PARALLEL_DOWNLOAD_WINDOW]
+            chunks = fetch_chunks_coalesced(client, client_loop, document, document.id, batch, timeout=VIDEO_CHUNK_FETCH_TIMEOUT,
+                                            viewer=f'prefetch:{job.phone}', priority=DOWNLOAD_PRIORITY_PREFETCH)
+            fetched += sum(len(c) for c in chunks.values())
+        if job.cancelled.is_set():
+            return
+        prepare_document_moov(client, client_loop, document, job.video_id, timeout=VIDEO_CHUNK_FETCH_TIMEOUT,
+                              viewer=f'prefetch:{job.phone}', priority=DOWNLOAD_PRIORITY_PREFETCH)
+        with self._lock:
+            self.completed += 1
+        if fetched:
+            print(f"✅ Video pre-cargado: {job.video_id} ({fetched} bytes)", flush=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued_or_running': len(self._jobs),
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'deduplicated': self.deduplicated,
+            }
+
+video_prefetch_scheduler = PrefetchScheduler(VIDEO_PREFETCH_WORKERS)
+
+# ==================== CACHÉ DE METADATOS DE VIDEO ====================
+# Cada Range request del navegador necesitaba MySQL + get_entity + get_messages antes de
+# enviar un solo byte. Con el documento ya resuelto en memoria se va directo a los bytes.
+
+VIDEO_METADATA_TTL = int(os.getenv('VIDEO_METADATA_TTL', 3600))  # 1 hora
+
+class VideoMetadataCache:
+    """Caché en memoria video_id -> documento de Telegram resuelto (con TTL)"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, video_id):
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is None:
+                return None
+            if time.time() > entry['expires_at']:
+                del self._entries[video_id]
+                return None
+            return dict(entry)
+
+    def put(self, video_id, metadata):
+        entry = dict(metadata)
+        entry['expires_at'] = time.time() + self.ttl
+        with self._lock:
+            self._entries[video_id] = entry
+
+    def update_document(self, video_id, document):
+        """Actualizar file_reference (y demás campos) tras refrescar el mensaje"""
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is not None:
+                entry.update(document_metadata(document))
+                entry['expires_at'] = time.time() + self.ttl
+
+    def update_fields(self, video_id, **fields):
+        """Añadir datos derivados del documento (p. ej. la posición del moov) a una entrada cacheada"""
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is not None:
+                entry.update(fields)
+
+    def invalidate(self, video_id):
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+def document_metadata(document):
+    """Extraer de un Document de Telegram los campos necesarios para descargarlo"""
+    return {
+        'doc_id': document.id,
+        'access_hash': document.access_hash,
+        'file_reference': document.file_reference,
+        'dc_id': document.dc_id,
+        'size': document.size,
+    }
+
+def document_from_metadata(metadata):
+    """Reconstruir un Document de Telegram a partir de los metadatos cacheados"""
+    return Document(
+        id=metadata['doc_id'],
+        access_hash=metadata['access_hash'],
+        file_reference=metadata['file_reference'],
+        date=None,
+        mime_type=metadata.get('mime_type') or 'video/mp4',
+        size=metadata['size'],
+        dc_id=metadata['dc_id'],
+        attributes=[]
+    )
+
+video_metadata_cache = VideoMetadataCache(VIDEO_METADATA_TTL)
+
+# ==================== UBICACIÓN DEL MOOV EN MP4 ====================
+# Muchos MP4 subidos tienen la caja moov (el índice) al final del archivo y el navegador
+# tiene que pedir ese final antes de poder mostrar el primer frame. Se localiza recorriendo
+# las cajas de primer nivel: el primer chunk da el tamaño del mdat, así que la cabecera de la
+# caja siguiente está en un offset exacto y se lee solo esa; el moov se fija en la caché.
+
+MP4_MOOV_MAX_HEADER_READS = 8  # Cabeceras fuera del primer chunk que se leen antes de rendirse
+
+def _read_box_header(buffer, pos):
+    """Leer (tamaño, tipo, longitud de cabecera) de la caja en buffer[pos:]; None si faltan bytes"""
+    if pos + 8 > len(buffer):
+        return None
+    size, box_type = struct.unpack('>I4s', buffer[pos:pos + 8])
+    header_size = 8
+    if size == 1:
+        if pos + 16 > len(buffer):
+            return None
+        size = struct.unpack('>Q', buffer[pos + 8:pos + 16])[0]
+        header_size = 16
+    return size, box_type, header_size
+
+def locate_mp4_moov(head, file_size, read_at=None):
+    """Buscar la caja moov recorriendo las cajas de primer nivel de un MP4.
+
+    head son los primeros bytes del archivo. Las cabeceras que caen fuera de head (la caja
+    que sigue al mdat, normalmente) se leen con read_at(offset, longitud). Devuelve
+    (offset, tamaño) del moov, o None si no es un MP4 o no se encuentra.
+    """
+    offset = 0
+    reads = 0
+    while offset + 8 <= file_size:
+        box = _read_box_header(head, offset) if offset < len(head) else None
+        if box is None:
+            if read_at is None or reads >= MP4_MOOV_MAX_HEADER_READS:
+                return None
+            reads += 1
+            box = _read_box_header(read_at(offset, min(16, file_size - offset)), 0)
+            if box is None:
+                return None
+        size, box_type, header_size = box
+        if not all(32 <= c < 127 for c in box_type):
+            return None  # No es una caja MP4 válida
+        if size == 0:
+            size = file_size - offset  # La caja llega hasta el final del archivo
+        if size < header_size or offset + size > file_size:
+            return None
+        if box_type == b'moov':
+            return offset, size
+        offset += size
+    return None
+
+def locate_document_moov(client, client_loop, document, timeout=None, viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Leer el primer chunk de un documento y localizar su moov saltando de caja en caja"""
+    size = document.size or 0
+    if size < 8:
+        return None
+    head = read_document_range(client, client_loop, document, document.id, 0, min(size, VIDEO_CHUNK_SIZE) - 1, timeout=timeout,
+                               viewer=viewer, priority=priority)
+
+    def read_at(offset, length):
+        return read_document_range(client, client_loop, document, document.id, offset, offset + length - 1, timeout=timeout,
+                                   viewer=viewer, priority=priority)
+
+    return locate_mp4_moov(head, size, read_at)
+
+def prepare_document_moov(client, client_loop, document, video_id, timeout=None, viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Localizar el moov (una vez por video), guardarlo en los metadatos y fijar sus chunks en memoria"""
+    metadata = video_metadata_cache.get(video_id)
+    if metadata is not None and 'moov_offset' in metadata:
+        return
+    location = locate_document_moov(client, client_loop, document, timeout=timeout, viewer=viewer, priority=priority)
+    if location is None:
+        video_metadata_cache.update_fields(video_id, moov_offset=None, moov_size=None)
+        return
+    moov_offset, moov_size = location
+    offsets = aligned_chunk_offsets(moov_offset, min(moov_offset + moov_size, document.size) - 1)
+    pinned = video_memory_cache.pin(document.id, offsets)
+    missing = [offset for offset in offsets if get_cached_chunk(document.id, offset) is None]
+    if missing:
+        fetch_chunks_coalesced(client, client_loop, document, document.id, missing, timeout=timeout, viewer=viewer, priority=priority)
+    video_metadata_cache.update_fields(video_id, moov_offset=moov_offset, moov_size=moov_size)
+    position = 'inicio' if moov_offset < VIDEO_CHUNK_SIZE else 'final'
+    print(f"🎞️ moov de {video_id} en offset {moov_offset} ({moov_size} bytes, al {position}){' fijado en caché' if pinned else ''}", flush=True)
+
+# ==================== FASTSTART EN LA SUBIDA ====================
+# Antes de subir un MP4 a Telegram se mueve el moov delante del mdat (como `qt-faststart`)
+# para que cualquier video guardado pueda empezar a reproducirse con el primer Range.
+# Se copia el archivo caja a caja en streaming; solo el moov se carga en memoria.
+
+UPLOAD_FASTSTART_ENABLED = os.getenv('UPLOAD_FASTSTART', 'true').lower() == 'true'
+UPLOAD_FASTSTART_MAX_MOOV_BYTES = 64 * 1024 * 1024  # Un moov mayor no se reubica
+
+_MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+def _scan_mp4_boxes(f, file_size):
+    """Lista de (offset, tamaño, tipo) de las cajas de primer nivel; None si no parece un MP4"""
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        box = _read_box_header(f.read(16), 0)
+        if box is None:
+            return None
+        size, box_type, header_size = box
+        if not all(32 <= c < 127 for c in box_type):
+            return None
+        if size == 0:
+            size = file_size - offset
+        if size < header_size or offset + size > file_size:
+            return None
+        boxes.append((offset, size, box_type))
+        offset += size
+    return boxes
+
+def _patch_chunk_offsets(buffer, start, end, relocate):
+    """Reescribir en el moov (bytearray) las tablas stco/co64 con relocate(offset_original)"""
+    pos = start
+    while pos + 8 <= end:
+        box = _read_box_header(buffer, pos)
+        if box is None:
+            raise ValueError(f"Caja MP4 truncada en el offset {pos} del moov")
+        size, box_type, header_size = box
+        if size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise ValueError(f"Caja MP4 corrupta en el offset {pos} del moov")
+        body = pos + header_size
+        if box_type in _MP4_CONTAINER_BOXES:
+            _patch_chunk_offsets(buffer, body, pos + size, relocate)
+        elif box_type in (b'stco', b'co64'):
+            entry_format, entry_size, entry_max = ('>I', 4, 0xFFFFFFFF) if box_type == b'stco' else ('>Q', 8, 0xFFFFFFFFFFFFFFFF)
+            count = struct.unpack_from('>I', buffer, body + 4)[0]
+            if body + 8 + count * entry_size > pos + size:
+                raise ValueError(f"Tabla {box_type.decode()} con más entradas que bytes")
+            for i in range(count):
+                entry_pos = body + 8 + i * entry_size
+                new_offset = relocate(struct.unpack_from(entry_format, buffer, entry_pos)[0])
+                if new_offset > entry_max:
+                    raise OverflowError(f"El offset {new_offset} no cabe en {box_type.decode()}")
+                struct.pack_into(entry_format, buffer, entry_pos, new_offset)
+        pos += size
+
+def mp4_faststart(path):
+    """Mover el moov de un MP4 delante del mdat reescribiendo los offsets de los chunks.
+
+    Devuelve True si el archivo se reescribió y False si no hacía falta o no se puede
+    (no es MP4, ya es faststart, MP4 fragmentado, moov demasiado grande...).
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as src:
+        boxes = _scan_mp4_boxes(src, file_size)
+        if not boxes:
+            return False
+        types = [box_type for _, _, box_type in boxes]
+        if b'moov' not in types or b'mdat' not in types or b'moof' in types:
+            return False
+        moov_index = types.index(b'moov')
+        mdat_index = types.index(b'mdat')
+        if moov_index < mdat_index:
+            return False  # Ya es faststart
+        moov_offset, moov_size, _ = boxes[moov_index]
+        if moov_size > UPLOAD_FASTSTART_MAX_MOOV_BYTES:
+            print(f"⚠️ moov de {moov_size} bytes demasiado grande para faststart, se sube sin cambios", flush=True)
+            return False
+
+        # Nuevo orden: lo que había antes del primer mdat, el moov, y el resto
+        others = [box for i, box in enumerate(boxes) if i != moov_index]
+        new_order = others[:mdat_index] + [boxes[moov_index]] + others[mdat_index:]
+        new_starts = {}
+        position = 0
+        for offset, size, _ in new_order:
+            new_starts[offset] = position
+            position += size
+        original_starts = [offset for offset, _, _ in others]
+
+        def relocate(offset):
+            i = bisect.bisect_right(original_starts, offset) - 1
+            if i < 0:
+                raise ValueError(f"Offset de chunk {offset} fuera de las cajas del archivo")
+            box_offset, box_size, _ = others[i]
+            if offset >= box_offset + box_size:
+                raise ValueError(f"Offset de chunk {offset} fuera de las cajas del archivo")
+            return new_starts[box_offset] + (offset - box_offset)
+
+        src.seek(moov_offset)
+        moov = bytearray(src.read(moov_size))
+        _, _, moov_header_size = _read_box_header(moov, 0)
+        _patch_chunk_offsets(moov, moov_header_size, len(moov), relocate)
+
+        output_path = f"{path}.faststart"
+        try:
+            with open(output_path, 'wb') as dst:
+                for offset, size, box_type in new_order:
+                    if offset == moov_offset:
+                        dst.write(moov)
+                        continue
+                    src.seek(offset)
+                    remaining = size
+                    while remaining > 0:
+                        data = src.read(min(remaining, VIDEO_CHUNK_SIZE))
+                        if not data:
+                            raise IOError(f"Fin de archivo inesperado copiando la caja {box_type.decode()}")
+                        dst.write(data)
+                        remaining -= len(data)
+        except BaseException:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+    os.replace(output_path, path)
+    print(f"🎞️ Faststart aplicado: moov ({moov_size} bytes) movido al inicio de {path}", flush=True)
+    return True
+
+def mp4_head_needs_faststart(head):
+    """True si los primeros bytes de un archivo son de un MP4 con el mdat antes que el moov.
+    False si ya es faststart, no es MP4 o head no llega a la caja que lo decide."""
+    offset = 0
+    while True:
+        box = _read_box_header(head, offset)
+        if box is None:
+            return False
+        size, box_type, header_size = box
+        if not all(32 <= c < 127 for c in box_type):
+            return False
+        if box_type == b'mdat':
+            return True
+        if box_type == b'moov' or size < header_size:
+            return False
+        offset += size
+
+async def refresh_video_document(client, video_id, chat_id, message_id):
+    """Volver a obtener el mensaje de un video para renovar su file_reference.
+    Actualiza la caché de metadatos y devuelve el Document nuevo (o None)."""
+    target_chat = int(chat_id) if chat_id != 'me' and str(chat_id).lstrip('-').isdigit() else 'me'
+    if isinstance(target_chat, int):
+        try:
+            target_chat = await client.get_entity(target_chat)
+        except Exception as entity_error:
+            print(f"⚠️ No se pudo obtener entidad para {chat_id} al refrescar file_reference: {entity_error}")
+    message = await client.get_messages(target_chat, ids=message_id)
+    if not message or not message.media or not hasattr(message.media, 'document'):
+        video_metadata_cache.invalidate(video_id)
+        return None
+    document = message.media.document
+    video_metadata_cache.update_document(video_id, document)
+    print(f"✅ file_reference renovado para video {video_id}", flush=True)
+    return document
+
+def resolve_video_document(client, video_id):
+    """Obtener (Document, metadatos) de un video usando la caché de metadatos o, si no está,
+    la base de datos y Telegram. Devuelve (None, None) si el video no existe."""
+    metadata = video_metadata_cache.get(video_id)
+    if metadata:
+        return document_from_metadata(metadata), metadata
+    video_info = get_video_from_db(video_id)
+    if not video_info:
+        return None, None
+    chat_id = video_info.get('chat_id', 'me')
+    message_id = video_info['message_id']
+    document = run_async(refresh_video_document(client, video_id, chat_id, message_id), client._loop, timeout=30)
+    if document is None:
+        return None, None
+    metadata = {
+        **document_metadata(document),
+        'mime_type': document.mime_type or 'video/mp4',
+        'chat_id': chat_id,
+        'message_id': message_id,
+    }
+    video_metadata_cache.put(video_id, metadata)
+    return document, metadata
+
+# ==================== MINIATURAS EN DISCO ====================
+# Las miniaturas de un documento de Telegram no cambian nunca: se descargan una vez, se
+# guardan en disco por id de documento y se sirven con caché inmutable. Se capturan al
+# registrar el video (subida o listado de un chat) para que /videos no espere a Telegram.
+
+THUMBNAIL_CACHE_DIR = os.getenv('THUMBNAIL_CACHE_DIR', 'thumbnail_cache')
+THUMBNAIL_VARIANTS = ('small', 'large')  # small = la menor de Telegram (~90-320px), large = la mayor
+THUMBNAIL_CAPTURE_TIMEOUT = 30
+
+class ThumbnailDiskCache:
+    """Miniaturas en <cache_dir>/<doc_id>/<variante>.jpg y el índice video_id -> doc_id.
+
+    El índice (<cache_dir>/videos/<video_id>, con "doc_id tamaño") permite servir la miniatura
+    de un video, o el ETag de un HEAD, sin resolver su documento en Telegram. Una variante que el documento no tiene se marca con
+    un archivo .none para no volver a pedirla.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'videos'), exist_ok=True)
+
+    def _path(self, doc_id, variant, suffix='.jpg'):
+        return os.path.join(self.cache_dir, str(doc_id), f'{variant}{suffix}')
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, doc_id, variant):
+        try:
+            with open(self._path(doc_id, variant), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def known(self, doc_id, variant):
+        """True si la variante ya está en disco o se sabe que el documento no la tiene"""
+        return os.path.exists(self._path(doc_id, variant)) or os.path.exists(self._path(doc_id, variant, '.none'))
+
+    def put(self, doc_id, variant, data):
+        if data:
+            self._write(self._path(doc_id, variant), data)
+        else:
+            self._write(self._path(doc_id, variant, '.none'), b'')
+
+    def link_video(self, video_id, doc_id, size=None):
+        path = os.path.join(self.cache_dir, 'videos', secure_filename(video_id))
+        if self.linked_document(video_id) != (doc_id, size):
+            self._write(path, (f'{doc_id} {size}' if size else str(doc_id)).encode())
+
+    def linked_document(self, video_id):
+        """(doc_id, tamaño) del documento enlazado al video; (None, None) si no se conoce.
+        Los índices antiguos solo tienen doc_id y dan tamaño None."""
+        try:
+            with open(os.path.join(self.cache_dir, 'videos', secure_filename(video_id)), 'rb') as f:
+                fields = f.read().split()
+            return (int(fields[0]) or None, int(fields[1]) if len(fields) > 1 else None) if fields else (None, None)
+        except (OSError, ValueError):
+            return None, None
+
+    def document_for_video(self, video_id):
+        return self.linked_document(video_id)[0]
+
+thumbnail_cache = ThumbnailDiskCache(THUMBNAIL_CACHE_DIR)
+
+def document_thumbnail_sizes(document):
+    """Miniaturas reales (con ancho y alto) de un documento, de menor a mayor"""
+    sizes = [t for t in (getattr(document, 'thumbs', None) or []) if isinstance(t, (PhotoSize, PhotoCachedSize, PhotoSizeProgressive))]
+    return sorted(sizes, key=lambda t: t.w * t.h)
+
+async def capture_document_thumbnails(client, document, variants=THUMBNAIL_VARIANTS):
+    """Descargar y guardar en disco las variantes de miniatura que falten. Devuelve {variante: bytes o None}."""
+    sizes = document_thumbnail_sizes(document)
+    wanted = {'small': sizes[0] if sizes else None, 'large': sizes[-1] if sizes else None}
+    results = {}
+    downloaded = {}  # tipo de PhotoSize -> bytes (small y large pueden ser la misma)
+    for variant in variants:
+        if thumbnail_cache.known(document.id, variant):
+            results[variant] = thumbnail_cache.get(document.id, variant)
+            continue
+        thumb = wanted.get(variant)
+        data = None
+        if thumb is not None:
+            if thumb.type not in downloaded:
+                downloaded[thumb.type] = await client.download_media(document, file=bytes, thumb=thumb)
+            data = downloaded[thumb.type]
+        thumbnail_cache.put(document.id, variant, data)
+        results[variant] = data
+    return results
+
+def document_stripped_preview(document):
+    """Vista previa instantánea: la miniatura "stripped" (~1KB) que viene dentro del propio
+    documento, reconstruida como JPEG en local sin descargar nada. Devuelve un data URI o None."""
+    for thumb in getattr(document, 'thumbs', None) or []:
+        if isinstance(thumb, PhotoStrippedSize) and thumb.bytes:
+            try:
+                return f"data:image/jpeg;base64,{base64.b64encode(stripped_photo_to_jpg(thumb.bytes)).decode('ascii')}"
+            except Exception:
+                return None
+    return None
+
+class ThumbnailCaptureQueue:
+    """Un worker que captura en segundo plano las miniaturas de los videos recién registrados"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = set()  # doc_ids en cola
+        self._thread = None
+        self.captured = 0
+
+    def submit(self, phone, video_id, document):
+        """Encolar la captura si falta alguna variante. Devuelve False si no hay nada que hacer."""
+        if document is None:
+            return False
+        thumbnail_cache.link_video(video_id, document.id, document.size)
+        if all(thumbnail_cache.known(document.id, variant) for variant in THUMBNAIL_VARIANTS):
+            return False
+        with self._lock:
+            if document.id in self._pending:
+                return False
+            self._pending.add(document.id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name='thumbnail-capture', daemon=True)
+                self._thread.start()
+        self._queue.put((phone, video_id, document))
+        return True
+
+    def _worker(self):
+        while True:
+            phone, video_id, document = self._queue.get()
+            try:
+                client, client_loop = get_background_client(phone)
+                if client is None:
+                    print(f"⚠️ Miniatura del video {video_id} omitida: cliente de {phone} no disponible", flush=True)
+                else:
+                    run_async(capture_document_thumbnails(client, document), client_loop, timeout=THUMBNAIL_CAPTURE_TIMEOUT)
+                    self.captured += 1
+            except Exception as e:
+                print(f"⚠️ Error capturando miniatura del video {video_id}: {type(e).__name__}: {e}", flush=True)
+            finally:
+                with self._lock:
+                    self._pending.discard(document.id)
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'captured': self.captured}
+
+thumbnail_capture_queue = ThumbnailCaptureQueue()
+
+def thumbnail_response(data, doc_id, variant):
+    """Miniatura con caché inmutable: el mismo documento de Telegram siempre tiene la misma miniatura"""
+    etag = f'"thumb-{doc_id}-{variant}"'
+    headers = {
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'ETag': etag,
+        'Access-Control-Allow-Origin': '*',
+    }
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(None, 304, headers)
+    return Response(data, 200, headers, mimetype='image/jpeg')
+
+# ==================== SUBIDA EN STREAMING A TELEGRAM ====================
+# /api/upload/stream lee el multipart del request a medida que llega y envía partes de 512KB
+# directamente con SaveBigFilePartRequest, sin archivo temporal: el video no se escribe en disco
+# salvo que Telegram vaya más lento que el cliente y se llene el buffer en memoria.
+
+UPLOAD_PART_SIZE = 512 * 1024  # Tamaño de parte de Telegram (todas iguales salvo la última)
+UPLOAD_BIG_FILE_THRESHOLD = 10 * 1024 * 1024  # Desde aquí Telegram exige SaveBigFilePartRequest
+UPLOAD_STREAM_MEMORY_BYTES = int(os.getenv('UPLOAD_STREAM_MEMORY_BYTES', 64 * 1024 * 1024))  # Partes en memoria antes de volcar a disco
+UPLOAD_PART_TIMEOUT = 60  # Segundos por parte
+UPLOAD_PART_RETRIES = 3
+# Subida paralela: conexiones extra al DC de la cuenta y SaveBigFilePartRequest en vuelo por conexión
+UPLOAD_PARALLEL_SENDERS = int(os.getenv('UPLOAD_PARALLEL_SENDERS', 4))
+UPLOAD_PARALLEL_REQUESTS_PER_SENDER = int(os.getenv('UPLOAD_PARALLEL_REQUESTS_PER_SENDER', 2))
+UPLOAD_STREAM_WORKERS = max(1, UPLOAD_PARALLEL_SENDERS * UPLOAD_PARALLEL_REQUESTS_PER_SENDER)  # Partes en vuelo hacia Telegram
+
+async def send_upload_part(client, part_request, slot=None):
+    """Enviar una parte por la conexión `slot` del pool de subida, o por la principal si
+    slot es None o no hay pool. Devuelve la respuesta de Telegram (True si la aceptó)."""
+    if slot is not None and UPLOAD_PARALLEL_SENDERS > 1:
+        pool = get_upload_sender_pool(client)
+        senders = await pool.get_senders()
+        if senders:
+            sender = senders[slot % len(senders)]
+            try:
+                return await sender.send(part_request)
+            except Exception:
+                if not sender.is_connected():
+                    await pool.discard(sender)
+                raise
+    return await client(part_request)
+
+async def upload_file_parallel(client, path, progress_callback=None):
+    """Subir un archivo local a Telegram con varias partes en vuelo y devolver el InputFile.
+
+    Sustituye a la subida secuencial de send_file: las partes de archivos grandes se reparten
+    entre las conexiones del pool de subida, cada parte se reintenta por separado (el último
+    intento por la conexión principal) y el progreso cuenta solo partes confirmadas, con el
+    mismo contrato progress_callback(enviados, total) de Telethon.
+    """
+    file_size = os.path.getsize(path)
+    if file_size <= UPLOAD_BIG_FILE_THRESHOLD or UPLOAD_PARALLEL_SENDERS <= 1:
+        return await client.upload_file(path, progress_callback=progress_callback)
+
+    # Partes más grandes cuanto mayor el archivo (Telegram limita el número de partes)
+    part_size = get_appropriated_part_size(file_size) * 1024
+    total_parts = math.ceil(file_size / part_size)
+    file_id = generate_random_long()
+    loop = asyncio.get_running_loop()
+    next_part = iter(range(total_parts))
+    uploaded = 0
+    started = time.time()
+    print(f"🚀 [UPLOAD-PARALLEL] {file_size / (1024*1024):.1f}MB en {total_parts} partes de {part_size // 1024}KB con {UPLOAD_STREAM_WORKERS} en vuelo", flush=True)
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        async def worker(slot):
+            nonlocal uploaded
+            for index in next_part:
+                data = await loop.run_in_executor(None, os.pread, fd, part_size, index * part_size)
+                part_request = SaveBigFilePartRequest(file_id, index, total_parts, data)
+                for attempt in range(1, UPLOAD_PART_RETRIES + 1):
+                    try:
+                        if await send_upload_part(client, part_request, slot if attempt < UPLOAD_PART_RETRIES else None):
+                            break
+                        raise Exception(f"Telegram rechazó la parte {index}")
+                    except Exception as e:
+                        if attempt == UPLOAD_PART_RETRIES:
+                            raise
+                        print(f"⚠️ [UPLOAD-PARALLEL] Reintentando parte {index} ({attempt}/{UPLOAD_PART_RETRIES}): {type(e).__name__}: {e}", flush=True)
+                        await asyncio.sleep(attempt)
+                uploaded += len(data)
+                if progress_callback:
+                    result = progress_callback(uploaded, file_size)
+                    if asyncio.iscoroutine(result):
+                        await result
+
+        workers = [asyncio.ensure_future(worker(slot)) for slot in range(UPLOAD_STREAM_WORKERS)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # Una parte que agotó sus reintentos (o una cancelación) detiene al resto antes de cerrar fd
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+    finally:
+        os.close(fd)
+
+    elapsed = time.time() - started
+    print(f"✅ [UPLOAD-PARALLEL] {total_parts} partes subidas en {elapsed:.1f}s ({file_size / (1024*1024) / max(elapsed, 0.001):.1f}MB/s)", flush=True)
+    return InputFileBig(file_id, total_parts, os.path.basename(path))
+
+class UploadPartBuffer:
+    """Partes pendientes entre el thread que lee el request y los que suben a Telegram.
+
+    Hasta max_memory bytes se guardan en memoria; el resto se vuelca a un archivo temporal
+    (se crea solo si hace falta). Telegram acepta las partes en cualquier orden, así que los
+    uploaders siempre toman primero las que están en memoria.
+    """
+
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self._cond = threading.Condition()
+        self._memory = []  # [(índice, bytes)]
+        self._memory_bytes = 0
+        self._spooled = []  # [(índice, offset en el archivo, longitud)]
+        self._spool_file = None
+        self._spool_end = 0
+        self._closed = False
+        self.error = None
+        self.spooled_bytes = 0
+
+    def put(self, index, data):
+        if self.error is not None:
+            raise self.error
+        with self._cond:
+            if self._memory_bytes + len(data) <= self.max_memory:
+                self._memory.append((index, data))
+                self._memory_bytes += len(data)
+                self._cond.notify()
+                return
+            if self._spool_file is None:
+                self._spool_file = tempfile.TemporaryFile(prefix='upload_spool_')
+                print(f"💾 [UPLOAD-STREAM] Telegram va más lento que el cliente, volcando partes a disco", flush=True)
+            offset = self._spool_end
+            self._spool_end += len(data)
+            # Escribir dentro del lock: la parte no se anuncia hasta que está en disco
+            os.pwrite(self._spool_file.fileno(), data, offset)
+            self._spooled.append((index, offset, len(data)))
+            self.spooled_bytes += len(data)
+            self._cond.notify()
+
+    def get(self):
+        """Siguiente parte (índice, bytes), o None cuando el buffer está cerrado y vacío (o abortado)"""
+        with self._cond:
+            while not self._memory and not self._spooled and not self._closed and self.error is None:
+                self._cond.wait()
+            if self.error is not None:
+                return None
+            if self._memory:
+                index, data = self._memory.pop(0)
+                self._memory_bytes -= len(data)
+                return index, data
+            if not self._spooled:
+                return None
+            index, offset, length = self._spooled.pop(0)
+            return index, os.pread(self._spool_file.fileno(), length, offset)
+
+    def close(self):
+        """El productor terminó: los uploaders salen al vaciar el buffer"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self, error):
+        with self._cond:
+            if self.error is None:
+                self.error = error
+            self._cond.notify_all()
+
+    def release(self):
+        if self._spool_file is not None:
+            self._spool_file.close()
+
+class TelegramPartUploader:
+    """Sube a Telegram las partes de un UploadPartBuffer con `workers` threads y construye el InputFile"""
+
+    def __init__(self, client, buffer, file_size, filename, workers=UPLOAD_STREAM_WORKERS, progress=None, file_id=None):
+        self.client = client
+        self.buffer = buffer
+        self.file_size = file_size
+        self.filename = filename
+        self.file_id = file_id or generate_random_long()  # Una subida reanudable reutiliza el suyo
+        self.is_big = file_size > UPLOAD_BIG_FILE_THRESHOLD
+        self.total_parts = max(1, math.ceil(file_size / UPLOAD_PART_SIZE))
+        self.progress = progress  # callback(bytes subidos, total)
+        self.uploaded_parts = 0
+        self.uploaded_bytes = 0
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._worker, args=(i,), name=f'upload-part-{i}', daemon=True) for i in range(max(1, workers))]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def join(self, timeout=None, expected_parts=None):
+        """Esperar a que se suban todas las partes (o expected_parts si el buffer solo lleva
+        un tramo del archivo); relanza el error de la primera que falló"""
+        deadline = time.time() + timeout if timeout else None
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+        if any(thread.is_alive() for thread in self._threads):
+            raise asyncio.TimeoutError("Timeout esperando a que terminen de subirse las partes")
+        if self.buffer.error is not None:
+            raise self.buffer.error
+        expected_parts = self.total_parts if expected_parts is None else expected_parts
+        if self.uploaded_parts != expected_parts:
+            raise Exception(f"Se subieron {self.uploaded_parts} de {expected_parts} partes")
+
+    def _save_part(self, index, data, slot):
+        if self.is_big:
+            part_request = SaveBigFilePartRequest(self.file_id, index, self.total_parts, data)
+        else:
+            part_request = SaveFilePartRequest(self.file_id, index, data)
+        for attempt in range(1, UPLOAD_PART_RETRIES + 1):
+            try:
+                # El último intento va por la conexión principal por si falla la del pool
+                connection = slot if attempt < UPLOAD_PART_RETRIES else None
+                if run_async(send_upload_part(self.client, part_request, connection), self.client._loop, timeout=UPLOAD_PART_TIMEOUT):
+                    return
+                raise Exception(f"Telegram rechazó la parte {index}")
+            except Exception as e:
+                if attempt == UPLOAD_PART_RETRIES:
+                    raise
+                print(f"⚠️ [UPLOAD-STREAM] Reintentando parte {index} ({attempt}/{UPLOAD_PART_RETRIES}): {type(e).__name__}: {e}", flush=True)
+                time.sleep(attempt)
+
+    def _worker(self, slot):
+        while True:
+            part = self.buffer.get()
+            if part is None:
+                return
+            index, data = part
+            try:
+                self._save_part(index, data, slot)
+            except Exception as e:
+                self.buffer.abort(e)
+                return
+            with self._lock:
+                self.uploaded_parts += 1
+                self.uploaded_bytes += len(data)
+                uploaded = self.uploaded_bytes
+            if self.progress:
+                self.progress(uploaded, self.file_size)
+
+    def input_file(self, md5_checksum=''):
+        if self.is_big:
+            return InputFileBig(self.file_id, self.total_parts, self.filename)
+        return InputFile(self.file_id, self.total_parts, self.filename, md5_checksum)
+
+def iter_multipart_events(stream, boundary, read_size=UPLOAD_PART_SIZE):
+    """Eventos (Field, File, Data) de un cuerpo multipart leído del stream poco a poco"""
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=1024 * 1024)
+    finished_input = False
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            if finished_input:
+                raise ValueError("El cuerpo multipart terminó antes de tiempo")
+            chunk = stream.read(read_size)
+            finished_input = not chunk
+            decoder.receive_data(chunk or None)
+            continue
+        if isinstance(event, Epilogue):
+            return
+        yield event
+
+# ==================== SUBIDAS REANUDABLES ====================
+# Protocolo al estilo tus para /api/upload/resumable: el navegador crea la subida, envía el
+# archivo en tramos con PATCH + Upload-Offset y, si se corta la conexión, pregunta con HEAD
+# por dónde seguir. Cada tramo se reenvía a Telegram como partes de 512KB con el mismo
+# file_id; Telegram guarda las partes ya subidas, así que el servidor solo conserva el estado
+# (y el resto de menos de una parte) en un JSON por subida que sobrevive a un reinicio.
+
+UPLOAD_RESUMABLE_DIR = os.getenv('UPLOAD_RESUMABLE_DIR', 'upload_sessions')
+UPLOAD_RESUMABLE_EXPIRE_HOURS = float(os.getenv('UPLOAD_RESUMABLE_EXPIRE_HOURS', 24))  # Telegram no guarda las partes para siempre
+UPLOAD_RESUMABLE_MAX_SIZE = 4 * 1024 * 1024 * 1024  # Límite de Telegram por archivo (cuentas premium)
+TUS_VERSION = '1.0.0'
+
+class ResumableUploadStore:
+    """Estado de las subidas reanudables en <upload_dir>/<upload_id>.json.
+
+    El estado guarda cuántas partes completas confirmó Telegram (parts_sent) y los bytes
+    recibidos que aún no llenan una parte (tail, en base64), de modo que
+    offset = parts_sent * UPLOAD_PART_SIZE + len(tail). Se reescribe de forma atómica al
+    final de cada PATCH: si el proceso muere a mitad de un tramo, el cliente vuelve a
+    enviarlo desde el último offset guardado (reenviar una parte a Telegram es inocuo).
+
+    Los MP4 con el moov al final (se ve en el primer tramo) no se reenvían por partes: se
+    guardan en <upload_id>.data (spool, offset = spooled) y al completarse upload_queue les
+    aplica faststart y los sube enteros, como /api/upload.
+
+    PATCH y DELETE trabajan con locked(): un lock del proceso más un flock sobre
+    <upload_id>.lock, para que también se excluyan entre varios workers de gunicorn.
+    """
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        self._hashers = {}  # upload_id -> (sha256, bytes ya hasheados)
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def _path(self, upload_id):
+        return os.path.join(self.upload_dir, f'{upload_id}.json')
+
+    def create(self, phone, filename, size, chat_id='me', description=''):
+        state = {
+            'upload_id': secrets.token_urlsafe(16),
+            'phone': phone,
+            'filename': filename,
+            'size': size,
+            'chat_id': chat_id,
+            'description': description,
+            'file_id': generate_random_long(),
+            'is_big': size > UPLOAD_BIG_FILE_THRESHOLD,
+            'total_parts': max(1, math.ceil(size / UPLOAD_PART_SIZE)),
+            'parts_sent': 0,
+            'tail': '',
+            'spool': False,
+            'spooled': 0,
+            'status': 'uploading',
+            'video_id': None,
+            'created': time.time(),
+            'expires': time.time() + UPLOAD_RESUMABLE_EXPIRE_HOURS * 3600,
+        }
+        self.save(state)
+        return state
+
+    def load(self, upload_id):
+        """Estado de la subida, o None si no existe o caducó (y entonces se borra)"""
+        if not upload_id or secure_filename(upload_id) != upload_id:
+            return None
+        try:
+            with open(self._path(upload_id), 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state['status'] != 'completed' and state['expires'] < time.time():
+            self.delete(upload_id)
+            return None
+        return state
+
+    def save(self, state):
+        path = self._path(state['upload_id'])
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def data_path(self, upload_id):
+        return os.path.join(self.upload_dir, f'{upload_id}.data')
+
+    def delete(self, upload_id):
+        data_path = self.data_path(upload_id)
+        for path in (self._path(upload_id), self._lock_path(upload_id), data_path, f'{data_path}.faststart'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+            self._hashers.pop(upload_id, None)
+
+    def take_hasher(self, upload_id, offset):
+        """SHA-256 de los primeros `offset` bytes para deduplicar, o None si se perdió.
+
+        El estado de hashlib no se puede guardar en el JSON, así que vive solo en memoria: tras
+        un reinicio o un tramo fallido la subida sigue, pero sin hash. Se saca del store y hay
+        que devolverlo con keep_hasher cuando el offset quede guardado.
+        """
+        with self._lock:
+            hasher, hashed = self._hashers.pop(upload_id, (None, 0))
+        if offset == 0:
+            return hashlib.sha256()
+        return hasher if hashed == offset else None
+
+    def keep_hasher(self, upload_id, hasher, offset):
+        if hasher is not None:
+            with self._lock:
+                self._hashers[upload_id] = (hasher, offset)
+
+    def _lock_path(self, upload_id):
+        return os.path.join(self.upload_dir, f'{upload_id}.lock')
+
+    @contextmanager
+    def locked(self, upload_id, timeout):
+        """Exclusión sobre una subida (dos PATCH a la vez, o un DELETE durante un PATCH, no
+        tienen sentido). Da True si se consiguió en timeout segundos, False si no.
+
+        Quien lo consigue debe releer el estado: si la subida se borró mientras esperaba,
+        load() da None. El archivo .lock se borra con la subida; un flock sobre el inodo
+        ya borrado sigue excluyendo a los que lo abrieron antes, y esos releen el estado.
+        """
+        with self._lock:
+            thread_lock = self._upload_locks.setdefault(upload_id, threading.Lock())
+        deadline = time.time() + timeout
+        if not thread_lock.acquire(timeout=timeout):
+            yield False
+            return
+        lock_file = None
+        try:
+            if fcntl is not None:
+                lock_file = open(self._lock_path(upload_id), 'a')
+                while True:
+                    try:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.time() >= deadline:
+                            yield False
+                            return
+                        time.sleep(0.05)
+            yield True
+        finally:
+            if lock_file is not None:
+                lock_file.close()  # Cerrar el descriptor libera el flock
+            thread_lock.release()
+
+    def cleanup_expired(self):
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.upload_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.upload_dir, name), 'r') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if state['expires'] < now:
+                self.delete(state['upload_id'])
+                removed += 1
+        if removed:
+            print(f"🧹 [UPLOAD-RESUMABLE] {removed} subidas reanudables caducadas eliminadas", flush=True)
+
+def resumable_upload_offset(state):
+    if state.get('spool'):
+        return state['spooled']
+    # La última parte puede ser más corta que UPLOAD_PART_SIZE
+    return min(state['size'], state['parts_sent'] * UPLOAD_PART_SIZE + len(base64.b64decode(state['tail'])))
+
+def resumable_upload_timeout(size):
+    # Como /api/upload: 6 segundos por MB, mínimo 10 minutos
+    return max(600, int(size / (1024 * 1024) * 6))
+
+def resumable_processing_stale(state):
+    """Una subida 'processing' cuyo trabajo ya debería haber terminado (el proceso que la
+    subía se reinició): se puede volver a encolar"""
+    return state['status'] == 'processing' and time.time() > state.get('processing_started', 0) + resumable_upload_timeout(state['size']) + 120
+
+def parse_tus_metadata(header):
+    """Upload-Metadata de tus: 'clave valor_base64, clave2 valor2_base64'"""
+    metadata = {}
+    for item in (header or '').split(','):
+        key, _, value = item.strip().partition(' ')
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(value).decode('utf-8') if value else ''
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError(f"Upload-Metadata inválido en la clave '{key}'")
+    return metadata
+
+resumable_uploads = ResumableUploadStore(UPLOAD_RESUMABLE_DIR)
+
+# ==================== COLA DE SUBIDAS POR CUENTA ====================
+# /api/upload recibe el archivo en un thread y la subida a Telegram (faststart + partes) pasa
+# por esta cola, igual que las reanudables guardadas en disco para aplicarles faststart: cada
+# cuenta sube como mucho UPLOAD_CONCURRENCY_PER_ACCOUNT videos a la vez y el resto espera en
+# orden de prioridad (o de llegada). Así varias subidas grandes no se reparten el loop del
+# cliente y el disco hasta hacerse lentas todas a la vez.
+
+UPLOAD_CONCURRENCY_PER_ACCOUNT = int(os.getenv('UPLOAD_CONCURRENCY_PER_ACCOUNT', 1))
+UPLOAD_QUEUE_ORDER = os.getenv('UPLOAD_QUEUE_ORDER', 'priority').lower()  # 'priority' o 'fifo'
+UPLOAD_PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+class UploadCancelledError(Exception):
+    """La subida se canceló desde /api/upload/<upload_id>/cancel"""
+
+class UploadSlotTimeoutError(Exception):
+    """La cuenta no tuvo un hueco libre para subir a tiempo (ver UploadQueue.slot)"""
+
+class UploadJob:
+    def __init__(self, upload_id, phone, priority, run, on_cancel=None):
+        self.upload_id = upload_id
+        self.phone = phone
+        self.priority = priority
+        self.run = run  # Callable sin argumentos que hace la subida
+        self.on_cancel = on_cancel  # Limpieza si se cancela antes de empezar
+        self.cancelled = False
+
+class UploadQueue:
+    """Subidas pendientes y en curso por cuenta (phone), con límite de concurrencia.
+
+    Cada trabajo corre en su propio thread cuando la cuenta tiene un hueco libre. Los
+    cancelados en cola no llegan a ejecutarse; los que ya están subiendo se detienen en el
+    siguiente aviso de progreso (ver check_cancelled). Las subidas que envían las partes
+    desde el thread del request (streaming y reanudables) ocupan un hueco con slot().
+    """
+
+    def __init__(self, concurrency, order='priority'):
+        self.concurrency = max(1, concurrency)
+        self.order = order
+        self._lock = threading.Lock()
+        self._pending = {}  # phone -> heap [(prioridad, secuencia, job)]
+        self._running = {}  # phone -> {upload_id: job}
+        self._jobs = {}  # upload_id -> job (en cola o en curso)
+        self._cancelled_early = set()  # Cancelados mientras aún se recibía el archivo
+        self._seq = 0
+
+    def submit(self, job):
+        with self._lock:
+            if job.upload_id in self._cancelled_early:
+                self._cancelled_early.discard(job.upload_id)
+                cancelled = True
+            else:
+                cancelled = False
+                self._seq += 1
+                priority = job.priority if self.order == 'priority' else 0
+                heapq.heappush(self._pending.setdefault(job.phone, []), (priority, self._seq, job))
+                self._jobs[job.upload_id] = job
+        if cancelled:
+            self._finish_cancelled(job)
+            return
+        self._dispatch(job.phone)
+
+    def _dispatch(self, phone):
+        started = []
+        with self._lock:
+            pending = self._pending.get(phone, [])
+            running = self._running.setdefault(phone, {})
+            while pending and len(running) < self.concurrency:
+                _, _, job = heapq.heappop(pending)
+                running[job.upload_id] = job
+                started.append(job)
+            if not pending:
+                self._pending.pop(phone, None)
+        for job in started:
+            threading.Thread(target=self._run, args=(job,), name=f'upload-{job.upload_id}', daemon=True).start()
+
+    def _run(self, job):
+        try:
+            print(f"▶️ [UPLOAD-QUEUE] Iniciando subida {job.upload_id} de {job.phone}", flush=True)
+            job.run()
+        except Exception as e:
+            print(f"❌ [UPLOAD-QUEUE] La subida {job.upload_id} terminó con error: {type(e).__name__}: {e}", flush=True)
+        finally:
+            with self._lock:
+                running = self._running.get(job.phone, {})
+                if running.get(job.upload_id) is job:
+                    del running[job.upload_id]
+                if self._jobs.get(job.upload_id) is job:
+                    del self._jobs[job.upload_id]
+            self._dispatch(job.phone)
+
+    def _finish_cancelled(self, job):
+        print(f"🚫 [UPLOAD-QUEUE] Subida {job.upload_id} cancelada antes de empezar", flush=True)
+        if job.on_cancel:
+            try:
+                job.on_cancel()
+            except Exception as e:
+                print(f"⚠️ [UPLOAD-QUEUE] Error limpiando la subida cancelada {job.upload_id}: {e}", flush=True)
+
+    @contextmanager
+    def slot(self, phone, upload_id, priority=UPLOAD_PRIORITIES['normal'], timeout=None):
+        """Ocupar un hueco de la cuenta mientras el thread del request sube partes a Telegram,
+        dentro del mismo límite y orden que los trabajos de la cola. Lanza UploadSlotTimeoutError
+        si no hay hueco en timeout segundos y UploadCancelledError si se cancela en cola."""
+        started = threading.Event()
+        finished = threading.Event()
+
+        def run():
+            started.set()
+            finished.wait()
+
+        job = UploadJob(upload_id, phone, priority, run, on_cancel=started.set)
+        self.submit(job)
+        try:
+            if not started.wait(timeout):
+                raise UploadSlotTimeoutError(f"Sin hueco para subir {upload_id} tras {timeout}s en cola")
+            if job.cancelled:
+                raise UploadCancelledError(f"Subida {upload_id} cancelada")
+            yield
+        finally:
+            finished.set()
+            if not started.is_set():
+                self._withdraw(job)
+
+    def _withdraw(self, job):
+        """Quitar de la cola un trabajo que aún no empezó"""
+        with self._lock:
+            pending = self._pending.get(job.phone, [])
+            queued = [item for item in pending if item[2] is job]
+            if queued:
+                pending.remove(queued[0])
+                heapq.heapify(pending)
+                if self._jobs.get(job.upload_id) is job:
+                    del self._jobs[job.upload_id]
+
+    def position(self, upload_id):
+        """1 = la siguiente en empezar, 0 = subiendo ya, None = no está en la cola"""
+        with self._lock:
+            job = self._jobs.get(upload_id)
+            if job is None:
+                return None
+            if upload_id in self._running.get(job.phone, {}):
+                return 0
+            order = sorted(self._pending.get(job.phone, []), key=lambda item: item[:2])
+            return 1 + [item[2].upload_id for item in order].index(upload_id)
+
+    def owner(self, upload_id):
+        with self._lock:
+            job = self._jobs.get(upload_id)
+            return job.phone if job else None
+
+    def cancel(self, upload_id):
+        """Cancelar una subida: la quita de la cola o marca la que está en curso para que pare.
+        Si aún no se encoló (se está recibiendo el archivo), se cancela al encolarla."""
+        with self._lock:
+            job = self._jobs.get(upload_id)
+            if job is None:
+                self._cancelled_early.add(upload_id)
+                return 'pending'
+            job.cancelled = True
+            pending = self._pending.get(job.phone, [])
+            queued = [item for item in pending if item[2] is job]
+            if queued:
+                pending.remove(queued[0])
+                heapq.heapify(pending)
+                self._jobs.pop(upload_id, None)
+        if queued:
+            self._finish_cancelled(job)
+            return 'cancelled'
+        print(f"🚫 [UPLOAD-QUEUE] Cancelando la subida en curso {upload_id}", flush=True)
+        return 'cancelling'
+
+    def check_cancelled(self, upload_id):
+        """Llamar desde el progreso de la subida: lanza UploadCancelledError si se canceló"""
+        with self._lock:
+            job = self._jobs.get(upload_id)
+            cancelled = job is not None and job.cancelled
+        if cancelled:
+            raise UploadCancelledError(f"Subida {upload_id} cancelada")
+
+    def stats(self):
+        with self._lock:
+            return {phone: {'running': len(self._running.get(phone, {})), 'queued': len(self._pending.get(phone, []))}
+                    for phone in set(self._running) | set(self._pending)}
+
+upload_queue = UploadQueue(UPLOAD_CONCURRENCY_PER_ACCOUNT, UPLOAD_QUEUE_ORDER)
+
+# ==================== DEDUPLICACIÓN DE SUBIDAS ====================
+# /api/upload calcula el SHA-256 del video mientras lo guarda. Si la cuenta ya subió ese
+# contenido, no se vuelve a enviar el archivo: se publica un mensaje nuevo (con la descripción
+# nueva) que reenvía el documento ya subido (InputDocument), con un solo SendMedia. Las subidas en
+# streaming y reanudables envían las partes según llegan, así que solo registran su hash.
+
+UPLOAD_DEDUP_ENABLED = os.getenv('UPLOAD_DEDUP', 'true').lower() not in ('0', 'false', 'no')
+UPLOAD_HASH_READ_SIZE = 1024 * 1024
+
+def save_upload_hashed(source, path):
+    """Copiar el stream de la subida a path calculando su SHA-256 por el camino"""
+    hasher = hashlib.sha256()
+    with open(path, 'wb') as f:
+        while True:
+            chunk = source.read(UPLOAD_HASH_READ_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            f.write(chunk)
+    return hasher.hexdigest()
+
+def telegram_chat(chat_id):
+    return int(chat_id) if chat_id != 'me' else 'me'
+
+async def resend_uploaded_document(client, chat_id, previous_uploads, caption):
+    """Publicar en chat_id, con caption, un contenido que la cuenta ya subió, reenviando su
+    documento (InputDocument) sin volver a enviar el archivo.
+
+    Devuelve el mensaje nuevo, o None si ninguna subida anterior sirve (mensajes borrados,
+    documento inaccesible...) y hay que subir el archivo.
+    """
+    chat_key = str(chat_id)
+    for previous in previous_uploads:
+        document = InputDocument(previous['document_id'], previous['access_hash'], previous['file_reference'] or b'')
+        try:
+            try:
+                return await client.send_file(telegram_chat(chat_key), document, caption=caption)
+            except (FileReferenceExpiredError, FilerefUpgradeNeededError):
+                # Refrescar la referencia desde el mensaje original
+                original = await client.get_messages(telegram_chat(previous['chat_id']), ids=previous['message_id'])
+                document = getattr(getattr(original, 'media', None), 'document', None)
+                if document is None or document.id != previous['document_id']:
+                    continue
+                return await client.send_file(telegram_chat(chat_key), document, caption=caption)
+        except Exception as e:
+            print(f"⚠️ [UPLOAD-DEDUP] No se pudo reutilizar el documento {previous['document_id']}: {type(e).__name__}: {e}", flush=True)
+    return None
+
+# ==================== SPRITES DE VISTA PREVIA PARA SEEK ====================
+# Opcional (requiere ffmpeg): por cada video se extrae un fotograma cada SEEK_PREVIEW_INTERVAL
+# segundos leyendo solo los chunks de los keyframes, se juntan en un sprite y se indexan en un
+# WebVTT. watch.html lo usa para enseñar dónde cae un seek antes de pedir el rango a Telegram.
+
+SEEK_PREVIEW_ENABLED = os.getenv('SEEK_PREVIEWS', 'false').lower() == 'true'
+SEEK_PREVIEW_DIR = os.getenv('SEEK_PREVIEW_DIR', 'preview_cache')
+SEEK_PREVIEW_FFMPEG = os.getenv('FFMPEG_PATH') or shutil.which('ffmpeg')
+SEEK_PREVIEW_INTERVAL = int(os.getenv('SEEK_PREVIEW_INTERVAL', 10))  # Segundos entre fotogramas
+SEEK_PREVIEW_MAX_FRAMES = int(os.getenv('SEEK_PREVIEW_MAX_FRAMES', 100))  # En videos largos se amplía el intervalo
+SEEK_PREVIEW_FFMPEG_PROCESSES = max(1, int(os.getenv('SEEK_PREVIEW_FFMPEG_PROCESSES', 2)))
+SEEK_PREVIEW_TILE_WIDTH = 160
+SEEK_PREVIEW_TILE_HEIGHT = 90
+SEEK_PREVIEW_COLUMNS = 10
+SEEK_PREVIEW_READAHEAD = 256 * 1024  # Bytes tras el keyframe que se leen reales (el decoder pide algunas muestras más)
+SEEK_PREVIEW_FFMPEG_TIMEOUT = 30
+
+def seek_preview_path(doc_id, name):
+    return os.path.join(SEEK_PREVIEW_DIR, str(doc_id), name)
+
+def seek_preview_known(doc_id):
+    """True si el sprite ya existe o se sabe que el documento no admite vista previa"""
+    return os.path.exists(seek_preview_path(doc_id, 'previews.vtt')) or os.path.exists(seek_preview_path(doc_id, 'previews.none'))
+
+def select_preview_keyframes(track, layout, interval=SEEK_PREVIEW_INTERVAL, max_frames=SEEK_PREVIEW_MAX_FRAMES):
+    """Primer keyframe a partir de cada marca de `interval` segundos. Devuelve ([(segundos, muestra)], duración)"""
+    offsets, times, total = layout
+    timescale = track['timescale']
+    duration = total / timescale
+    interval = max(interval, duration / max(1, max_frames))
+    sync_samples = track['sync_samples'] if track['sync_samples'] is not None else range(len(offsets))
+    frames = []
+    mark = 0.0
+    for sample in sorted(sync_samples):
+        if not 0 <= sample < len(offsets):
+            continue
+        seconds = times[sample] / timescale
+        if seconds >= mark:
+            frames.append((seconds, sample))
+            mark = seconds + interval
+    return frames, duration
+
+def _format_vtt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    return f'{hours:02d}:{minutes:02d}:{milliseconds // 1000:02d}.{milliseconds % 1000:03d}'
+
+def render_seek_preview_vtt(times, duration, sprite_name='previews.jpg'):
+    """WebVTT con un cue por fotograma apuntando a su recuadro del sprite (#xywh)"""
+    lines = ['WEBVTT', '']
+    for i, seconds in enumerate(times):
+        start = 0.0 if i == 0 else seconds
+        end = times[i + 1] if i + 1 < len(times) else max(duration, seconds + 0.001)
+        x = (i % SEEK_PREVIEW_COLUMNS) * SEEK_PREVIEW_TILE_WIDTH
+        y = (i // SEEK_PREVIEW_COLUMNS) * SEEK_PREVIEW_TILE_HEIGHT
+        lines.append(f'{_format_vtt_time(start)} --> {_format_vtt_time(end)}')
+        lines.append(f'{sprite_name}#xywh={x},{y},{SEEK_PREVIEW_TILE_WIDTH},{SEEK_PREVIEW_TILE_HEIGHT}')
+        lines.append('')
+    return '\n'.join(lines)
+
+def _run_ffmpeg(args):
+    result = subprocess.run([SEEK_PREVIEW_FFMPEG, '-v', 'error', '-y', *args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=SEEK_PREVIEW_FFMPEG_TIMEOUT)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip()[-300:])
+
+def _extract_preview_frame(source_path, seek_seconds, output_path):
+    """Un fotograma (el keyframe anterior o igual a seek_seconds) escalado al tamaño del recuadro"""
+    try:
+        _run_ffmpeg([
+            '-noaccurate_seek', '-ss', f'{seek_seconds:.3f}', '-i', source_path,
+            '-map', '0:v:0', '-frames:v', '1',
+            '-vf', (f'scale={SEEK_PREVIEW_TILE_WIDTH}:{SEEK_PREVIEW_TILE_HEIGHT}:force_original_aspect_ratio=decrease,'
+                    f'pad={SEEK_PREVIEW_TILE_WIDTH}:{SEEK_PREVIEW_TILE_HEIGHT}:(ow-iw)/2:(oh-ih)/2'),
+            '-q:v', '5', output_path,
+        ])
+        return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+    except Exception as e:
+        print(f"⚠️ [PREVIEW] ffmpeg no pudo extraer el fotograma en {seek_seconds:.1f}s: {e}", flush=True)
+        return False
+
+def build_seek_preview(client, client_loop, document, metadata, timeout=VIDEO_CHUNK_FETCH_TIMEOUT):
+    """Generar previews.jpg + previews.vtt del documento en SEEK_PREVIEW_DIR. Devuelve True si se generó.
+
+    ffmpeg trabaja sobre un archivo disperso del tamaño del documento en el que solo están
+    escritos el inicio, el moov y los chunks alineados de cada keyframe elegido.
+    """
+    viewer = 'previews'
+    priority = DOWNLOAD_PRIORITY_PREFETCH
+    doc_id = document.id
+    size = document.size or 0
+
+    def mark_unsupported(reason):
+        print(f"⚠️ [PREVIEW] Documento {doc_id} sin vista previa: {reason}", flush=True)
+        os.makedirs(os.path.dirname(seek_preview_path(doc_id, 'previews.none')), exist_ok=True)
+        open(seek_preview_path(doc_id, 'previews.none'), 'wb').close()
+        return False
+
+    if metadata.get('moov_offset') is not None:
+        location = (metadata['moov_offset'], metadata['moov_size'])
+    else:
+        location = locate_document_moov(client, client_loop, document, timeout=timeout, viewer=viewer, priority=priority)
+    if location is None:
+        return mark_unsupported('no es un MP4 con moov')
+    moov_offset, moov_size = location
+    moov = read_document_range(client, client_loop, document, doc_id, moov_offset, moov_offset + moov_size - 1, timeout=timeout,
+                               viewer=viewer, priority=priority)
+    track = parse_mp4_video_track(moov)
+    layout = mp4_sample_layout(track) if track else None
+    if layout is None:
+        return mark_unsupported('tablas de muestras no utilizables')
+    offsets, _, _ = layout
+    frames, duration = select_preview_keyframes(track, layout)
+    if not frames:
+        return mark_unsupported('sin keyframes')
+
+    # Chunks alineados necesarios: inicio (ftyp), moov y cada keyframe con algo de margen
+    needed = set(aligned_chunk_offsets(0, min(size, VIDEO_CHUNK_SIZE) - 1))
+    needed.update(aligned_chunk_offsets(moov_offset, moov_offset + moov_size - 1))
+    for _, sample in frames:
+        needed.update(aligned_chunk_offsets(offsets[sample], min(size - 1, offsets[sample] + track['sizes'][sample] + SEEK_PREVIEW_READAHEAD)))
+    needed = sorted(needed)
+    print(f"🎞️ [PREVIEW] Documento {doc_id}: {len(frames)} fotogramas, {len(needed)} chunk(s) de 1MB", flush=True)
+
+    with tempfile.TemporaryDirectory(prefix='seek_preview_') as work_dir:
+        source_path = os.path.join(work_dir, 'source.mp4')
+        with open(source_path, 'wb') as source:
+            source.truncate(size)
+            for i in range(0, len(needed), PARALLEL_DOWNLOAD_WINDOW):
+                batch = needed[i:i + PARALLEL_DOWNLOAD_WINDOW]
+                chunks = {offset: get_cached_chunk(doc_id, offset) for offset in batch}
+                missing = [offset for offset, data in chunks.items() if data is None]
+                if missing:
+                    chunks.update(fetch_chunks_coalesced(client, client_loop, document, doc_id, missing, timeout=timeout,
+                                                         viewer=viewer, priority=priority))
+                for offset in batch:
+                    if not chunks.get(offset):
+                        raise RuntimeError(f"No se pudo leer el chunk {offset} del documento {doc_id}")
+                    source.seek(offset)
+                    source.write(chunks[offset])
+
+        # Buscar un poco después del keyframe: su PTS puede ir algo por delante del DTS del moov
+        times = [seconds for seconds, _ in frames]
+        seeks = [seconds + min(0.5, (times[i + 1] - seconds) / 2 if i + 1 < len(times) else 0.5) for i, seconds in enumerate(times)]
+        outputs = [os.path.join(work_dir, f'frame_{i:04d}.jpg') for i in range(len(frames))]
+        with ThreadPoolExecutor(max_workers=SEEK_PREVIEW_FFMPEG_PROCESSES) as pool:
+            extracted = list(pool.map(_extract_preview_frame, [source_path] * len(frames), seeks, outputs))
+
+        # Los fotogramas que fallen se omiten: el cue anterior cubre su intervalo
+        good = [i for i, ok in enumerate(extracted) if ok]
+        if not good:
+            return mark_unsupported('ffmpeg no extrajo ningún fotograma')
+        for position, i in enumerate(good):
+            os.replace(outputs[i], os.path.join(work_dir, f'tile_{position:04d}.jpg'))
+        rows = math.ceil(len(good) / SEEK_PREVIEW_COLUMNS)
+        sprite_tmp = os.path.join(work_dir, 'previews.jpg')
+        _run_ffmpeg([
+            '-i', os.path.join(work_dir, 'tile_%04d.jpg'),
+            '-vf', f'tile={SEEK_PREVIEW_COLUMNS}x{rows}', '-frames:v', '1', '-q:v', '5', sprite_tmp,
+        ])
+
+        os.makedirs(os.path.dirname(seek_preview_path(doc_id, 'previews.jpg')), exist_ok=True)
+        shutil.move(sprite_tmp, seek_preview_path(doc_id, 'previews.jpg.tmp'))
+        os.replace(seek_preview_path(doc_id, 'previews.jpg.tmp'), seek_preview_path(doc_id, 'previews.jpg'))
+        vtt_tmp = seek_preview_path(doc_id, 'previews.vtt.tmp')
+        with open(vtt_tmp, 'w', encoding='utf-8') as f:
+            f.write(render_seek_preview_vtt([times[i] for i in good], duration))
+        os.replace(vtt_tmp, seek_preview_path(doc_id, 'previews.vtt'))
+    print(f"✅ [PREVIEW] Sprite de {len(good)} fotogramas generado para el documento {doc_id}", flush=True)
+    return True
+
+class SeekPreviewQueue:
+    """Un worker que genera en segundo plano los sprites de vista previa de los videos registrados"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = set()  # doc_ids en cola
+        self._thread = None
+        self.generated = 0
+        self.failed = 0
+
+    @property
+    def available(self):
+        return SEEK_PREVIEW_ENABLED and bool(SEEK_PREVIEW_FFMPEG)
+
+    def submit(self, phone, video_id, document):
+        """Encolar la generación si está activada y el sprite no existe. Devuelve True si se encoló."""
+        if not self.available or document is None or seek_preview_known(document.id):
+            return False
+        with self._lock:
+            if document.id in self._pending:
+                return False
+            self._pending.add(document.id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name='seek-preview', daemon=True)
+                self._thread.start()
+        self._queue.put((phone, video_id, document))
+        return True
+
+    def pending(self, doc_id):
+        with self._lock:
+            return doc_id in self._pending
+
+    def _worker(self):
+        while True:
+            phone, video_id, document = self._queue.get()
+            try:
+                client, client_loop = get_background_client(phone)
+                if client is None:
+                    print(f"⚠️ Vista previa del video {video_id} omitida: cliente de {phone} no disponible", flush=True)
+                elif build_seek_preview(client, client_loop, document, video_metadata_cache.get(video_id) or {}):
+                    self.generated += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"⚠️ Error generando la vista previa del video {video_id}: {type(e).__name__}: {e}", flush=True)
+            finally:
+                with self._lock:
+                    self._pending.discard(document.id)
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.available, 'pending': len(self._pending), 'generated': self.generated, 'failed': self.failed}
+
+seek_preview_queue = SeekPreviewQueue()
+
+def capture_video_assets(phone, video_id, document):
+    """Al registrar un video: capturar sus miniaturas y, si está activado, su sprite de vista previa"""
+    thumbnail_capture_queue.submit(phone, video_id, document)
+    seek_preview_queue.submit(phone, video_id, document)
+
+# ==================== RESPUESTAS DE VIDEO DESDE CACHÉ ====================
+# Un documento de Telegram nunca cambia, así que su id + tamaño sirven de ETag fuerte.
+# Con los metadatos en caché se pueden validar peticiones condicionales y servir rangos
+# que ya están en la caché de chunks sin hablar con Telegram.
+
+VIDEO_INITIAL_CHUNK_SIZE = 128 * 1024  # Lo que se sirve a una petición sin Range
+
+def video_etag(doc_id, size):
+    return f'"{doc_id}-{size}"'
+
+def etag_matches(header_value, etag):
+    """Comparación débil de If-None-Match (lista de ETags o '*')"""
+    if not header_value:
+        return False
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate == etag or candidate == f'W/{etag}':
+            return True
+    return False
+
+def video_mime_from_filename(filename):
+    """Tipo MIME de un video por la extensión de su nombre (mp4 si no se reconoce)"""
+    filename = (filename or '').lower()
+    if filename.endswith('.webm'):
+        return 'video/webm'
+    elif filename.endswith('.mkv'):
+        return 'video/x-matroska'
+    elif filename.endswith('.avi'):
+        return 'video/x-msvideo'
+    return 'video/mp4'
 
-# Verificar conexión a MySQL al iniciar
-if db_config:
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT COUNT(*) as count FROM videos")
-                result = cursor.fetchone()
-                print(f"✅ Conexión a MySQL exitosa. Videos en DB: {result['count']}")
-    except Exception as e:
-        print(f"⚠️ Advertencia: No se pudo conectar a MySQL: {e}")
-        print("⚠️ La aplicación continuará pero algunas funciones pueden no funcionar correctamente.")
+def video_response_headers(mime_type, etag):
+    """Headers comunes a todas las respuestas de /api/video (sin ETag si no se conoce el documento)"""
+    # IMPORTANTE: Headers optimizados para compatibilidad con navegadores móviles
+    headers = {
+        'Content-Type': mime_type,
+        'Accept-Ranges': 'bytes',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
+        'Access-Control-Allow-Headers': 'Range, Content-Range, Content-Length, If-None-Match, If-Range',
+        'Access-Control-Expose-Headers': 'Content-Range, Content-Length, ETag',
+        'Cache-Control': 'public, max-age=3600',
+        'ETag': etag,
+        'X-Content-Type-Options': 'nosniff',
+    }
+    if etag is None:
+        del headers['ETag']
+    return headers
 
-# Almacenar loops por thread
-_thread_loops = {}
-_thread_lock = threading.Lock()
+def parse_video_range(range_header, file_size, max_length):
+    """Interpretar un header Range como lo hace get_video: (start, end) recortado a max_length bytes"""
+    range_match = range_header.replace('bytes=', '').split('-')
+    start = int(range_match[0]) if range_match[0] else 0
+    end = int(range_match[1]) if range_match[1] else file_size - 1
+    start = max(start, 0)
+    end = min(end, file_size - 1)
+    start = min(start, end)
+    return start, min(end, start + max_length - 1)
 
-def get_event_loop():
-    """Obtener o crear un event loop para el thread actual"""
-    thread_id = threading.current_thread().ident
-    
-    with _thread_lock:
-        if thread_id in _thread_loops:
-            loop = _thread_loops[thread_id]
-            if loop.is_closed():
-                del _thread_loops[thread_id]
-            else:
-                # CRÍTICO: Asegurarse de que el loop esté establecido como el loop actual del thread
-                # Esto es necesario porque Flask puede reutilizar threads y el loop puede no estar configurado
-                try:
-                    asyncio.set_event_loop(loop)
-                except RuntimeError:
-                    # Si hay un error, crear un nuevo loop
-                    pass
-                else:
-                    return loop
-        
-        # Crear nuevo loop para este thread
-        loop = asyncio.new_event_loop()
-        # CRÍTICO: Establecer el loop como el loop actual del thread ANTES de guardarlo
-        asyncio.set_event_loop(loop)
-        _thread_loops[thread_id] = loop
-        return loop
+def read_cached_range(doc_id, start, end):
+    """Leer [start, end] solo de la caché de chunks; None si falta algún chunk"""
+    parts = []
+    for offset in aligned_chunk_offsets(start, end):
+        data = get_cached_chunk(doc_id, offset)
+        if data is None:
+            return None
+        # memoryview: recortar el chunk sin copiarlo; la única copia es la del join
+        parts.append(memoryview(data)[max(start - offset, 0):end - offset + 1])
+    return b''.join(parts)
 
-def run_async(coro, loop=None, timeout=None):
-    """Ejecutar una corrutina en un event loop para el thread actual
-    
-    Args:
-        coro: Corrutina a ejecutar
-        loop: Event loop a usar (opcional)
-        timeout: Timeout en segundos (opcional, por defecto 300 para operaciones largas)
+def iter_file_range(path, start, end, block_size=VIDEO_CHUNK_SIZE):
+    """Generar [start, end] de un archivo local por bloques leídos de un mmap (sin buffers intermedios)"""
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = start
+            while position <= end:
+                block_end = min(end + 1, position + block_size)
+                yield mapped[position:block_end]
+                position = block_end
+
+def file_range_body(path, start, end):
+    """Cuerpo de respuesta para [start, end] de un archivo local.
+
+    Con gunicorn se entrega el archivo ya posicionado a wsgi.file_wrapper, que lo envía con
+    os.sendfile hasta el Content-Length (cero copias en Python). Con otros servidores (el de
+    desarrollo de Werkzeug lee el file_wrapper hasta el final) se usa el generador sobre mmap.
     """
-    if timeout is None:
-        timeout = 300  # 5 minutos por defecto para operaciones como subir videos
-    
-    if loop is None:
-        loop = get_event_loop()
-    
-    # Asegurarse de que el loop no esté cerrado
-    if loop.is_closed():
-        # Si el loop está cerrado, crear uno nuevo
-        thread_id = threading.current_thread().ident
-        with _thread_lock:
-            if thread_id in _thread_loops:
-                del _thread_loops[thread_id]
-        loop = get_event_loop()
-    
-    # CRÍTICO: Establecer el loop como el loop actual del thread SIEMPRE
-    # Esto previene el error "no current event loop" cuando Flask reutiliza threads
-    try:
-        current_loop = asyncio.get_event_loop()
-        # Si el loop actual es diferente o está cerrado, establecer el nuevo loop
-        if current_loop != loop or current_loop.is_closed():
-            asyncio.set_event_loop(loop)
-    except RuntimeError:
-        # No hay loop actual, establecer este
-        asyncio.set_event_loop(loop)
-    
-    try:
-        # Verificar si el loop ya está corriendo
-        if loop.is_running():
-            # Si el loop está corriendo, usar run_coroutine_threadsafe para ejecutar en ese loop
-            # NO crear un nuevo loop porque el cliente detectaría el cambio
-            import concurrent.futures
-            
-            future = asyncio.run_coroutine_threadsafe(coro, loop)
-            try:
-                result = future.result(timeout=timeout)
-                return result
-            except concurrent.futures.TimeoutError:
-                future.cancel()
-                raise asyncio.TimeoutError(f"Operación excedió el timeout de {timeout} segundos")
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and 'gunicorn' in request.environ.get('SERVER_SOFTWARE', '').lower():
+        f = open(path, 'rb')
+        f.seek(start)
+        return file_wrapper(f, VIDEO_CHUNK_SIZE)
+    return iter_file_range(path, start, end)
+
+def video_accel_redirect_response(doc_id, mime_type, etag):
+    """Respuesta vacía con X-Accel-Redirect al documento materializado, o None si no está en disco"""
+    document_path = video_chunk_cache.document_path(doc_id)
+    if document_path is None:
+        return None
+    relative_path = os.path.relpath(document_path, video_chunk_cache.cache_dir).replace(os.sep, '/')
+    headers = video_response_headers(mime_type, etag)
+    headers['X-Accel-Redirect'] = f"{VIDEO_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_path}"
+    print(f"🚀 Documento {doc_id} servido por nginx (X-Accel-Redirect)", flush=True)
+    return Response(None, 200, headers, mimetype=mime_type)
+
+def serve_video_from_cache(file_size, mime_type, doc_id, range_header):
+    """Responder a /api/video solo con metadatos y chunks cacheados, sin cliente de Telegram.
+
+    Devuelve un 304 si el navegador ya tiene el video, los headers si es un HEAD, un 206/200
+    si los bytes pedidos están en caché, o None si hace falta el camino completo.
+    """
+    mime_type = mime_type or 'video/mp4'
+    etag = video_etag(doc_id, file_size)
+    headers = video_response_headers(mime_type, etag)
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        headers.pop('Content-Type', None)
+        return Response('', 304, headers)
+
+    # If-Range con otro validador: el rango ya no vale y se responde como sin Range
+    if_range = request.headers.get('If-Range')
+    if range_header and if_range and if_range.strip() != etag:
+        range_header = None
+
+    if range_header:
+        max_length = VIDEO_STREAM_MAX_RANGE if VIDEO_STREAMING_ENABLED else 5 * 1024 * 1024
+        start, end = parse_video_range(range_header, file_size, max_length)
+    else:
+        start, end = 0, adaptive_initial_bytes(video_viewer_id(), file_size) - 1
+    if end < start:
+        return None
+
+    # Mismos headers que tendría el GET (sin Range se sirven los primeros bytes con 206)
+    headers['Content-Length'] = str(end - start + 1)
+    status = 206
+    if not range_header and end + 1 >= file_size:
+        status = 200
+    else:
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+    if request.method == 'HEAD':
+        # Sin cuerpo (None) para que Flask no reemplace el Content-Length por 0
+        return Response(None, status, headers, mimetype=mime_type)
+
+    # Documento completo en disco: que nginx sirva los bytes (y el Range) con sendfile.
+    # nginx no conoce nuestro ETag, así que los If-Range los sigue resolviendo Python
+    if VIDEO_ACCEL_REDIRECT_ENABLED and not if_range:
+        accel_response = video_accel_redirect_response(doc_id, mime_type, etag)
+        if accel_response is not None:
+            return accel_response
+
+    # Documento completo en disco: los bytes salen del archivo con sendfile/mmap, sin leerlos en memoria
+    document_path = video_chunk_cache.document_path(doc_id) if VIDEO_MATERIALIZE_ENABLED else None
+    if document_path is not None:
+        print(f"📼 Rango {start}-{end} del documento {doc_id} servido desde archivo local", flush=True)
+        return Response(file_range_body(document_path, start, end), status, headers, mimetype=mime_type, direct_passthrough=True)
+
+    data = read_cached_range(doc_id, start, end)
+    if data is None:
+        return None
+    print(f"⚡ Rango {start}-{end} del documento {doc_id} servido desde caché sin Telegram", flush=True)
+    return Response(data, status, headers, mimetype=mime_type)
+
+# ==================== HLS SOBRE MP4 ====================
+# Playlist HLS con segmentos fMP4 generados al vuelo desde el MP4 guardado en Telegram: el
+# moov da las tablas de muestras, se corta en keyframes de video y cada segmento es un
+# moof + mdat con las muestras de video y audio de ese tramo (leídas por la caché de chunks).
+# El segmento de inicialización es el mismo moov sin muestras y con mvex.
+
+HLS_TARGET_SEGMENT_SECONDS = float(os.getenv('HLS_TARGET_SEGMENT_SECONDS', 6))
+HLS_MODEL_CACHE_SIZE = 8  # Videos con las tablas de muestras ya preparadas en memoria
+HLS_SAMPLE_READ_GAP = 64 * 1024  # Muestras separadas por menos de esto se leen en un solo rango
+
+def _iter_mp4_boxes(buffer, start, end):
+    """Recorrer las cajas de buffer[start:end] devolviendo (tipo, inicio del cuerpo, fin)"""
+    pos = start
+    while pos + 8 <= end:
+        box = _read_box_header(buffer, pos)
+        if box is None:
+            return
+        size, box_type, header_size = box
+        if size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            return
+        yield box_type, pos + header_size, pos + size
+        pos += size
+
+def _find_mp4_box(buffer, start, end, path):
+    """Buscar una caja por su ruta (p. ej. [b'mdia', b'minf', b'stbl']); devuelve (inicio, fin) del cuerpo"""
+    for box_type, body, box_end in _iter_mp4_boxes(buffer, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return body, box_end
+            return _find_mp4_box(buffer, body, box_end, path[1:])
+    return None
+
+def _read_full_box_table(buffer, location, entry_format):
+    """Leer las entradas de una full box con contador (stts, stsc, stss, stco, co64, ctts)"""
+    if location is None:
+        return None
+    body, _ = location
+    count = struct.unpack_from('>I', buffer, body + 4)[0]
+    entry_size = struct.calcsize(entry_format)
+    return [struct.unpack_from(entry_format, buffer, body + 8 + i * entry_size) for i in range(count)]
+
+def parse_mp4_track(moov, handler=b'vide'):
+    """Extraer de un moov las tablas de muestras de la primera pista del tipo handler
+    (b'vide' o b'soun'), o None si no hay"""
+    trak_start = 8
+    for box_type, body, box_end in _iter_mp4_boxes(moov, 8, len(moov)):
+        start, trak_start = trak_start, box_end
+        if box_type != b'trak':
+            continue
+        hdlr = _find_mp4_box(moov, body, box_end, [b'mdia', b'hdlr'])
+        if hdlr is None or moov[hdlr[0] + 8:hdlr[0] + 12] != handler:
+            continue
+        tkhd = _find_mp4_box(moov, body, box_end, [b'tkhd'])
+        mdhd = _find_mp4_box(moov, body, box_end, [b'mdia', b'mdhd'])
+        stbl = _find_mp4_box(moov, body, box_end, [b'mdia', b'minf', b'stbl'])
+        if mdhd is None or stbl is None:
+            return None
+        track_id = struct.unpack_from('>I', moov, tkhd[0] + (20 if moov[tkhd[0]] == 1 else 12))[0] if tkhd else None
+        version = moov[mdhd[0]]
+        timescale = struct.unpack_from('>I', moov, mdhd[0] + (20 if version == 1 else 12))[0]
+        stsz = _find_mp4_box(moov, stbl[0], stbl[1], [b'stsz'])
+        if stsz is None:
+            return None
+        uniform_size, sample_count = struct.unpack_from('>II', moov, stsz[0] + 4)
+        if uniform_size:
+            sizes = [uniform_size] * sample_count
         else:
-            # Si el loop no está corriendo, usar run_until_complete normalmente
-            return loop.run_until_complete(coro)
-    except Exception as e:
-        # Re-raise la excepción para que se maneje arriba
-        raise
-    finally:
-        # NO cerrar el loop - mantenerlo vivo para Telethon
-        # Asegurarse de que el loop sigue siendo el loop actual
-        try:
-            asyncio.set_event_loop(loop)
-        except:
-            pass
+            sizes = list(struct.unpack_from(f'>{sample_count}I', moov, stsz[0] + 12))
+        stco = _find_mp4_box(moov, stbl[0], stbl[1], [b'stco'])
+        chunk_offsets = _read_full_box_table(moov, stco, '>I') if stco else _read_full_box_table(moov, _find_mp4_box(moov, stbl[0], stbl[1], [b'co64']), '>Q')
+        stss = _read_full_box_table(moov, _find_mp4_box(moov, stbl[0], stbl[1], [b'stss']), '>I')
+        return {
+            'track_id': track_id,
+            'trak': (start, body, box_end),
+            'timescale': timescale,
+            'sizes': sizes,
+            'stts': _read_full_box_table(moov, _find_mp4_box(moov, stbl[0], stbl[1], [b'stts']), '>II') or [],
+            'stsc': _read_full_box_table(moov, _find_mp4_box(moov, stbl[0], stbl[1], [b'stsc']), '>III') or [],
+            'ctts': _read_full_box_table(moov, _find_mp4_box(moov, stbl[0], stbl[1], [b'ctts']), '>Ii'),
+            'chunk_offsets': [entry[0] for entry in chunk_offsets or []],
+            'sync_samples': [entry[0] - 1 for entry in stss] if stss is not None else None,
+        }
+    return None
+
+def parse_mp4_video_track(moov):
+    """Tablas de muestras de la pista de video del moov (o None si no hay)"""
+    return parse_mp4_track(moov, b'vide')
+
+def mp4_sample_layout(track):
+    """Offset en el archivo y tiempo de inicio (en unidades del timescale) de cada muestra de
+    la pista. Devuelve (offsets, times, duración total) o None si las tablas no son utilizables."""
+    sizes = track['sizes']
+    sample_count = len(sizes)
+    if not sample_count or not track['timescale'] or not track['chunk_offsets'] or not track['stsc']:
+        return None
+
+    # Offset en el archivo de cada muestra (stsc agrupa muestras por chunk, stco da el offset del chunk)
+    offsets = []
+    stsc = track['stsc']
+    chunk_offsets = track['chunk_offsets']
+    for i, (first_chunk, samples_per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunk_offsets)
+        for chunk in range(first_chunk - 1, last_chunk):
+            position = chunk_offsets[chunk]
+            for _ in range(samples_per_chunk):
+                if len(offsets) == sample_count:
+                    break
+                offsets.append(position)
+                position += sizes[len(offsets) - 1]
+    if len(offsets) != sample_count:
+        return None
+
+    # Tiempo de inicio de cada muestra (stts son pares cantidad/duración)
+    times = []
+    current = 0
+    for count, delta in track['stts']:
+        for _ in range(count):
+            times.append(current)
+            current += delta
+    if len(times) < sample_count:
+        return None
+    return offsets, times, current
+
+def hls_track_model(track):
+    """Datos por muestra de una pista para generar fragmentos fMP4 (arrays compactos), o None"""
+    layout = mp4_sample_layout(track) if track['track_id'] is not None else None
+    if layout is None:
+        return None
+    offsets, times, total_duration = layout
+    sample_count = len(offsets)
+    durations = [(times[i + 1] if i + 1 < len(times) else total_duration) - times[i] for i in range(sample_count)]
+    composition_offsets = None
+    if track['ctts']:
+        composition_offsets = array('l')
+        for count, offset in track['ctts']:
+            composition_offsets.extend([offset] * count)
+        if len(composition_offsets) < sample_count:
+            return None
+    return {
+        'track_id': track['track_id'],
+        'timescale': track['timescale'],
+        'offsets': array('q', offsets),
+        'sizes': array('L', track['sizes']),
+        'times': array('q', times[:sample_count]),
+        'durations': array('L', durations),
+        'composition_offsets': composition_offsets,
+        'sync': frozenset(track['sync_samples']) if track['sync_samples'] is not None else None,
+    }
+
+def _mp4_box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def _mp4_full_box(box_type, version, flags, payload):
+    return _mp4_box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+_FMP4_EMPTY_SAMPLE_TABLES = (
+    _mp4_full_box(b'stts', 0, 0, struct.pack('>I', 0)) +
+    _mp4_full_box(b'stsc', 0, 0, struct.pack('>I', 0)) +
+    _mp4_full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)) +
+    _mp4_full_box(b'stco', 0, 0, struct.pack('>I', 0))
+)
+
+def _fmp4_init_box(moov, box_type, start, body, end):
+    """Copia de una caja de la pista para el segmento de inicialización: igual salvo stbl, que
+    se queda con stsd y tablas vacías (las muestras van en cada moof)"""
+    if box_type in (b'trak', b'mdia', b'minf'):
+        children = []
+        child_start = body
+        for child_type, child_body, child_end in _iter_mp4_boxes(moov, body, end):
+            children.append(_fmp4_init_box(moov, child_type, child_start, child_body, child_end))
+            child_start = child_end
+        return _mp4_box(box_type, b''.join(children))
+    if box_type == b'stbl':
+        stsd = _find_mp4_box(moov, body, end, [b'stsd'])
+        return _mp4_box(b'stbl', _mp4_box(b'stsd', moov[stsd[0]:stsd[1]]) + _FMP4_EMPTY_SAMPLE_TABLES)
+    return moov[start:end]
+
+def build_fmp4_init(moov, tracks):
+    """ftyp + moov (mvhd, pistas sin muestras y mvex) para EXT-X-MAP"""
+    ftyp = _mp4_box(b'ftyp', b'iso5' + struct.pack('>I', 512) + b'iso5iso6mp41')
+    boxes = []
+    box_start = 8
+    for box_type, _, box_end in _iter_mp4_boxes(moov, 8, len(moov)):
+        if box_type == b'mvhd':
+            boxes.append(moov[box_start:box_end])
+        box_start = box_end
+    for track in tracks:
+        boxes.append(_fmp4_init_box(moov, b'trak', *track['trak']))
+    # trex: valores por defecto de los fragmentos (cada trun los da todos explícitamente)
+    boxes.append(_mp4_box(b'mvex', b''.join(
+        _mp4_full_box(b'trex', 0, 0, struct.pack('>IIIII', track['track_id'], 1, 0, 0, 0)) for track in tracks
+    )))
+    return ftyp + _mp4_box(b'moov', b''.join(boxes))
+
+def build_hls_model(moov, target_seconds=HLS_TARGET_SEGMENT_SECONDS):
+    """Preparar el HLS de un moov: segmento de inicialización, pistas y segmentos de
+    ~target_seconds que empiezan en un keyframe de video. None si no se puede."""
+    video_track = parse_mp4_track(moov, b'vide')
+    video = hls_track_model(video_track) if video_track else None
+    if video is None:
+        return None
+    audio_track = parse_mp4_track(moov, b'soun')
+    audio = hls_track_model(audio_track) if audio_track else None
+    parsed_tracks = [video_track] + ([audio_track] if audio else [])
+    tracks = [video] + ([audio] if audio else [])
+
+    sample_count = len(video['sizes'])
+    video_times = video['times']
+    sync_samples = sorted(video['sync']) if video['sync'] is not None else range(sample_count)
+    boundaries = []
+    for sample in sync_samples:
+        if 0 <= sample < sample_count and (not boundaries or video_times[sample] - video_times[boundaries[-1]] >= target_seconds * video['timescale']):
+            boundaries.append(sample)
+    if not boundaries or boundaries[0] != 0:
+        return None
+
+    # Cada pista se corta en el mismo instante que el keyframe de video
+    track_ranges = []
+    for track in tracks:
+        if track is video:
+            starts = boundaries
+        else:
+            starts = [0] + [bisect.bisect_left(track['times'], video_times[sample] * track['timescale'] // video['timescale'])
+                            for sample in boundaries[1:]]
+        track_ranges.append(list(zip(starts, starts[1:] + [len(track['sizes'])])))
+
+    video_end = video_times[-1] + video['durations'][-1]
+    segments = []
+    for i, sample in enumerate(boundaries):
+        end_time = video_times[boundaries[i + 1]] if i + 1 < len(boundaries) else video_end
+        segments.append(((end_time - video_times[sample]) / video['timescale'], [ranges[i] for ranges in track_ranges]))
+    return {
+        'init': build_fmp4_init(moov, parsed_tracks),
+        'tracks': tracks,
+        'segments': segments,
+    }
+
+def read_hls_samples(read_range, tracks, ranges):
+    """Bytes de las muestras de cada pista en el segmento, concatenados por pista.
+    read_range(inicio, fin) lee bytes del archivo (fin incluido); las muestras cercanas se
+    leen juntas porque audio y video van intercalados en el mdat."""
+    wanted = sorted((track['offsets'][s], track['sizes'][s])
+                    for track, (first, end) in zip(tracks, ranges) for s in range(first, end))
+    spans = []
+    for offset, size in wanted:
+        if spans and offset <= spans[-1][1] + HLS_SAMPLE_READ_GAP:
+            spans[-1][1] = max(spans[-1][1], offset + size)
+        else:
+            spans.append([offset, offset + size])
+    blobs = []
+    for start, end in spans:
+        data = read_range(start, end - 1)
+        if len(data) != end - start:
+            raise IOError(f"Lectura incompleta de muestras: {len(data)} de {end - start} bytes en {start}")
+        blobs.append((start, data))
+    blob_starts = [start for start, _ in blobs]
+
+    def sample_bytes(offset, size):
+        start, data = blobs[bisect.bisect_right(blob_starts, offset) - 1]
+        return data[offset - start:offset - start + size]
+
+    return [b''.join(sample_bytes(track['offsets'][s], track['sizes'][s]) for s in range(first, end))
+            for track, (first, end) in zip(tracks, ranges)]
+
+def build_fmp4_segment(sequence, tracks, ranges, sample_data):
+    """moof + mdat de un segmento. ranges[i] son las muestras [primera, fin) de tracks[i] y
+    sample_data[i] sus bytes concatenados (ver read_hls_samples)."""
+    def moof(data_offset):
+        trafs = []
+        for track, (first, end), data in zip(tracks, ranges, sample_data):
+            if first == end:
+                continue
+            offsets = track['composition_offsets']
+            # data-offset + duración, tamaño, flags y (si hay ctts) composición por muestra
+            trun_flags = 0x000001 | 0x000100 | 0x000200 | 0x000400 | (0x000800 if offsets is not None else 0)
+            entries = []
+            for sample in range(first, end):
+                is_sync = track['sync'] is None or sample in track['sync']
+                entry = struct.pack('>III', track['durations'][sample], track['sizes'][sample], 0x02000000 if is_sync else 0x01010000)
+                if offsets is not None:
+                    entry += struct.pack('>i', offsets[sample])
+                entries.append(entry)
+            trafs.append(_mp4_box(b'traf',
+                _mp4_full_box(b'tfhd', 0, 0x020000, struct.pack('>I', track['track_id'])) +  # default-base-is-moof
+                _mp4_full_box(b'tfdt', 1, 0, struct.pack('>Q', track['times'][first])) +
+                _mp4_full_box(b'trun', 1, trun_flags, struct.pack('>Ii', end - first, data_offset) + b''.join(entries))))
+            data_offset += len(data)
+        return _mp4_box(b'moof', _mp4_full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)) + b''.join(trafs))
+
+    # El data-offset de cada trun se cuenta desde el inicio del moof: primero se mide el moof
+    moof_size = len(moof(0))
+    return moof(moof_size + 8) + _mp4_box(b'mdat', b''.join(sample_data))
+
+_hls_models = OrderedDict()  # doc_id -> modelo HLS (LRU)
+_hls_models_lock = threading.Lock()
+
+def build_document_hls(client, client_loop, document, video_id, metadata, timeout=None, viewer=None, priority=DOWNLOAD_PRIORITY_BULK):
+    """Modelo HLS del documento (leyendo su moov la primera vez); None si no es un MP4 utilizable"""
+    with _hls_models_lock:
+        hls = _hls_models.get(document.id)
+        if hls is not None:
+            _hls_models.move_to_end(document.id)
+            return hls
+    if metadata.get('moov_offset') is not None:
+        location = (metadata['moov_offset'], metadata['moov_size'])
+    else:
+        location = locate_document_moov(client, client_loop, document, timeout=timeout, viewer=viewer, priority=priority)
+    if location is None:
+        return None
+    moov_offset, moov_size = location
+    moov = read_document_range(client, client_loop, document, document.id, moov_offset, moov_offset + moov_size - 1, timeout=timeout,
+                               viewer=viewer, priority=priority)
+    video_metadata_cache.update_fields(video_id, moov_offset=moov_offset, moov_size=moov_size)
+    hls = build_hls_model(moov)
+    if hls is None:
+        return None
+    with _hls_models_lock:
+        _hls_models[document.id] = hls
+        while len(_hls_models) > HLS_MODEL_CACHE_SIZE:
+            _hls_models.popitem(last=False)
+    return hls
+
+def render_hls_playlist(base_url, hls):
+    """Generar el texto m3u8 (VOD) con el segmento de inicialización y un .m4s por segmento"""
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:7',
+        f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(duration for duration, _ in hls['segments'])))}",
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+        '#EXT-X-INDEPENDENT-SEGMENTS',
+        f'#EXT-X-MAP:URI="{base_url}/init.mp4"',
+    ]
+    for index, (duration, _) in enumerate(hls['segments']):
+        lines.append(f'#EXTINF:{duration:.3f},')
+        lines.append(f'{base_url}/{index}.m4s')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
 
 def load_saved_config():
     """Cargar configuración guardada"""
@@ -952,6 +4206,7 @@ def get_video_link():
             
             # Guardar en base de datos
             if save_video_to_db(video_id, chat_id_str, message_id, filename, timestamp, file_size):
+                capture_video_assets(phone, video_id, getattr(message.media, 'document', None))
                 video_url = f'/watch/{video_id}'
                 return jsonify({
                     'video_id': video_id,
@@ -1541,6 +4796,29 @@ def get_or_create_client(phone):
                     print(traceback.format_exc(), flush=True)
                     raise
 
+def get_background_client(phone):
+    """Cliente y loop ya registrados para trabajos en segundo plano, o (None, None).
+
+    A diferencia de get_or_create_client no toca la sesión de Flask (los hilos de fondo no
+    tienen contexto de petición) ni crea clientes nuevos: solo reconecta el existente, como
+    hace upload_in_background.
+    """
+    client_data = telegram_clients.get(phone)
+    if not client_data:
+        return None, None
+    client = client_data.get('client')
+    client_loop = client_data.get('loop')
+    if not client or not client_loop or client_loop.is_closed():
+        return None, None
+    if not client.is_connected():
+        try:
+            run_async(client.connect(), client_loop, timeout=10)
+        except Exception as e:
+            print(f"⚠️ Error reconectando cliente {phone} en segundo plano: {e}", flush=True)
+        if not client.is_connected():
+            return None, None
+    return client, client_loop
+
 @app.route('/api/chat/<chat_id>/messages', methods=['GET'])
 def get_messages(chat_id):
     """Obtener mensajes de un chat"""
@@ -1567,6 +4845,9 @@ def get_messages(chat_id):
             print(f"❌ Loop del cliente está cerrado, esto no debería pasar después de get_or_create_client")
             return jsonify({'error': 'Error de conexión. Por favor, recarga la página.'}), 500
         
+        # Cambiar de chat cancela las pre-cargas pendientes del chat anterior
+        video_prefetch_scheduler.cancel(phone)
+        
         async def fetch_messages():
             messages = []
             try:
@@ -1662,41 +4943,12 @@ def get_messages(chat_id):
                                 msg_info['video_url'] = f'/api/video/{existing_video_id}'
                                 msg_info['video_id'] = existing_video_id  # Agregar video_id directamente
                                 msg_info['watch_url'] = f'/watch/{existing_video_id}'
+                                msg_info['thumbnail_preview'] = document_stripped_preview(doc)
                                 print(f"✅ Video URL asignado para mensaje {message.id}: {msg_info['video_url']}, video_id: {existing_video_id}")
                                 
-                                # Pre-cargar video en memoria en segundo plano (como Telegram - instantáneo)
-                                def preload_video():
-                                    try:
-                                        if existing_video_id not in video_memory_cache:
-                                            print(f"🔄 Pre-cargando video en memoria: {existing_video_id}")
-                                            # Obtener cliente
-                                            client_preload = get_or_create_client(phone)
-                                            client_loop_preload = client_preload._loop
-                                            
-                                            # Obtener mensaje
-                                            async def get_msg():
-                                                target_chat_preload = int(chat_id) if chat_id != 'me' and str(chat_id).isdigit() else 'me'
-                                                return await client_preload.get_messages(target_chat_preload, ids=message.id)
-                                            
-                                            msg_preload = run_async(get_msg(), client_loop_preload, timeout=30)
-                                            
-                                            if msg_preload and msg_preload.media:
-                                                # Descargar a memoria
-                                                async def download_to_mem():
-                                                    buffer = BytesIO()
-                                                    await client_preload.download_media(msg_preload, buffer)
-                                                    buffer.seek(0)
-                                                    return buffer.getvalue()
-                                                
-                                                video_data = run_async(download_to_mem(), client_loop_preload, timeout=300)
-                                                if video_data:
-                                                    video_memory_cache[existing_video_id] = video_data
-                                                    print(f"✅ Video pre-cargado en memoria: {existing_video_id} ({len(video_data)} bytes)")
-                                    except Exception as e:
-                                        print(f"⚠️ Error pre-cargando video: {e}")
-                                
-                                # Pre-cargar en thread separado (no bloquea)
-                                threading.Thread(target=preload_video, daemon=True).start()
+                                # Pre-cargar el inicio del video en segundo plano (como Telegram - instantáneo)
+                                video_prefetch_scheduler.submit(phone, phone, message.media.document, existing_video_id, priority=len(messages))
+                                capture_video_assets(phone, existing_video_id, message.media.document)
                                 
                                 # Si el mensaje tiene texto (caption), mantenerlo pero no sobrescribir
                                 if message.text and not msg_info.get('text'):
@@ -1729,6 +4981,14 @@ def get_messages(chat_id):
         # Asegurarse de devolver JSON, no HTML
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/prefetch/cancel', methods=['POST'])
+def cancel_prefetch():
+    """Cancelar las pre-cargas de videos del usuario (la página las pide al salir)"""
+    if 'phone' not in session:
+        return jsonify({'error': 'No estás conectado'}), 401
+    cancelled = video_prefetch_scheduler.cancel(session['phone'])
+    return jsonify({'success': True, 'cancelled': cancelled})
+
 @app.route('/api/send_message', methods=['POST'])
 def send_message():
     """Enviar mensaje de texto"""
@@ -1789,6 +5049,7 @@ def upload_video():
     
     chat_id = request.form.get('chat_id', 'me')  # Por defecto a "me" (Saved Messages)
     description = request.form.get('description', '')  # Descripción opcional del video
+    priority = UPLOAD_PRIORITIES.get(request.form.get('priority', 'normal'), UPLOAD_PRIORITIES['normal'])
     print(f"📋 Chat ID recibido: {chat_id}", flush=True)
     print(f"📋 Descripción: {description}", flush=True)
     
@@ -1818,7 +5079,8 @@ def upload_video():
     session_name = session.get('session_name', f"sessions/{secure_filename(phone)}")
     
     # Inicializar progreso ANTES de guardar el archivo
-    upload_progress[upload_id] = {'progress': 0, 'status': 'uploading', 'current': 0, 'total': 0, 'message': 'Iniciando subida directa a Telegram...'}
+    upload_progress[upload_id] = {'progress': 0, 'status': 'uploading', 'current': 0, 'total': 0, 'phone': phone,
+                                  'message': 'Iniciando subida directa a Telegram...'}
     print(f"✅ [UPLOAD] Upload ID creado: {upload_id}", flush=True)
     print(f"📋 [UPLOAD] Upload IDs disponibles después de crear: {list(upload_progress.keys())}", flush=True)
     
@@ -1858,7 +5120,7 @@ def upload_video():
         upload_progress[upload_id]['total'] = 4 * 1024 * 1024 * 1024  # 4GB estimado
     
     # CRÍTICO: Definir upload_in_background ANTES de usarla
-    def upload_in_background(phone_param, api_id_param, api_hash_param, session_name_param, chat_id_param, local_path_param, filename_param, upload_id_param, timestamp_param, file_size_param, description_param=''):
+    def upload_in_background(phone_param, api_id_param, api_hash_param, session_name_param, chat_id_param, local_path_param, filename_param, upload_id_param, timestamp_param, file_size_param, description_param='', content_hash_param=None):
         try:
             # 🚀 NUEVA ARQUITECTURA: Esperar a que el archivo esté completamente guardado
             # Ya no hay streaming parcial, esperamos a que termine de guardarse y luego subimos
@@ -1947,7 +5209,8 @@ def upload_video():
                     'progress': 10,  # 10% porque ya se guardó
                     'status': 'uploading', 
                     'current': 0, 
-                    'total': file_size_param
+                    'total': file_size_param,
+                    'phone': phone_param
                 }
             else:
                 # Asegurarse de que el total esté configurado
@@ -1956,6 +5219,14 @@ def upload_video():
                 upload_progress[upload_id_param]['progress'] = 10  # 10% = guardado completo
                 upload_progress[upload_id_param]['message'] = 'Subiendo a Telegram...'
             
+            # ¿La cuenta ya subió este mismo contenido? Entonces no hace falta volver a enviarlo
+            previous_uploads = []
+            if UPLOAD_DEDUP_ENABLED and content_hash_param:
+                previous_uploads = find_uploaded_documents(phone_param, content_hash_param, file_size_param)
+                if previous_uploads:
+                    print(f"♻️ [UPLOAD-BG] Contenido ya subido antes ({len(previous_uploads)} chats), reutilizando documento", flush=True)
+                    upload_progress[upload_id_param]['message'] = 'Video ya subido antes, reutilizándolo...'
+            
             print(f"🚀 [UPLOAD-BG] Iniciando subida en background - Upload ID: {upload_id_param}", flush=True)
             print(f"📋 [UPLOAD-BG] Upload IDs disponibles al iniciar background: {list(upload_progress.keys())}", flush=True)
             
@@ -1985,6 +5256,8 @@ def upload_video():
             # El progreso de Telegram (0-100%) se mapea a 10-100% del progreso total
             # porque el guardado inicial (0-10%) ya se completó
             def progress_callback(current, total):
+                # Lanzar la excepción aquí corta la subida de partes en curso
+                upload_queue.check_cancelled(upload_id_param)
                 if total > 0:
                     # Progreso de Telegram (0-100%)
                     telegram_progress = (current / total) * 100
@@ -1998,7 +5271,8 @@ def upload_video():
                             'progress': 30,  # Guardado inicial
                             'status': 'uploading', 
                             'current': current, 
-                            'total': total
+                            'total': total,
+                            'phone': phone_param
                         }
                     
                     # Actualizar progreso de forma thread-safe
@@ -2012,17 +5286,21 @@ def upload_video():
                     if total_progress % 5 == 0 or total_progress == 100:
                         print(f"📤 [UPLOAD-BG] Progreso total: {total_progress}% (Telegram: {telegram_progress:.1f}%, {current}/{total} bytes) - Upload ID: {upload_id_param}", flush=True)
             
+            # Usar la descripción si está disponible, sino usar el nombre del archivo
+            caption = description_param if description_param else filename_param
+            
             # Subir video al chat especificado desde el archivo local
             async def upload():
-                # Usar la descripción si está disponible, sino usar el nombre del archivo
-                caption = description_param if description_param else filename_param
-                
-                # Enviar el archivo desde el path local
+                # Partes en paralelo por varias conexiones; los atributos (duración, tamaño...) se
+                # sacan del archivo local igual que haría send_file con el path
+                input_file = await upload_file_parallel(client, local_path_param, progress_callback=progress_callback)
+                attributes, mime_type = get_attributes(local_path_param)
                 message = await client.send_file(
                     int(chat_id_param) if chat_id_param != 'me' else 'me', 
-                    local_path_param, 
+                    input_file, 
                     caption=caption,
-                    progress_callback=progress_callback
+                    attributes=attributes,
+                    mime_type=mime_type
                 )
                 return message
             
@@ -2034,7 +5312,23 @@ def upload_video():
             print(f"🚀 [UPLOAD-BG] Iniciando subida a Telegram ahora...", flush=True)
             
             try:
-                message = run_async(upload(), client_loop, timeout=timeout_seconds)
+                message = None
+                if previous_uploads:
+                    message = run_async(resend_uploaded_document(client, chat_id_param, previous_uploads, caption), client_loop, timeout=120)
+                    if message is None:
+                        print(f"⚠️ [UPLOAD-BG] Ninguna subida anterior se pudo reutilizar, subiendo el archivo", flush=True)
+                if message is None:
+                    # Mover el moov al inicio para que el video se pueda reproducir desde el primer
+                    # Range (solo cuando de verdad hay que subir el archivo)
+                    upload_queue.check_cancelled(upload_id_param)
+                    if UPLOAD_FASTSTART_ENABLED:
+                        upload_progress[upload_id_param]['message'] = 'Optimizando video para streaming...'
+                        try:
+                            mp4_faststart(local_path_param)
+                        except Exception as faststart_error:
+                            print(f"⚠️ [UPLOAD-BG] No se pudo aplicar faststart, se sube el archivo original: {type(faststart_error).__name__}: {faststart_error}", flush=True)
+                        upload_progress[upload_id_param]['message'] = 'Subiendo a Telegram...'
+                    message = run_async(upload(), client_loop, timeout=timeout_seconds)
                 print(f"✅ [UPLOAD-BG] Subida completada exitosamente", flush=True)
             except Exception as upload_error:
                 error_msg = str(upload_error)
@@ -2075,8 +5369,10 @@ def upload_video():
             
             if save_video_to_db(video_id, chat_id_str, message.id, filename_param, timestamp_param, file_size_param):
                 print(f"✅ Video subido a Telegram: ID={video_id}, Chat={chat_id_str}, Message={message.id}")
+                capture_video_assets(phone_param, video_id, getattr(message.media, 'document', None))
             else:
                 print(f"⚠️ Error guardando video en DB, pero continuando...")
+            save_uploaded_document(content_hash_param, file_size_param, phone_param, chat_id_str, message, video_id)
             
             # Guardar video_id en el progreso para que el frontend lo pueda obtener
             upload_progress[upload_id_param]['video_id'] = video_id
@@ -2089,14 +5385,20 @@ def upload_video():
             error_traceback = traceback.format_exc()
             error_msg = f"{type(e).__name__}: {str(e)}"
             
-            print(f"❌ ERROR en subida en background - Upload ID: {upload_id_param}")
-            print(f"❌ Error: {error_msg}")
-            print(f"❌ Traceback completo:\n{error_traceback}")
-            
-            if upload_id_param in upload_progress:
-                upload_progress[upload_id_param]['status'] = 'error'
-                upload_progress[upload_id_param]['error'] = error_msg
-                upload_progress[upload_id_param]['error_details'] = error_traceback
+            if isinstance(e, UploadCancelledError):
+                print(f"🚫 [UPLOAD-BG] Subida cancelada - Upload ID: {upload_id_param}", flush=True)
+                if upload_id_param in upload_progress:
+                    upload_progress[upload_id_param]['status'] = 'cancelled'
+                    upload_progress[upload_id_param]['message'] = 'Subida cancelada'
+            else:
+                print(f"❌ ERROR en subida en background - Upload ID: {upload_id_param}")
+                print(f"❌ Error: {error_msg}")
+                print(f"❌ Traceback completo:\n{error_traceback}")
+                
+                if upload_id_param in upload_progress:
+                    upload_progress[upload_id_param]['status'] = 'error'
+                    upload_progress[upload_id_param]['error'] = error_msg
+                    upload_progress[upload_id_param]['error_details'] = error_traceback
             
             # 🗑️ Limpiar archivo temporal en caso de error
             try:
@@ -2116,6 +5418,27 @@ def upload_video():
                 except:
                     pass
     
+    def enqueue_upload(actual_file_size, content_hash=None):
+        """Encolar la subida a Telegram del archivo ya guardado en la cola de la cuenta"""
+        def cancel_before_start():
+            if os.path.exists(local_path):
+                os.remove(local_path)
+                print(f"🗑️ [UPLOAD] Archivo temporal de subida cancelada eliminado: {local_path}", flush=True)
+            upload_progress[upload_id]['status'] = 'cancelled'
+            upload_progress[upload_id]['message'] = 'Subida cancelada'
+        
+        upload_progress[upload_id]['status'] = 'queued'
+        upload_progress[upload_id]['message'] = 'En cola para subir a Telegram...'
+        upload_queue.submit(UploadJob(
+            upload_id, phone, priority,
+            lambda: upload_in_background(
+                phone, api_id, api_hash, session_name,
+                chat_id, local_path, filename, upload_id,
+                timestamp, actual_file_size, description, content_hash
+            ),
+            on_cancel=cancel_before_start
+        ))
+    
     # SOLUCIÓN STREAMING: Guardar y subir simultáneamente
     # Leemos el archivo en chunks y lo guardamos, pero empezamos a subir tan pronto como tengamos suficiente data
     def save_and_upload_streaming(file_obj, save_path, upload_id_param, estimated_size, phone_param, api_id_param, api_hash_param, session_name_param, chat_id_param, filename_param, description_param):
@@ -2325,8 +5648,8 @@ def upload_video():
                 # Flask/Werkzeug maneja el streaming internamente
                 file.seek(0)
                 print(f"💾 [SAVE-BG] Guardando en archivo temporal: {local_path}", flush=True)
-                file.save(local_path)
-                print(f"💾 [SAVE-BG] Archivo temporal guardado completamente", flush=True)
+                content_hash = save_upload_hashed(file.stream, local_path)
+                print(f"💾 [SAVE-BG] Archivo temporal guardado completamente (sha256 {content_hash[:12]}...)", flush=True)
                 
                 actual_file_size = os.path.getsize(local_path)
                 print(f"✅ [SAVE-BG] Archivo temporal listo: {local_path} ({actual_file_size} bytes, {actual_file_size / (1024*1024*1024):.2f} GB)", flush=True)
@@ -2338,13 +5661,9 @@ def upload_video():
                 upload_progress[upload_id]['progress'] = 10
                 print(f"✅ [SAVE-BG] Progreso actualizado a 10%: {upload_progress[upload_id]}", flush=True)
                 
-                # Iniciar subida a Telegram
-                print(f"📤 [SAVE-BG] Iniciando subida a Telegram...", flush=True)
-                upload_in_background(
-                    phone, api_id, api_hash, session_name,
-                    chat_id, local_path, filename, upload_id,
-                    timestamp, actual_file_size, description
-                )
+                # Encolar la subida a Telegram (límite de subidas simultáneas por cuenta)
+                print(f"📤 [SAVE-BG] Encolando subida a Telegram...", flush=True)
+                enqueue_upload(actual_file_size, content_hash)
                 
             except Exception as e:
                 import traceback
@@ -2480,8 +5799,7 @@ def upload_video():
                 # Guardar el archivo desde el buffer en memoria al archivo temporal
                 print(f"💾 [BG] Guardando archivo temporal desde buffer en memoria...", flush=True)
                 file_buffer.seek(0)  # Asegurarse de que estamos al inicio del buffer
-                with open(local_path, 'wb') as f:
-                    shutil.copyfileobj(file_buffer, f)
+                content_hash = save_upload_hashed(file_buffer, local_path)
                 
                 actual_file_size = os.path.getsize(local_path)
                 print(f"✅ [BG] Archivo temporal guardado: {local_path} ({actual_file_size} bytes, {actual_file_size / (1024*1024*1024):.2f} GB)", flush=True)
@@ -2492,13 +5810,9 @@ def upload_video():
                 upload_progress[upload_id]['message'] = 'Archivo listo, iniciando subida a Telegram...'
                 upload_progress[upload_id]['progress'] = 10
                 
-                # Iniciar subida a Telegram inmediatamente
-                print(f"📤 [BG] Iniciando subida a Telegram...", flush=True)
-                upload_in_background(
-                    phone, api_id, api_hash, session_name,
-                    chat_id, local_path, filename, upload_id,
-                    timestamp, actual_file_size, description
-                )
+                # Encolar la subida a Telegram (límite de subidas simultáneas por cuenta)
+                print(f"📤 [BG] Encolando subida a Telegram...", flush=True)
+                enqueue_upload(actual_file_size, content_hash)
             except Exception as e:
                 import traceback
                 error_traceback = traceback.format_exc()
@@ -2527,6 +5841,487 @@ def upload_video():
     })
     
 
+@app.route('/api/upload/stream', methods=['POST'])
+def upload_video_stream():
+    """Subir un video a Telegram mientras se recibe, sin guardarlo antes en disco.
+
+    Mismo formulario multipart que /api/upload (video, chat_id, description) más el header
+    X-Upload-Size con el tamaño exacto del archivo (Telegram necesita saber el número de
+    partes desde la primera). Responde cuando el video ya está enviado al chat. No aplica
+    faststart: para eso hace falta el archivo completo (usar /api/upload).
+    """
+    if 'phone' not in session:
+        return jsonify({'error': 'No estás conectado a Telegram'}), 401
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        return jsonify({'error': 'Se esperaba multipart/form-data'}), 400
+    try:
+        file_size = int(request.headers.get('X-Upload-Size', ''))
+    except ValueError:
+        return jsonify({'error': 'Falta el header X-Upload-Size con el tamaño del archivo'}), 400
+    if file_size <= 0:
+        return jsonify({'error': 'El archivo está vacío'}), 400
+    if file_size > UPLOAD_RESUMABLE_MAX_SIZE:
+        return jsonify({'error': 'El archivo supera el tamaño máximo de Telegram'}), 413
+
+    phone = session['phone']
+    client = get_or_create_client(phone)
+    if not client or not client.is_connected():
+        return jsonify({'error': 'No se pudo conectar a Telegram'}), 500
+
+    upload_id = secrets.token_urlsafe(8)
+    timestamp = int(time.time())
+    upload_progress[upload_id] = {'progress': 0, 'status': 'queued', 'current': 0, 'total': file_size, 'phone': phone,
+                                  'message': 'En cola para subir a Telegram...'}
+
+    def progress_callback(current, total):
+        progress = int(current / total * 100)
+        upload_progress[upload_id]['progress'] = progress
+        upload_progress[upload_id]['current'] = current
+        upload_progress[upload_id]['message'] = f'Subiendo a Telegram... {progress}%'
+
+    fields = {}
+    filename = None
+    buffer = UploadPartBuffer(UPLOAD_STREAM_MEMORY_BYTES)
+    uploader = None
+    md5 = hashlib.md5()  # Solo lo usa Telegram en archivos pequeños (InputFile)
+    content_hash = hashlib.sha256()  # Para deduplicar futuras subidas del mismo video
+    received = 0
+    started = time.time()
+    try:
+        # Las partes hacia Telegram cuentan en el límite de subidas simultáneas de la cuenta
+        with upload_queue.slot(phone, upload_id):
+            upload_progress[upload_id].update({'status': 'uploading', 'message': 'Subiendo directamente a Telegram...'})
+            current_field = None  # Nombre del campo de texto en curso, 'video' para el archivo, None para ignorar
+            pending = bytearray()
+            part_index = 0
+            for event in iter_multipart_events(request.stream, options['boundary']):
+                if isinstance(event, File):
+                    current_field = None
+                    if event.name == 'video' and uploader is None:
+                        current_field = 'video'
+                        filename = secure_filename(event.filename or '') or 'video.mp4'
+                        uploader = TelegramPartUploader(client, buffer, file_size, filename, progress=progress_callback)
+                        uploader.start()
+                        print(f"🚀 [UPLOAD-STREAM] {filename}: {file_size / (1024*1024):.1f}MB en {uploader.total_parts} partes ({upload_id})", flush=True)
+                elif isinstance(event, Field):
+                    current_field = event.name if event.name != 'video' else None
+                    fields[event.name] = bytearray()
+                elif isinstance(event, Data):
+                    if current_field is None:
+                        continue
+                    if current_field != 'video':
+                        fields[current_field] += event.data
+                        continue
+                    upload_queue.check_cancelled(upload_id)
+                    received += len(event.data)
+                    if received > file_size:
+                        raise ValueError(f"El archivo supera el tamaño declarado en X-Upload-Size ({file_size} bytes)")
+                    if not uploader.is_big:
+                        md5.update(event.data)
+                    content_hash.update(event.data)
+                    pending += event.data
+                    # Partes de 512KB exactos; la última sale al terminar los datos del archivo
+                    while len(pending) >= UPLOAD_PART_SIZE or (pending and not event.more_data):
+                        buffer.put(part_index, bytes(pending[:UPLOAD_PART_SIZE]))
+                        del pending[:UPLOAD_PART_SIZE]
+                        part_index += 1
+
+            if uploader is None:
+                upload_progress[upload_id]['status'] = 'error'
+                return jsonify({'error': 'No se encontró el archivo de video'}), 400
+            if received != file_size:
+                raise ValueError(f"Se recibieron {received} bytes pero X-Upload-Size indicaba {file_size}")
+            buffer.close()
+            uploader.join(timeout=max(600, int(file_size / (1024 * 1024) * 6)))
+
+            chat_id = fields.get('chat_id', b'').decode('utf-8') or 'me'
+            description = fields.get('description', b'').decode('utf-8')
+            upload_progress[upload_id]['message'] = 'Enviando video al chat...'
+            message = run_async(client.send_file(
+                int(chat_id) if chat_id != 'me' else 'me',
+                uploader.input_file('' if uploader.is_big else md5.hexdigest()),
+                caption=description or filename
+            ), client._loop, timeout=120)
+    except UploadCancelledError:
+        buffer.abort(UploadCancelledError(upload_id))
+        upload_progress[upload_id].update({'status': 'cancelled', 'message': 'Subida cancelada'})
+        return jsonify({'error': 'Subida cancelada', 'upload_id': upload_id}), 409
+    except Exception as e:
+        buffer.abort(e)
+        error_msg = f"{type(e).__name__}: {e}"
+        print(f"❌ [UPLOAD-STREAM] Error en la subida {upload_id}: {error_msg}", flush=True)
+        upload_progress[upload_id]['status'] = 'error'
+        upload_progress[upload_id]['error'] = error_msg
+        return jsonify({'error': error_msg, 'upload_id': upload_id}), 500
+    finally:
+        buffer.release()
+
+    elapsed = time.time() - started
+    print(f"✅ [UPLOAD-STREAM] {filename} subido en {elapsed:.1f}s ({file_size / (1024*1024) / max(elapsed, 0.001):.1f}MB/s, {buffer.spooled_bytes / (1024*1024):.1f}MB volcados a disco)", flush=True)
+    video_id = secrets.token_urlsafe(16)
+    chat_id_str = str(chat_id) if chat_id != 'me' else 'me'
+    if save_video_to_db(video_id, chat_id_str, message.id, filename, timestamp, file_size):
+        capture_video_assets(phone, video_id, getattr(message.media, 'document', None))
+    else:
+        print(f"⚠️ Error guardando video en DB, pero continuando...")
+    save_uploaded_document(content_hash.hexdigest(), file_size, phone, chat_id_str, message, video_id)
+    upload_progress[upload_id].update({'status': 'completed', 'progress': 100, 'current': file_size, 'video_id': video_id,
+                                       'message_id': message.id, 'chat_id': chat_id_str})
+    return jsonify({
+        'message': 'Video subido',
+        'upload_id': upload_id,
+        'video_id': video_id,
+        'view_url': f'/watch/{video_id}',
+        'status': 'completed'
+    })
+
+@app.route('/api/upload/resumable', methods=['POST'])
+def create_resumable_upload():
+    """Crear una subida reanudable (POST de creación de tus).
+
+    Headers: Upload-Length con el tamaño del archivo y, opcional, Upload-Metadata con
+    filename, chat_id y description en base64. Devuelve la URL de la subida en Location.
+    """
+    if 'phone' not in session:
+        return jsonify({'error': 'No estás conectado a Telegram'}), 401
+    try:
+        file_size = int(request.headers.get('Upload-Length', ''))
+    except ValueError:
+        return jsonify({'error': 'Falta el header Upload-Length con el tamaño del archivo'}), 400
+    try:
+        metadata = parse_tus_metadata(request.headers.get('Upload-Metadata'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if file_size <= 0:
+        return jsonify({'error': 'El archivo está vacío'}), 400
+    if file_size > UPLOAD_RESUMABLE_MAX_SIZE:
+        return jsonify({'error': 'El archivo supera el tamaño máximo de Telegram'}), 413
+
+    resumable_uploads.cleanup_expired()
+    filename = secure_filename(metadata.get('filename', '')) or 'video.mp4'
+    state = resumable_uploads.create(session['phone'], filename, file_size,
+                                     chat_id=metadata.get('chat_id') or 'me',
+                                     description=metadata.get('description', ''))
+    upload_url = f"/api/upload/resumable/{state['upload_id']}"
+    print(f"🆕 [UPLOAD-RESUMABLE] {filename}: {file_size / (1024*1024):.1f}MB en {state['total_parts']} partes ({state['upload_id']})", flush=True)
+    response = jsonify({'upload_id': state['upload_id'], 'upload_url': upload_url, 'offset': 0})
+    response.status_code = 201
+    response.headers['Location'] = upload_url
+    response.headers['Upload-Offset'] = '0'
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    return response
+
+@app.route('/api/upload/resumable/<upload_id>', methods=['GET', 'HEAD', 'PATCH', 'DELETE'])
+def resumable_upload(upload_id):
+    """HEAD: offset actual. PATCH: siguiente tramo desde Upload-Offset. GET: estado en JSON
+    ('processing' mientras upload_queue sube un MP4 guardado en disco). DELETE: cancelar la subida."""
+    if 'phone' not in session:
+        return jsonify({'error': 'No estás conectado a Telegram'}), 401
+    phone = session['phone']
+    state = resumable_uploads.load(upload_id)
+    if state is None or state['phone'] != phone:
+        return jsonify({'error': 'Subida no encontrada o caducada'}), 404
+
+    headers = {
+        'Upload-Offset': str(resumable_upload_offset(state)),
+        'Upload-Length': str(state['size']),
+        'Tus-Resumable': TUS_VERSION,
+        'Cache-Control': 'no-store',
+    }
+    if request.method == 'HEAD':
+        return Response(None, status=200, headers=headers)
+    if request.method == 'GET':
+        status, error = state['status'], state.get('error')
+        if resumable_processing_stale(state):
+            status, error = 'uploaded', 'La subida a Telegram se interrumpió, reanúdala para reintentarla'
+        return jsonify({
+            'upload_id': upload_id,
+            'offset': resumable_upload_offset(state),
+            'size': state['size'],
+            'status': status,
+            'error': error,
+            'video_id': state['video_id'],
+            'view_url': f"/watch/{state['video_id']}" if state['video_id'] else None,
+        }), 200, headers
+    if request.method == 'DELETE':
+        # Con el lock tomado, para que un PATCH en curso no vuelva a guardar (ni enviar al chat)
+        # la subida cancelada: al soltarlo, los PATCH que esperaban releen y no la encuentran
+        with resumable_uploads.locked(upload_id, UPLOAD_PART_TIMEOUT) as acquired:
+            if not acquired:
+                return jsonify({'error': 'La subida está ocupada por otra petición, reintenta la cancelación'}), 423, headers
+            resumable_uploads.delete(upload_id)
+        # Si estaba en upload_queue (faststart + subida desde disco), que no siga subiendo
+        if upload_queue.owner(upload_id) == phone:
+            upload_queue.cancel(upload_id)
+        print(f"🗑️ [UPLOAD-RESUMABLE] Subida {upload_id} cancelada", flush=True)
+        return Response(None, status=204, headers={'Tus-Resumable': TUS_VERSION})
+
+    if request.mimetype != 'application/offset+octet-stream':
+        return jsonify({'error': 'Se esperaba Content-Type application/offset+octet-stream'}), 415
+    # Un PATCH anterior puede seguir terminando de subir sus partes tras cortarse la conexión
+    with resumable_uploads.locked(upload_id, UPLOAD_PART_TIMEOUT) as acquired:
+        if not acquired:
+            return jsonify({'error': 'La subida está ocupada por otra petición'}), 423, headers
+        return patch_resumable_upload(upload_id, phone)
+
+def iter_request_body(length, upload_id):
+    """Leer hasta length bytes del cuerpo en trozos de una parte. Si se corta la conexión se
+    termina sin error: se guarda lo que llegó y el cliente sigue desde ahí."""
+    received = 0
+    while received < length:
+        try:
+            chunk = request.stream.read(min(UPLOAD_PART_SIZE, length - received))
+        except Exception as e:
+            print(f"📶 [UPLOAD-RESUMABLE] Conexión cortada en {upload_id} tras {received / (1024*1024):.1f}MB: {type(e).__name__}", flush=True)
+            return
+        if not chunk:
+            return
+        received += len(chunk)
+        yield chunk
+
+def forward_resumable_chunks(client, state, chunks, remaining, hasher):
+    """Reenviar a Telegram las partes completas que forman los chunks recibidos y dejar en
+    state['tail'] lo que aún no llena una parte"""
+    pending = bytearray(base64.b64decode(state['tail']))
+    part_index = state['parts_sent']
+    parts_put = 0
+    received = 0
+    buffer = UploadPartBuffer(UPLOAD_STREAM_MEMORY_BYTES)
+    uploader = TelegramPartUploader(client, buffer, state['size'], state['filename'], file_id=state['file_id'])
+    uploader.start()
+    try:
+        for chunk in chunks:
+            received += len(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            pending += chunk
+            last_data = received == remaining  # La última parte del archivo puede ser más corta
+            while len(pending) >= UPLOAD_PART_SIZE or (pending and last_data):
+                buffer.put(part_index, bytes(pending[:UPLOAD_PART_SIZE]))
+                del pending[:UPLOAD_PART_SIZE]
+                part_index += 1
+                parts_put += 1
+        buffer.close()
+        uploader.join(timeout=max(600, parts_put * UPLOAD_PART_TIMEOUT), expected_parts=parts_put)
+    except Exception as e:
+        buffer.abort(e)
+        raise
+    finally:
+        buffer.release()
+    state['parts_sent'] = part_index
+    state['tail'] = base64.b64encode(bytes(pending)).decode('ascii')
+
+def spool_resumable_chunks(upload_id, state, chunks, hasher):
+    """Añadir los chunks recibidos a <upload_id>.data a partir de state['spooled']"""
+    fd = os.open(resumable_uploads.data_path(upload_id), os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+b') as f:
+        # Descartar lo que un PATCH anterior escribiera sin llegar a guardarlo en el estado
+        f.truncate(state['spooled'])
+        f.seek(state['spooled'])
+        received = 0
+        for chunk in chunks:
+            f.write(chunk)
+            received += len(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    state['spooled'] += received
+
+def patch_resumable_upload(upload_id, phone):
+    """Recibir un tramo de una subida reanudable y reenviarlo a Telegram en partes (o
+    guardarlo en disco si el MP4 necesita faststart)"""
+    state = resumable_uploads.load(upload_id)  # Releer con el lock tomado
+    if state is None:
+        return jsonify({'error': 'Subida no encontrada o caducada'}), 404
+    current = resumable_upload_offset(state)
+    headers = {'Upload-Offset': str(current), 'Tus-Resumable': TUS_VERSION}
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Falta el header Upload-Offset'}), 400, headers
+    if offset != current:
+        return jsonify({'error': f'Upload-Offset {offset} no coincide con el offset actual {current}'}), 409, headers
+    if state['status'] == 'completed' or (state['status'] == 'processing' and not resumable_processing_stale(state)):
+        return Response(None, status=204, headers=headers)
+    remaining = state['size'] - current
+    if request.content_length is not None and request.content_length > remaining:
+        return jsonify({'error': 'El tramo supera el tamaño declarado en Upload-Length'}), 413, headers
+
+    client = get_or_create_client(phone)
+    if not client or not client.is_connected():
+        return jsonify({'error': 'No se pudo conectar a Telegram'}), 500, headers
+
+    if remaining > 0:
+        hasher = resumable_uploads.take_hasher(upload_id, current)
+        chunks = iter_request_body(remaining, upload_id)
+        if current == 0:
+            # El primer tramo decide: un MP4 con el moov al final se guarda en disco para
+            # aplicarle faststart antes de subirlo
+            first_chunk = next(chunks, b'')
+            state['spool'] = UPLOAD_FASTSTART_ENABLED and mp4_head_needs_faststart(first_chunk)
+            if state['spool']:
+                print(f"🎞️ [UPLOAD-RESUMABLE] {state['filename']} tiene el moov al final: se guarda en disco para aplicar faststart ({upload_id})", flush=True)
+            chunks = itertools.chain([first_chunk], chunks)
+        try:
+            if state['spool']:
+                spool_resumable_chunks(upload_id, state, chunks, hasher)
+            else:
+                # Las partes hacia Telegram cuentan en el límite de subidas simultáneas de la cuenta
+                with upload_queue.slot(phone, f'{upload_id}/{current}', timeout=UPLOAD_PART_TIMEOUT):
+                    forward_resumable_chunks(client, state, chunks, remaining, hasher)
+        except UploadSlotTimeoutError:
+            # Sin leer el tramo: el cliente lo reintenta desde el mismo offset
+            resumable_uploads.keep_hasher(upload_id, hasher, current)
+            return jsonify({'error': 'La cuenta ya tiene otras subidas en curso, reintenta en unos segundos'}), 423, {**headers, 'Retry-After': '5'}
+        except Exception as e:
+            # Nada avanza: el cliente reenvía el tramo (las partes que sí llegaron se sobrescriben)
+            error_msg = f"{type(e).__name__}: {e}"
+            print(f"❌ [UPLOAD-RESUMABLE] Error guardando el tramo de {upload_id}: {error_msg}", flush=True)
+            return jsonify({'error': error_msg}), 500, headers
+
+        current = resumable_upload_offset(state)
+        headers['Upload-Offset'] = str(current)
+        if current == state['size']:
+            state['status'] = 'uploaded'
+        resumable_uploads.save(state)
+        resumable_uploads.keep_hasher(upload_id, hasher, current)
+
+    if current < state['size']:
+        return Response(None, status=204, headers=headers)
+
+    if state['spool']:
+        # Faststart + subida en upload_queue; el cliente consulta el estado con GET
+        state['status'] = 'processing'
+        state['processing_started'] = time.time()
+        state.pop('error', None)
+        resumable_uploads.save(state)
+        upload_queue.submit(UploadJob(upload_id, phone, UPLOAD_PRIORITIES['normal'],
+                                      lambda: finish_spooled_resumable_upload(upload_id, phone, client)))
+        return Response(None, status=204, headers=headers)
+
+    # Archivo completo en Telegram: enviarlo al chat. Si falla, un PATCH vacío con el offset
+    # final lo reintenta sin volver a subir nada.
+    chat_id = state['chat_id']
+    filename = state['filename']
+    if state['is_big']:
+        input_file = InputFileBig(state['file_id'], state['total_parts'], filename)
+    else:
+        # El md5 es opcional para Telegram y no se puede calcular a lo largo de varios procesos
+        input_file = InputFile(state['file_id'], state['total_parts'], filename, '')
+    hasher = resumable_uploads.take_hasher(upload_id, state['size'])
+    try:
+        message = run_async(client.send_file(
+            telegram_chat(chat_id),
+            input_file,
+            caption=state['description'] or filename
+        ), client._loop, timeout=120)
+    except Exception as e:
+        error_msg = f"{type(e).__name__}: {e}"
+        print(f"❌ [UPLOAD-RESUMABLE] Error enviando {upload_id} al chat: {error_msg}", flush=True)
+        resumable_uploads.keep_hasher(upload_id, hasher, state['size'])
+        return jsonify({'error': error_msg}), 500, headers
+
+    complete_resumable_upload(upload_id, phone, state, message, hasher.hexdigest() if hasher is not None else None)
+    return Response(None, status=204, headers=headers)
+
+def complete_resumable_upload(upload_id, phone, state, message, content_hash):
+    """Registrar el video enviado al chat y marcar la subida como completada"""
+    video_id = secrets.token_urlsafe(16)
+    if save_video_to_db(video_id, str(state['chat_id']), message.id, state['filename'], int(state['created']), state['size']):
+        capture_video_assets(phone, video_id, getattr(message.media, 'document', None))
+    else:
+        print(f"⚠️ Error guardando video en DB, pero continuando...")
+    if content_hash:
+        save_uploaded_document(content_hash, state['size'], phone, state['chat_id'], message, video_id)
+    state['status'] = 'completed'
+    state['video_id'] = video_id
+    state['tail'] = ''
+    resumable_uploads.save(state)
+    print(f"✅ [UPLOAD-RESUMABLE] {state['filename']} completado en {time.time() - state['created']:.0f}s ({upload_id})", flush=True)
+
+def finish_spooled_resumable_upload(upload_id, phone, client):
+    """Trabajo de upload_queue para una subida reanudable guardada en disco: faststart, subida
+    de las partes en paralelo y envío al chat. Si falla, la subida vuelve a 'uploaded' y un
+    PATCH vacío con el offset final la vuelve a encolar."""
+    state = resumable_uploads.load(upload_id)
+    if state is None or state['status'] != 'processing':
+        return
+    path = resumable_uploads.data_path(upload_id)
+    try:
+        # El hash de dedup es el del archivo tal como llegó: si se perdió (reinicio) se recalcula
+        hasher = resumable_uploads.take_hasher(upload_id, state['size'])
+        if hasher is None and UPLOAD_DEDUP_ENABLED:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(UPLOAD_HASH_READ_SIZE), b''):
+                    hasher.update(block)
+        content_hash = hasher.hexdigest() if hasher is not None else None
+
+        upload_queue.check_cancelled(upload_id)
+        try:
+            mp4_faststart(path)
+        except Exception as faststart_error:
+            print(f"⚠️ [UPLOAD-RESUMABLE] No se pudo aplicar faststart, se sube el archivo original: {type(faststart_error).__name__}: {faststart_error}", flush=True)
+
+        if not client.is_connected():
+            raise ConnectionError('El cliente de Telegram se desconectó')
+
+        def progress_callback(current, total):
+            upload_queue.check_cancelled(upload_id)
+
+        async def upload():
+            input_file = await upload_file_parallel(client, path, progress_callback=progress_callback)
+            attributes, mime_type = get_attributes(path)
+            return input_file, attributes, mime_type
+
+        input_file, attributes, mime_type = run_async(upload(), client._loop, timeout=resumable_upload_timeout(state['size']))
+
+        # Enviar al chat con el lock: si la subida se canceló (DELETE) mientras tanto, no se publica
+        with resumable_uploads.locked(upload_id, UPLOAD_PART_TIMEOUT) as acquired:
+            state = resumable_uploads.load(upload_id) if acquired else None
+            if state is None or state['status'] != 'processing':
+                print(f"🚫 [UPLOAD-RESUMABLE] Subida {upload_id} cancelada antes de enviarla al chat", flush=True)
+                if acquired and state is None and os.path.exists(path):
+                    os.remove(path)  # faststart pudo volver a crear el archivo tras el DELETE
+                return
+            message = run_async(client.send_file(
+                telegram_chat(state['chat_id']),
+                input_file,
+                caption=state['description'] or state['filename'],
+                attributes=attributes,
+                mime_type=mime_type
+            ), client._loop, timeout=120)
+            complete_resumable_upload(upload_id, phone, state, message, content_hash)
+            os.remove(path)
+    except Exception as e:
+        error_msg = f"{type(e).__name__}: {e}"
+        print(f"❌ [UPLOAD-RESUMABLE] Error subiendo {upload_id} desde disco: {error_msg}", flush=True)
+        with resumable_uploads.locked(upload_id, UPLOAD_PART_TIMEOUT) as acquired:
+            state = resumable_uploads.load(upload_id) if acquired else None
+            if state is not None and state['status'] == 'processing':
+                state['status'] = 'uploaded'
+                state['error'] = 'Subida cancelada' if isinstance(e, UploadCancelledError) else error_msg
+                resumable_uploads.save(state)
+            elif acquired and state is None and os.path.exists(path):
+                os.remove(path)  # Cancelada mientras se subía: faststart pudo volver a crear el archivo
+
+@app.route('/api/upload/<upload_id>/cancel', methods=['POST'])
+def cancel_upload(upload_id):
+    """Cancelar una subida de /api/upload o /api/upload/stream, esté en cola o ya subiendo"""
+    if 'phone' not in session:
+        return jsonify({'error': 'No estás conectado a Telegram'}), 401
+    # Solo la cuenta que la creó (también mientras aún se recibe el archivo y no está en la cola)
+    if upload_id not in upload_progress or upload_progress[upload_id].get('phone') != session['phone']:
+        return jsonify({'error': 'Subida no encontrada'}), 404
+    if upload_progress[upload_id].get('status') in ('completed', 'error', 'cancelled'):
+        return jsonify({'error': 'La subida ya terminó', 'status': upload_progress[upload_id]['status']}), 409
+    status = upload_queue.cancel(upload_id)
+    if status != 'cancelled':
+        upload_progress[upload_id]['message'] = 'Cancelando subida...'
+    return jsonify({'upload_id': upload_id, 'status': status})
+
 @app.route('/api/upload/progress/<upload_id>', methods=['GET'])
 def get_upload_progress(upload_id):
     """Obtener progreso de subida"""
@@ -2535,6 +6330,12 @@ def get_upload_progress(upload_id):
     
     if upload_id in upload_progress:
         progress_data = upload_progress[upload_id].copy()
+        progress_data.pop('phone', None)
+        if progress_data.get('status') == 'queued':
+            position = upload_queue.position(upload_id)
+            if position:
+                progress_data['queue_position'] = position
+                progress_data['message'] = f'En cola para subir a Telegram (posición {position})...'
         return jsonify(progress_data)
     
     # Si no se encuentra, puede ser que aún no se haya inicializado
@@ -2557,7 +6358,19 @@ def watch_video(video_id):
 
 @app.route('/api/video/<video_id>/thumbnail')
 def get_video_thumbnail(video_id):
-    """Obtener la miniatura del video (como Telegram Web)"""
+    """Obtener la miniatura del video (como Telegram Web). ?size=small|large (por defecto large)"""
+    variant = request.args.get('size', 'large')
+    if variant not in THUMBNAIL_VARIANTS:
+        return jsonify({'error': f"size debe ser uno de: {', '.join(THUMBNAIL_VARIANTS)}"}), 400
+    
+    # Miniatura ya capturada: se sirve desde disco sin MySQL ni Telegram
+    metadata = video_metadata_cache.get(video_id)
+    doc_id = metadata['doc_id'] if metadata else thumbnail_cache.document_for_video(video_id)
+    if doc_id:
+        cached = thumbnail_cache.get(doc_id, variant)
+        if cached:
+            return thumbnail_response(cached, doc_id, variant)
+    
     video_info = get_video_from_db(video_id)
     if not video_info:
         return jsonify({'error': 'Video no encontrado'}), 404
@@ -2627,21 +6440,17 @@ def get_video_thumbnail(video_id):
             
             messages = await client.get_messages(actual_target_chat, ids=message_id)
             if not messages or not messages.media:
-                return None
+                return None, None
             
             # Intentar obtener thumbnail del video
             if hasattr(messages.media, 'document'):
                 document = messages.media.document
-                # Descargar thumbnail usando download_media con thumb=True
+                # Descargar las miniaturas del documento y guardarlas en disco para las próximas veces
                 try:
-                    thumb_data = await client.download_media(messages, thumb=-1)  # -1 = thumbnail más grande disponible
+                    thumbnail_cache.link_video(video_id, document.id, document.size)
+                    thumb_data = (await capture_document_thumbnails(client, document)).get(variant)
                     if thumb_data:
-                        if isinstance(thumb_data, bytes):
-                            return thumb_data
-                        elif isinstance(thumb_data, str):
-                            # Si es un path, leer el archivo
-                            with open(thumb_data, 'rb') as f:
-                                return f.read()
+                        return document.id, thumb_data
                 except Exception as e:
                     print(f"⚠️ Error descargando thumbnail: {e}")
                     # Si falla, intentar obtener el primer frame del video
@@ -2665,14 +6474,16 @@ def get_video_thumbnail(video_id):
                             limit=thumbnail_limit
                         ))
                         if hasattr(result, 'bytes'):
-                            return result.bytes[:1024 * 1024]  # Solo primeros 1MB para thumbnail
+                            return None, result.bytes[:1024 * 1024]  # Solo primeros 1MB para thumbnail
                     except:
                         pass
             
-            return None
+            return None, None
         
         try:
-            thumbnail_data = run_async(get_thumbnail(), client_loop, timeout=30)
+            thumbnail_doc_id, thumbnail_data = run_async(get_thumbnail(), client_loop, timeout=30)
+            if thumbnail_data and thumbnail_doc_id:
+                return thumbnail_response(thumbnail_data, thumbnail_doc_id, variant)
             if thumbnail_data:
                 return Response(thumbnail_data, mimetype='image/jpeg')
             else:
@@ -2688,6 +6499,262 @@ def get_video_thumbnail(video_id):
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/video/<video_id>/previews.vtt')
+def get_video_seek_preview_vtt(video_id):
+    """Índice WebVTT del sprite de vista previa (los cues apuntan a previews.jpg#xywh=...)"""
+    return serve_seek_preview_file(video_id, 'previews.vtt', 'text/vtt')
+
+@app.route('/api/video/<video_id>/previews.jpg')
+def get_video_seek_preview_sprite(video_id):
+    """Sprite con los fotogramas de vista previa del video"""
+    return serve_seek_preview_file(video_id, 'previews.jpg', 'image/jpeg')
+
+def serve_seek_preview_file(video_id, name, mimetype):
+    """Servir un archivo del sprite desde disco; si no existe todavía, encolar su generación"""
+    metadata = video_metadata_cache.get(video_id)
+    doc_id = metadata['doc_id'] if metadata else thumbnail_cache.document_for_video(video_id)
+    if doc_id and os.path.exists(seek_preview_path(doc_id, name)):
+        response = send_file(os.path.abspath(seek_preview_path(doc_id, name)), mimetype=mimetype, max_age=31536000)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+    if not seek_preview_queue.available:
+        return jsonify({'error': 'Las vistas previas no están activadas en el servidor'}), 404
+    if doc_id and (seek_preview_known(doc_id) or seek_preview_queue.pending(doc_id)):
+        return jsonify({'error': 'Vista previa no disponible', 'pending': seek_preview_queue.pending(doc_id)}), 404
+    
+    phone = get_video_request_phone()
+    if not phone:
+        return jsonify({'error': 'No se pudo acceder al video. Por favor, inicia sesión o verifica la configuración del servidor.'}), 401
+    try:
+        client = get_or_create_client(phone)
+        if not client or not client.is_connected():
+            return jsonify({'error': 'No se pudo conectar a Telegram'}), 500
+        document, _ = resolve_video_document(client, video_id)
+        if document is None:
+            return jsonify({'error': 'Video no encontrado'}), 404
+        thumbnail_cache.link_video(video_id, document.id, document.size)
+        queued = seek_preview_queue.submit(phone, video_id, document)
+        return jsonify({'error': 'Vista previa en preparación', 'pending': queued or seek_preview_queue.pending(document.id)}), 404
+    except Exception as e:
+        print(f"❌ Error en serve_seek_preview_file: {e}")
+        return jsonify({'error': str(e)}), 500
+
+THUMBNAIL_BATCH_MAX_IDS = 100  # Máximo de video_ids por petición a /api/thumbnails
+THUMBNAIL_BATCH_CONCURRENCY = 8  # Descargas de miniaturas simultáneas dentro de un lote
+
+@app.route('/api/thumbnails', methods=['POST'])
+def get_video_thumbnails_batch():
+    """Miniaturas de muchos videos en una sola petición (listado de un chat).
+
+    Body JSON: {"video_ids": [...], "size": "small"|"large"}. Las que están en disco se
+    devuelven directamente; el resto se agrupa por chat, se resuelve con un get_messages
+    por chat y se descarga en paralelo. Respuesta: {"thumbnails": {video_id: data URI o null}}.
+    """
+    data = request.get_json(silent=True) or {}
+    video_ids = [str(v) for v in (data.get('video_ids') or []) if v][:THUMBNAIL_BATCH_MAX_IDS]
+    variant = data.get('size', 'large')
+    if variant not in THUMBNAIL_VARIANTS:
+        return jsonify({'error': f"size debe ser uno de: {', '.join(THUMBNAIL_VARIANTS)}"}), 400
+    
+    def data_uri(thumb_bytes):
+        return f"data:image/jpeg;base64,{base64.b64encode(thumb_bytes).decode('ascii')}"
+    
+    thumbnails = {}
+    missing = []
+    for video_id in video_ids:
+        metadata = video_metadata_cache.get(video_id)
+        doc_id = metadata['doc_id'] if metadata else thumbnail_cache.document_for_video(video_id)
+        cached = thumbnail_cache.get(doc_id, variant) if doc_id else None
+        if cached:
+            thumbnails[video_id] = data_uri(cached)
+        elif doc_id and thumbnail_cache.known(doc_id, variant):
+            thumbnails[video_id] = None  # El documento no tiene miniatura
+        else:
+            missing.append(video_id)
+    
+    if missing:
+        phone = get_video_request_phone()
+        if not phone:
+            return jsonify({'error': 'No se pudo acceder a los videos. Por favor, inicia sesión o verifica la configuración del servidor.'}), 401
+        
+        # Agrupar por chat: un solo get_messages(ids=[...]) por chat
+        videos_info = get_videos_from_db(missing)
+        by_chat = {}
+        for video_id in missing:
+            info = videos_info.get(video_id)
+            if not info:
+                thumbnails[video_id] = None
+                continue
+            by_chat.setdefault(info.get('chat_id', 'me'), []).append((video_id, info['message_id']))
+        
+        try:
+            client = get_or_create_client(phone)
+            if not client or not client.is_connected():
+                return jsonify({'error': 'No se pudo conectar a Telegram'}), 500
+            client_loop = client._loop
+            if not client_loop or client_loop.is_closed():
+                return jsonify({'error': 'Error de conexión'}), 500
+            
+            async def fetch_batch():
+                semaphore = asyncio.Semaphore(THUMBNAIL_BATCH_CONCURRENCY)
+                results = {}
+                
+                async def capture(video_id, document):
+                    async with semaphore:
+                        try:
+                            thumbnail_cache.link_video(video_id, document.id, document.size)
+                            results[video_id] = (await capture_document_thumbnails(client, document)).get(variant)
+                        except Exception as e:
+                            print(f"⚠️ [THUMBNAILS] Error descargando miniatura de {video_id}: {type(e).__name__}: {e}")
+                            results[video_id] = None
+                
+                async def resolve_chat(chat_id, entries):
+                    target_chat = int(chat_id) if chat_id != 'me' and str(chat_id).lstrip('-').isdigit() else 'me'
+                    if target_chat != 'me':
+                        try:
+                            target_chat = await client.get_entity(target_chat)
+                        except Exception as entity_error:
+                            print(f"⚠️ [THUMBNAILS] No se pudo obtener entidad para {chat_id}, usando directamente: {entity_error}")
+                    messages = await client.get_messages(target_chat, ids=[message_id for _, message_id in entries])
+                    tasks = []
+                    for (video_id, _), message in zip(entries, messages):
+                        document = getattr(getattr(message, 'media', None), 'document', None) if message else None
+                        if document is None:
+                            results[video_id] = None
+                        else:
+                            tasks.append(capture(video_id, document))
+                    await asyncio.gather(*tasks)
+                
+                chat_results = await asyncio.gather(*(resolve_chat(chat_id, entries) for chat_id, entries in by_chat.items()), return_exceptions=True)
+                for (chat_id, entries), chat_result in zip(by_chat.items(), chat_results):
+                    if isinstance(chat_result, Exception):
+                        print(f"⚠️ [THUMBNAILS] Error resolviendo mensajes del chat {chat_id}: {type(chat_result).__name__}: {chat_result}")
+                        for video_id, _ in entries:
+                            results.setdefault(video_id, None)
+                return results
+            
+            if by_chat:
+                print(f"🖼️ [THUMBNAILS] {len(missing)} miniatura(s) sin caché en {len(by_chat)} chat(s)", flush=True)
+                for video_id, thumb_bytes in run_async(fetch_batch(), client_loop, timeout=THUMBNAIL_CAPTURE_TIMEOUT).items():
+                    thumbnails[video_id] = data_uri(thumb_bytes) if thumb_bytes else None
+        except asyncio.TimeoutError:
+            print(f"⏱️ [THUMBNAILS] Timeout descargando miniaturas, devolviendo las que hay", flush=True)
+        except Exception as e:
+            print(f"❌ Error en get_video_thumbnails_batch: {e}")
+            import traceback
+            print(traceback.format_exc())
+            return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'thumbnails': thumbnails})
+
+def video_viewer_id():
+    """Identificador del espectador para el reparto de descargas (IP real detrás de nginx)"""
+    return request.headers.get('X-Real-IP') or request.remote_addr or 'anonimo'
+
+def get_video_request_phone():
+    """Teléfono con el que servir un video: el de la sesión o, para enlaces públicos compartidos,
+    el de la configuración guardada del servidor (que se copia a la sesión)."""
+    phone = session.get('phone')
+    if phone:
+        return phone
+    saved_config = load_saved_config()
+    if not saved_config or not saved_config.get('phone'):
+        return None
+    phone = saved_config['phone']
+    session.permanent = True
+    session['phone'] = phone
+    session['api_id'] = saved_config.get('api_id')
+    session['api_hash'] = saved_config.get('api_hash')
+    session['session_name'] = saved_config.get('session_name', f"sessions/{secure_filename(phone)}")
+    return phone
+
+def load_video_hls(video_id):
+    """Cliente, documento y modelo HLS de un video para las rutas HLS.
+    Devuelve ((client, client_loop, document, hls), None) o (None, respuesta de error)."""
+    phone = get_video_request_phone()
+    if not phone:
+        return None, (jsonify({'error': 'No se pudo acceder al video. Por favor, inicia sesión o verifica la configuración del servidor.'}), 401)
+    
+    client = get_or_create_client(phone)
+    if not client or not client.is_connected():
+        return None, (jsonify({'error': 'No se pudo conectar a Telegram'}), 500)
+    
+    client_loop = client._loop
+    if not client_loop or client_loop.is_closed():
+        return None, (jsonify({'error': 'Error de conexión'}), 500)
+    
+    document, metadata = resolve_video_document(client, video_id)
+    if document is None:
+        return None, (jsonify({'error': 'Video no encontrado'}), 404)
+    
+    hls = build_document_hls(client, client_loop, document, video_id, metadata, timeout=VIDEO_CHUNK_FETCH_TIMEOUT,
+                             viewer=video_viewer_id(), priority=DOWNLOAD_PRIORITY_INTERACTIVE)
+    if not hls:
+        return None, (jsonify({'error': 'El video no es un MP4 con índice de muestras utilizable para HLS'}), 415)
+    return (client, client_loop, document, hls), None
+
+HLS_RESPONSE_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Cache-Control': 'public, max-age=3600',
+}
+
+@app.route('/api/video/<video_id>/index.m3u8')
+def get_video_hls(video_id):
+    """Playlist HLS del video: segmentos fMP4 alineados a keyframes, remuxados al vuelo"""
+    try:
+        context, error = load_video_hls(video_id)
+        if error:
+            return error
+        _, _, _, hls = context
+        print(f"📺 Playlist HLS de {video_id}: {len(hls['segments'])} segmentos", flush=True)
+        playlist = render_hls_playlist(f'/api/video/{video_id}/hls', hls)
+        return Response(playlist, mimetype='application/vnd.apple.mpegurl', headers=HLS_RESPONSE_HEADERS)
+    except Exception as e:
+        print(f"❌ Error generando playlist HLS de {video_id}: {type(e).__name__}: {e}")
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/video/<video_id>/hls/init.mp4')
+def get_video_hls_init(video_id):
+    """Segmento de inicialización HLS (ftyp + moov sin muestras con mvex)"""
+    try:
+        context, error = load_video_hls(video_id)
+        if error:
+            return error
+        _, _, _, hls = context
+        return Response(hls['init'], mimetype='video/mp4', headers=HLS_RESPONSE_HEADERS)
+    except Exception as e:
+        print(f"❌ Error generando init HLS de {video_id}: {type(e).__name__}: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/video/<video_id>/hls/<int:index>.m4s')
+def get_video_hls_segment(video_id, index):
+    """Segmento HLS fMP4 (moof + mdat) con las muestras de video y audio de ese tramo"""
+    try:
+        context, error = load_video_hls(video_id)
+        if error:
+            return error
+        client, client_loop, document, hls = context
+        if index >= len(hls['segments']):
+            return jsonify({'error': 'Segmento no encontrado'}), 404
+        _, ranges = hls['segments'][index]
+        viewer = video_viewer_id()
+
+        def read_range(start, end):
+            return read_document_range(client, client_loop, document, document.id, start, end, timeout=VIDEO_CHUNK_FETCH_TIMEOUT,
+                                       viewer=viewer, priority=DOWNLOAD_PRIORITY_INTERACTIVE)
+
+        sample_data = read_hls_samples(read_range, hls['tracks'], ranges)
+        segment = build_fmp4_segment(index + 1, hls['tracks'], ranges, sample_data)
+        print(f"📺 Segmento HLS {index} de {video_id}: {len(segment)} bytes", flush=True)
+        return Response(segment, mimetype='video/iso.segment', headers=HLS_RESPONSE_HEADERS)
+    except Exception as e:
+        print(f"❌ Error generando segmento HLS {index} de {video_id}: {type(e).__name__}: {e}")
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/video/<video_id>', methods=['GET', 'HEAD', 'OPTIONS'])
 def get_video(video_id):
     """Obtener el video directamente desde la nube de Telegram (sin caché)"""
@@ -2703,7 +6770,7 @@ def get_video(video_id):
         return '', 200, {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
-            'Access-Control-Allow-Headers': 'Range, Content-Range, Content-Length',
+            'Access-Control-Allow-Headers': 'Range, Content-Range, Content-Length, If-None-Match, If-Range',
             'Access-Control-Max-Age': '3600',
         }
     
@@ -2716,27 +6783,31 @@ def get_video(video_id):
         if range_header:
             print(f"📥 Range request: {range_header}", flush=True)
         
-        # Verificar conexión a base de datos primero
-        try:
-            video_info = get_video_from_db(video_id)
-        except Exception as db_error:
-            error_type = type(db_error).__name__
-            error_msg = str(db_error)
-            print(f"❌ ERROR DE BASE DE DATOS obteniendo video {video_id}: {error_type}: {error_msg}")
-            import traceback
-            print(traceback.format_exc())
-            return jsonify({
-                'error': f'Error de conexión a la base de datos: {error_msg}',
-                'error_type': error_type,
-                'video_id': video_id,
-                'suggestion': 'Verifica que MySQL esté ejecutándose y que la configuración de la base de datos sea correcta.'
-            }), 500
+        video_metadata = video_metadata_cache.get(video_id)
+        if video_metadata:
+            video_info = {'chat_id': video_metadata['chat_id'], 'message_id': video_metadata['message_id']}
+        else:
+            # Verificar conexión a base de datos primero
+            try:
+                video_info = get_video_from_db(video_id)
+            except Exception as db_error:
+                error_type = type(db_error).__name__
+                error_msg = str(db_error)
+                print(f"❌ ERROR DE BASE DE DATOS obteniendo video {video_id}: {error_type}: {error_msg}")
+                import traceback
+                print(traceback.format_exc())
+                return jsonify({
+                    'error': f'Error de conexión a la base de datos: {error_msg}',
+                    'error_type': error_type,
+                    'video_id': video_id,
+                    'suggestion': 'Verifica que MySQL esté ejecutándose y que la configuración de la base de datos sea correcta.'
+                }), 500
         
-        if not video_info:
-            print(f"❌ Video {video_id} no encontrado en la base de datos")
-            return jsonify({'error': 'Video no encontrado'}), 404
+            if not video_info:
+                print(f"❌ Video {video_id} no encontrado en la base de datos")
+                return jsonify({'error': 'Video no encontrado'}), 404
         
-        print(f"✅ Video encontrado en DB: chat_id={video_info.get('chat_id')}, message_id={video_info.get('message_id')}")
+            print(f"✅ Video encontrado en DB: chat_id={video_info.get('chat_id')}, message_id={video_info.get('message_id')}")
         
         # Primero intentar usar sesión activa (para mantener compatibilidad)
         # Si no hay sesión, usar configuración guardada (para videos públicos compartidos)
@@ -2777,6 +6848,18 @@ def get_video(video_id):
                 'suggestion': 'Inicia sesión en la aplicación o verifica que el servidor esté configurado correctamente.'
             }), 401
         
+        # Con los metadatos en caché, las peticiones condicionales, los HEAD y los rangos ya
+        # cacheados se responden sin cliente de Telegram. Un HEAD sin caché se responde con el
+        # documento enlazado en disco (mismo ETag que el GET); si no se conoce, va por Telegram
+        if video_metadata:
+            cached_response = serve_video_from_cache(video_metadata['size'], video_metadata.get('mime_type'), video_metadata['doc_id'], range_header)
+            if cached_response is not None:
+                return cached_response
+        elif request.method == 'HEAD':
+            linked_doc_id, linked_size = thumbnail_cache.linked_document(video_id)
+            if linked_doc_id and linked_size:
+                return serve_video_from_cache(linked_size, video_mime_from_filename(video_info.get('filename')), linked_doc_id, range_header)
+        
         # Obtener cliente de Telegram (phone ya está obtenido de sesión o configuración guardada)
         # Si usamos configuración guardada, asegurarnos de que los valores estén en la sesión
         try:
@@ -2904,163 +6987,197 @@ def get_video(video_id):
             print(f"⚠️ Error verificando autenticación: {auth_check_error}")
             # Continuar de todas formas, el error se capturará más adelante
         
-        # Para canales, necesitamos obtener la entidad primero y hacerla disponible en todo el scope
-        # Esto se hace aquí fuera de las funciones async para que esté disponible en download_initial_chunk también
-        async def get_target_chat_entity():
-            actual_target_chat = target_chat
-            try:
-                # Si target_chat es un número, intentar obtener como entidad (necesario para canales)
-                if isinstance(target_chat, int) or (isinstance(target_chat, str) and target_chat.isdigit()):
-                    entity = await client.get_entity(int(target_chat))
-                    actual_target_chat = entity
-                    print(f"✅ Entidad obtenida para chat {target_chat}: {type(entity).__name__}")
-            except Exception as entity_error:
-                # Si falla obtener entidad, usar target_chat directamente (chats normales)
-                print(f"⚠️ No se pudo obtener entidad para {target_chat}, usando directamente: {entity_error}")
+        # Si el documento ya está resuelto en la caché de metadatos, no hace falta
+        # get_entity ni get_messages: se va directo a los bytes
+        if video_metadata:
+            video_document = document_from_metadata(video_metadata)
+            file_size = video_metadata['size']
+            mime_type = video_metadata.get('mime_type')
+            print(f"⚡ Metadatos del video {video_id} servidos desde caché (doc_id={video_document.id})", flush=True)
+        else:
+            # Para canales, necesitamos obtener la entidad primero y hacerla disponible en todo el scope
+            # Esto se hace aquí fuera de las funciones async para que esté disponible en download_initial_chunk también
+            async def get_target_chat_entity():
                 actual_target_chat = target_chat
-            return actual_target_chat
+                try:
+                    # Si target_chat es un número, intentar obtener como entidad (necesario para canales)
+                    if isinstance(target_chat, int) or (isinstance(target_chat, str) and target_chat.isdigit()):
+                        entity = await client.get_entity(int(target_chat))
+                        actual_target_chat = entity
+                        print(f"✅ Entidad obtenida para chat {target_chat}: {type(entity).__name__}")
+                except Exception as entity_error:
+                    # Si falla obtener entidad, usar target_chat directamente (chats normales)
+                    print(f"⚠️ No se pudo obtener entidad para {target_chat}, usando directamente: {entity_error}")
+                    actual_target_chat = target_chat
+                return actual_target_chat
         
-        # Obtener la entidad del chat (importante para canales)
-        try:
-            actual_target_chat = run_async(get_target_chat_entity(), client_loop, timeout=15)
-        except Exception as e:
-            print(f"⚠️ Error obteniendo entidad del chat, usando target_chat original: {e}")
-            actual_target_chat = target_chat
+            # Obtener la entidad del chat (importante para canales)
+            try:
+                actual_target_chat = run_async(get_target_chat_entity(), client_loop, timeout=15)
+            except Exception as e:
+                print(f"⚠️ Error obteniendo entidad del chat, usando target_chat original: {e}")
+                actual_target_chat = target_chat
         
-        # Obtener información del mensaje y el archivo
-        async def get_video_info():
-            print(f"🔍 Obteniendo mensaje {message_id} del chat {actual_target_chat}...")
+            # Obtener información del mensaje y el archivo
+            async def get_video_info():
+                print(f"🔍 Obteniendo mensaje {message_id} del chat {actual_target_chat}...")
             
-            # Intentar obtener el mensaje específico
-            messages = await client.get_messages(actual_target_chat, ids=message_id)
+                # Intentar obtener el mensaje específico
+                messages = await client.get_messages(actual_target_chat, ids=message_id)
             
-            # Si no se encuentra, buscar en los mensajes recientes (como Telegram hace)
-            if not messages:
-                print(f"⚠️ Mensaje {message_id} no encontrado directamente, buscando en mensajes recientes...")
-                try:
-                    # Buscar en los últimos 100 mensajes del chat
-                    async for message in client.iter_messages(actual_target_chat, limit=100):
-                        if message.id == message_id and message.media:
-                            messages = message
-                            print(f"✅ Mensaje {message_id} encontrado en búsqueda reciente")
-                            break
-                except Exception as e:
-                    print(f"⚠️ Error buscando mensaje: {e}")
+                # Si no se encuentra, buscar en los mensajes recientes (como Telegram hace)
+                if not messages:
+                    print(f"⚠️ Mensaje {message_id} no encontrado directamente, buscando en mensajes recientes...")
+                    try:
+                        # Buscar en los últimos 100 mensajes del chat
+                        async for message in client.iter_messages(actual_target_chat, limit=100):
+                            if message.id == message_id and message.media:
+                                messages = message
+                                print(f"✅ Mensaje {message_id} encontrado en búsqueda reciente")
+                                break
+                    except Exception as e:
+                        print(f"⚠️ Error buscando mensaje: {e}")
             
-            if not messages:
-                print(f"⚠️ Mensaje {message_id} no encontrado en chat {actual_target_chat}")
-                return None, None, None
+                if not messages:
+                    print(f"⚠️ Mensaje {message_id} no encontrado en chat {actual_target_chat}")
+                    return None, None, None
             
-            if not messages.media:
-                print(f"⚠️ Mensaje {message_id} no tiene media")
-                return None, None, None
+                if not messages.media:
+                    print(f"⚠️ Mensaje {message_id} no tiene media")
+                    return None, None, None
             
-            print(f"✅ Mensaje {message_id} obtenido, tiene media: {type(messages.media).__name__}")
+                print(f"✅ Mensaje {message_id} obtenido, tiene media: {type(messages.media).__name__}")
             
-            # Obtener el documento del mensaje
-            if hasattr(messages.media, 'document'):
-                document = messages.media.document
-                file_size = document.size
-                # Obtener el mime_type real del documento
-                mime_type = 'video/mp4'  # Fallback por defecto
-                if hasattr(document, 'mime_type') and document.mime_type:
-                    mime_type = document.mime_type
-                    # Asegurarse de que es un tipo de video válido
-                    if not mime_type.startswith('video/'):
-                        # Si no es video, intentar detectar por extensión del nombre
-                        if hasattr(document, 'attributes'):
-                            for attr in document.attributes:
-                                if hasattr(attr, 'file_name') and attr.file_name:
-                                    filename = attr.file_name.lower()
-                                    if filename.endswith('.mp4'):
-                                        mime_type = 'video/mp4'
-                                    elif filename.endswith('.webm'):
-                                        mime_type = 'video/webm'
-                                    elif filename.endswith('.mkv'):
-                                        mime_type = 'video/x-matroska'
-                                    elif filename.endswith('.avi'):
-                                        mime_type = 'video/x-msvideo'
-                                    break
-                        # Si aún no es video, usar mp4 como fallback
+                # Obtener el documento del mensaje
+                if hasattr(messages.media, 'document'):
+                    document = messages.media.document
+                    file_size = document.size
+                    # Obtener el mime_type real del documento
+                    mime_type = 'video/mp4'  # Fallback por defecto
+                    if hasattr(document, 'mime_type') and document.mime_type:
+                        mime_type = document.mime_type
+                        # Asegurarse de que es un tipo de video válido
                         if not mime_type.startswith('video/'):
-                            mime_type = 'video/mp4'
+                            # Si no es video, intentar detectar por extensión del nombre
+                            if hasattr(document, 'attributes'):
+                                for attr in document.attributes:
+                                    if hasattr(attr, 'file_name') and attr.file_name:
+                                        filename = attr.file_name.lower()
+                                        if filename.endswith('.mp4'):
+                                            mime_type = 'video/mp4'
+                                        elif filename.endswith('.webm'):
+                                            mime_type = 'video/webm'
+                                        elif filename.endswith('.mkv'):
+                                            mime_type = 'video/x-matroska'
+                                        elif filename.endswith('.avi'):
+                                            mime_type = 'video/x-msvideo'
+                                        break
+                            # Si aún no es video, usar mp4 como fallback
+                            if not mime_type.startswith('video/'):
+                                mime_type = 'video/mp4'
                 
-                # Actualizar el message_id en la base de datos si cambió (por si Telegram lo actualizó)
-                if messages.id != message_id:
-                    print(f"⚠️ Message ID cambió: {message_id} -> {messages.id}, actualizando DB...")
-                    try:
-                        with get_db_connection() as conn:
-                            with conn.cursor() as cursor:
-                                cursor.execute(
-                                    "UPDATE videos SET message_id = %s WHERE video_id = %s",
-                                    (messages.id, video_id)
-                                )
-                                conn.commit()
-                        print(f"✅ Message ID actualizado en DB")
-                    except Exception as e:
-                        print(f"⚠️ Error actualizando message_id: {e}")
+                    # Actualizar el message_id en la base de datos si cambió (por si Telegram lo actualizó)
+                    if messages.id != message_id:
+                        print(f"⚠️ Message ID cambió: {message_id} -> {messages.id}, actualizando DB...")
+                        try:
+                            with get_db_connection() as conn:
+                                with conn.cursor() as cursor:
+                                    cursor.execute(
+                                        "UPDATE videos SET message_id = %s WHERE video_id = %s",
+                                        (messages.id, video_id)
+                                    )
+                                    conn.commit()
+                            print(f"✅ Message ID actualizado en DB")
+                        except Exception as e:
+                            print(f"⚠️ Error actualizando message_id: {e}")
                 
-                return messages, file_size, mime_type
+                    return messages, file_size, mime_type
             
-            return None, None, None
+                return None, None, None
         
-        # Aumentar timeout para obtener información del video (60 segundos)
-        try:
-            messages, file_size, mime_type = run_async(get_video_info(), client_loop, timeout=60)
-        except asyncio.TimeoutError:
-            print(f"⏱️ Timeout al obtener información del video {video_id} desde Telegram")
-            return jsonify({'error': 'Tiempo de espera agotado al obtener el video. Intenta más tarde.'}), 504
-        except Exception as e:
-            error_type = type(e).__name__
-            error_msg = str(e)
-            import traceback
-            traceback_str = traceback.format_exc()
-            print(f"❌ Error al obtener información del video {video_id}: {error_type}: {error_msg}")
-            print(traceback_str)
+            # Aumentar timeout para obtener información del video (60 segundos)
+            try:
+                messages, file_size, mime_type = run_async(get_video_info(), client_loop, timeout=60)
+            except asyncio.TimeoutError:
+                print(f"⏱️ Timeout al obtener información del video {video_id} desde Telegram")
+                return jsonify({'error': 'Tiempo de espera agotado al obtener el video. Intenta más tarde.'}), 504
+            except Exception as e:
+                error_type = type(e).__name__
+                error_msg = str(e)
+                import traceback
+                traceback_str = traceback.format_exc()
+                print(f"❌ Error al obtener información del video {video_id}: {error_type}: {error_msg}")
+                print(traceback_str)
             
-            # Manejar específicamente el error de autenticación
-            if 'AuthKeyUnregisteredError' in error_type or 'not registered' in error_msg.lower():
-                return jsonify({
-                    'error': 'La sesión de Telegram no está autenticada. Por favor, inicia sesión nuevamente en la aplicación.',
-                    'error_type': 'AuthKeyUnregisteredError',
-                    'video_id': video_id,
-                    'suggestion': 'Inicia sesión en la aplicación web para autenticar la sesión de Telegram. Si el problema persiste, puede ser necesario eliminar los archivos de sesión y volver a autenticarse.'
-                }), 401
+                # Manejar específicamente el error de autenticación
+                if 'AuthKeyUnregisteredError' in error_type or 'not registered' in error_msg.lower():
+                    return jsonify({
+                        'error': 'La sesión de Telegram no está autenticada. Por favor, inicia sesión nuevamente en la aplicación.',
+                        'error_type': 'AuthKeyUnregisteredError',
+                        'video_id': video_id,
+                        'suggestion': 'Inicia sesión en la aplicación web para autenticar la sesión de Telegram. Si el problema persiste, puede ser necesario eliminar los archivos de sesión y volver a autenticarse.'
+                    }), 401
             
-            # Devolver un mensaje de error más descriptivo
-            error_response = {
-                'error': f'Error al obtener información del video: {error_msg}',
-                'error_type': error_type,
-                'video_id': video_id
-            }
+                # Devolver un mensaje de error más descriptivo
+                error_response = {
+                    'error': f'Error al obtener información del video: {error_msg}',
+                    'error_type': error_type,
+                    'video_id': video_id
+                }
             
-            # Si es un error de event loop, sugerir recargar
-            if 'event loop' in error_msg.lower() or 'asyncio' in error_msg.lower():
-                error_response['suggestion'] = 'Por favor, recarga la página e intenta de nuevo.'
+                # Si es un error de event loop, sugerir recargar
+                if 'event loop' in error_msg.lower() or 'asyncio' in error_msg.lower():
+                    error_response['suggestion'] = 'Por favor, recarga la página e intenta de nuevo.'
             
-            return jsonify(error_response), 500
+                return jsonify(error_response), 500
         
-        if not messages:
-            print(f"⚠️ No se pudo obtener el mensaje del video {video_id} desde Telegram")
-            return jsonify({'error': 'No se pudo obtener el video desde Telegram'}), 500
+            if not messages:
+                print(f"⚠️ No se pudo obtener el mensaje del video {video_id} desde Telegram")
+                return jsonify({'error': 'No se pudo obtener el video desde Telegram'}), 500
+
+            video_document = messages.media.document
+            thumbnail_cache.link_video(video_id, video_document.id, video_document.size)
+            video_metadata_cache.put(video_id, {
+                **document_metadata(video_document),
+                'mime_type': mime_type or 'video/mp4',
+                'chat_id': chat_id,
+                'message_id': messages.id,
+            })
         
         # Si no hay mime_type, usar mp4 como fallback
         if not mime_type:
             mime_type = 'video/mp4'
         
+        # Renovar el file_reference si Telegram lo da por expirado durante la descarga
+        async def refresh_document():
+            return await refresh_video_document(client, video_id, chat_id, message_id)
+        
+        # Localizar y fijar en caché el moov del MP4 en segundo plano (una vez por video), así el
+        # Range al final del archivo que piden los navegadores para MP4 no-faststart ya está servido
+        if request.method == 'GET' and (video_metadata is None or 'moov_offset' not in video_metadata):
+            video_prefetch_scheduler.submit(phone, phone, video_document, video_id, priority=-1)
+        
         print(f"🎬 Streaming video: {mime_type}, tamaño: {file_size} bytes, video_id: {video_id}")
         
         # Headers base para todas las respuestas
-        # IMPORTANTE: Headers optimizados para compatibilidad con navegadores móviles
-        base_headers = {
-            'Content-Type': mime_type,
-            'Accept-Ranges': 'bytes',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
-            'Access-Control-Allow-Headers': 'Range, Content-Range, Content-Length',
-            'Cache-Control': 'public, max-age=3600',
-            'X-Content-Type-Options': 'nosniff',
-        }
+        etag = video_etag(video_document.id, file_size)
+        base_headers = video_response_headers(mime_type, etag)
+        
+        # Peticiones condicionales: el navegador ya tiene esta versión del video
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            print(f"✅ If-None-Match coincide para {video_id}, respondiendo 304", flush=True)
+            return Response('', 304, {k: v for k, v in base_headers.items() if k != 'Content-Type'})
+        
+        # If-Range con otro validador: el archivo pudo cambiar, se ignora el Range
+        if_range = request.headers.get('If-Range')
+        if range_header and if_range and if_range.strip() != etag:
+            print(f"⚠️ If-Range no coincide ({if_range}), ignorando Range", flush=True)
+            range_header = None
+        
+        # HEAD (solo headers), rangos ya en caché o documento completo para nginx: sin descargar nada
+        cached_response = serve_video_from_cache(file_size, mime_type, video_document.id, range_header)
+        if cached_response is not None:
+            return cached_response
         
         # Si hay range request, servir solo ese rango (streaming progresivo)
         if range_header:
@@ -3085,81 +7202,41 @@ def get_video(video_id):
                 
                 print(f"📊 Range request: start={start}, end={end}, chunk_size={chunk_size}, file_size={file_size}")
                 
-                # Descargar solo el rango solicitado usando iter_download (más robusto que GetFileRequest)
-                async def download_range():
-                    # Usar iter_download de Telethon que maneja automáticamente file_reference, offsets y límites
-                    if hasattr(messages.media, 'document'):
-                        document = messages.media.document
-                        
-                        # Límite máximo por request HTTP (5MB) - el navegador hará múltiples requests
-                        MAX_HTTP_RESPONSE_SIZE = 5 * 1024 * 1024  # 5MB
-                        
-                        # Calcular el rango exacto solicitado
-                        requested_end = start + chunk_size
-                        end = min(requested_end, file_size)
-                        
-                        # Limitar el tamaño máximo a descargar por request HTTP
-                        if (end - start) > MAX_HTTP_RESPONSE_SIZE:
-                            end = start + MAX_HTTP_RESPONSE_SIZE
-                            print(f"⚠️ Rango solicitado excede máximo HTTP ({MAX_HTTP_RESPONSE_SIZE} bytes), limitando a {MAX_HTTP_RESPONSE_SIZE} bytes. El navegador hará múltiples requests.", flush=True)
-                        
-                        buffer = BytesIO()
-                        bytes_downloaded = 0
-                        target_bytes = end - start
-                        
-                        print(f"📥 Descargando rango usando iter_download: start={start}, end={end}, target_bytes={target_bytes}, file_size={file_size}", flush=True)
-                        
-                        try:
-                            # Usar iter_download que maneja automáticamente todos los detalles
-                            # Solo leeremos los bytes del rango solicitado
-                            async for chunk in client.iter_download(messages, offset=start, limit=target_bytes):
-                                if chunk:
-                                    # Solo agregar los bytes que necesitamos
-                                    remaining_needed = target_bytes - bytes_downloaded
-                                    if remaining_needed <= 0:
-                                        break
-                                    
-                                    chunk_to_add = chunk[:remaining_needed]
-                                    buffer.write(chunk_to_add)
-                                    bytes_downloaded += len(chunk_to_add)
-                                    
-                                    print(f"📊 Chunk descargado: {len(chunk_to_add)} bytes, total en buffer: {bytes_downloaded}/{target_bytes}", flush=True)
-                                    
-                                    # Si alcanzamos el límite HTTP, detener
-                                    if bytes_downloaded >= MAX_HTTP_RESPONSE_SIZE:
-                                        print(f"⚠️ Alcanzado límite HTTP ({MAX_HTTP_RESPONSE_SIZE} bytes), deteniendo descarga. El navegador hará múltiples requests.", flush=True)
-                                        break
-                                    
-                                    if bytes_downloaded >= target_bytes:
-                                        break
-                            
-                            print(f"✅ Descarga completada: {bytes_downloaded} bytes descargados", flush=True)
-                            
-                            if bytes_downloaded > 0:
-                                buffer.seek(0)
-                                data = buffer.read()
-                                
-                                # Limitar al tamaño solicitado
-                                if len(data) > chunk_size:
-                                    data = data[:chunk_size]
-                                    print(f"✂️ Recortando datos a {chunk_size} bytes (solicitado)", flush=True)
-                                
-                                if len(data) > 0:
-                                    print(f"✅ Devolviendo {len(data)} bytes al cliente", flush=True)
-                                    return data
-                            
-                            print(f"❌ No se descargó ningún dato (bytes_downloaded={bytes_downloaded})", flush=True)
-                            raise Exception("No se pudo descargar ningún chunk del rango solicitado")
-                        except Exception as e:
-                            error_msg = str(e)
-                            error_type = type(e).__name__
-                            print(f"❌ Error con iter_download en range: {error_type}: {error_msg}", flush=True)
-                            import traceback
-                            traceback_str = traceback.format_exc()
-                            print(traceback_str, flush=True)
-                            raise
-                    else:
-                        raise Exception("El mensaje no tiene documento")
+                # Límite máximo por request HTTP (5MB bufferizado) - el navegador hará múltiples requests
+                # En modo streaming la memoria no depende del tamaño del rango, así que se permite más.
+                # Dentro de ese tope, el tamaño sale del throughput medido del DC y del espectador:
+                # respuestas grandes si todo va rápido, pequeñas si el espectador no da para más
+                document = video_document
+                viewer = video_viewer_id()
+                dc_id = getattr(document, 'dc_id', None)
+                MAX_HTTP_RESPONSE_SIZE = adaptive_range_bytes(dc_id, viewer, VIDEO_STREAM_MAX_RANGE if VIDEO_STREAMING_ENABLED else 5 * 1024 * 1024)
+                range_end = min(end, start + MAX_HTTP_RESPONSE_SIZE - 1, file_size - 1)
+                if range_end < end:
+                    # Cortar en un límite de chunk para no descargar de Telegram un chunk que no se envía
+                    aligned_end = ((range_end + 1) // VIDEO_CHUNK_SIZE) * VIDEO_CHUNK_SIZE - 1
+                    if aligned_end >= start:
+                        range_end = aligned_end
+                    print(f"⚠️ Rango solicitado excede máximo HTTP ({MAX_HTTP_RESPONSE_SIZE} bytes), limitando a {range_end - start + 1} bytes. El navegador hará múltiples requests.", flush=True)
+                
+                download_priority = download_scheduler.classify_range(viewer, document.id, start, range_end)
+                
+                if VIDEO_STREAMING_ENABLED:
+                    headers = {
+                        **base_headers,
+                        'Content-Range': f'bytes {start}-{range_end}/{file_size}',
+                        'Content-Length': str(range_end - start + 1),
+                    }
+                    # HEAD: los headers no dependen de los bytes, no hace falta descargar nada
+                    if request.method == 'HEAD':
+                        return Response('', 206, headers, mimetype=mime_type)
+                    
+                    print(f"📡 Streaming de rango: start={start}, end={range_end}, file_size={file_size}", flush=True)
+                    window_timeout = adaptive_timeout(dc_id, PARALLEL_DOWNLOAD_WINDOW * VIDEO_CHUNK_SIZE, VIDEO_CHUNK_FETCH_TIMEOUT)
+                    stream = stream_document_range(client, client_loop, document, document.id, start, range_end, timeout=window_timeout, refresh_media=refresh_document,
+                                                   viewer=viewer, priority=download_priority)
+                    if stream is None:
+                        return jsonify({'error': 'No se pudo descargar el rango del video'}), 500
+                    return Response(stream, 206, headers, mimetype=mime_type, direct_passthrough=True)
                 
                 # 🚀 OPTIMIZADO: Timeout dinámico para range requests
                 # Aumentado para videos grandes y de alta calidad
@@ -3169,8 +7246,14 @@ def get_video(video_id):
                     timeout_seconds = 90  # 1.5 minutos
                 else:
                     timeout_seconds = min(60, max(10, int(chunk_size / (1024 * 1024)) * 5))
+                # Con throughput medido del DC, el timeout sale de lo que realmente se va a descargar
+                timeout_seconds = adaptive_timeout(dc_id, range_end - start + 1, timeout_seconds)
                 
-                chunk_data = run_async(download_range(), client_loop, timeout=timeout_seconds)
+                # Servir el rango desde la caché de chunks en disco; solo se descargan de Telegram
+                # los chunks alineados que falten
+                print(f"📥 Leyendo rango: start={start}, end={range_end}, file_size={file_size}", flush=True)
+                chunk_data = read_document_range(client, client_loop, document, document.id, start, range_end, timeout=timeout_seconds, refresh_media=refresh_document,
+                                                 viewer=viewer, priority=download_priority)
                 
                 if chunk_data and len(chunk_data) > 0:
                     # Si es HEAD request, solo devolver headers
@@ -3225,8 +7308,8 @@ def get_video(video_id):
             print(f"📊 Descargando chunk inicial de {initial_size / (1024*1024):.2f}MB para video de {file_size / (1024*1024):.2f}MB ({file_size / (1024*1024*1024):.2f}GB)")
             
             # Usar GetFileRequest para descargar solo los primeros bytes (MUCHO más rápido)
-            if hasattr(messages.media, 'document'):
-                document = messages.media.document
+            if video_document is not None:
+                document = video_document
                 from telethon.tl.types import InputDocumentFileLocation
                 from telethon.tl.functions.upload import GetFileRequest
                 
@@ -3244,9 +7327,9 @@ def get_video(video_id):
                         print(f"⚠️ file_reference vacío, intentando actualizar...")
                         # Intentar obtener el mensaje de nuevo para actualizar file_reference
                         try:
-                            updated_messages = await client.get_messages(actual_target_chat, ids=message_id)
-                            if updated_messages and hasattr(updated_messages.media, 'document'):
-                                document = updated_messages.media.document
+                            updated_document = await refresh_document()
+                            if updated_document is not None:
+                                document = updated_document
                                 file_location = InputDocumentFileLocation(
                                     id=document.id,
                                     access_hash=document.access_hash,
@@ -3372,9 +7455,9 @@ def get_video(video_id):
                         for retry_attempt in range(max_retries):
                             try:
                                 print(f"🔄 Reintento {retry_attempt + 1}/{max_retries} actualizando file_reference...")
-                                updated_messages = await client.get_messages(actual_target_chat, ids=message_id)
-                                if updated_messages and hasattr(updated_messages.media, 'document'):
-                                    document = updated_messages.media.document
+                                updated_document = await refresh_document()
+                                if updated_document is not None:
+                                    document = updated_document
                                     file_location = InputDocumentFileLocation(
                                         id=document.id,
                                         access_hash=document.access_hash,
@@ -3434,6 +7517,8 @@ def get_video(video_id):
             timeout_initial = 120  # 2 minutos
         else:
             timeout_initial = 60  # 1 minuto para videos normales
+        # El primer chunk es siempre 1MB: con throughput medido del DC no depende del tamaño del video
+        timeout_initial = adaptive_timeout(getattr(video_document, 'dc_id', None), VIDEO_CHUNK_SIZE, timeout_initial)
         
         try:
             # Verificar que el loop esté disponible antes de descargar
@@ -3450,7 +7535,22 @@ def get_video(video_id):
             
             print(f"⏱️ Timeout configurado: {timeout_initial}s para video de {file_size / (1024*1024*1024):.2f}GB")
             try:
-                initial_data = run_async(download_initial_chunk(), client_loop, timeout=timeout_initial)
+                # El primer chunk sale de la caché de disco o de una descarga compartida con los
+                # demás requests que lo estén pidiendo a la vez (link compartido en un grupo)
+                initial_data = None
+                if video_document is not None:
+                    try:
+                        first_chunk = get_cached_chunk(video_document.id, 0)
+                        if first_chunk is None:
+                            first_chunk = fetch_chunks_coalesced(client, client_loop, video_document, video_document.id, [0], timeout=timeout_initial, refresh_media=refresh_document,
+                                                                 viewer=video_viewer_id(), priority=DOWNLOAD_PRIORITY_INTERACTIVE).get(0)
+                        if first_chunk:
+                            initial_data = first_chunk[:adaptive_initial_bytes(video_viewer_id(), file_size)]
+                            print(f"💾 Chunk inicial servido desde caché/descarga compartida ({len(initial_data)} bytes)", flush=True)
+                    except Exception as first_chunk_error:
+                        print(f"⚠️ No se pudo obtener el primer chunk compartido, usando descarga directa: {first_chunk_error}", flush=True)
+                if not initial_data:
+                    initial_data = run_async(download_initial_chunk(), client_loop, timeout=timeout_initial)
             except asyncio.TimeoutError:
                 print(f"⏱️ Timeout al descargar chunk inicial del video {video_id}")
                 return jsonify({'error': 'Tiempo de espera agotado al descargar el video. Intenta más tarde.'}), 504
@@ -3592,7 +7692,16 @@ def debug_video(video_id):
         'telegram_client': {
             'available': False,
             'connected': False
-        }
+        },
+        'chunk_cache': {
+            'memory': video_memory_cache.stats(),
+            'disk': video_chunk_cache.stats(),
+        },
+        'prefetch': video_prefetch_scheduler.stats(),
+        'download_scheduler': download_scheduler.stats(),
+        'throughput': {'dc': dc_throughput.stats(), 'viewers': viewer_throughput.stats()},
+        'thumbnails': thumbnail_capture_queue.stats(),
+        'seek_previews': seek_preview_queue.stats()
     }
     
     # Intentar obtener video de la base de datos
@@ -3633,6 +7742,10 @@ def logout():
         client_data = telegram_clients[phone]
         client = client_data.get('client')
         if client and client.is_connected():
+            try:
+                run_async(close_download_sender_pools(client))
+            except:
+                pass
             try:
                 run_async(client.disconnect())
             except:
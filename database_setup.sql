@@ -15,6 +15,23 @@ CREATE TABLE IF NOT EXISTS videos (
     INDEX idx_timestamp (timestamp)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Tabla para deduplicar subidas: hash del contenido -> documento de Telegram ya subido
+-- (access_hash es propio de cada cuenta, por eso la clave incluye phone; una fila por chat)
+CREATE TABLE IF NOT EXISTS video_hashes (
+    content_hash CHAR(64) NOT NULL,
+    file_size BIGINT NOT NULL,
+    phone VARCHAR(50) NOT NULL,
+    chat_id VARCHAR(255) NOT NULL,
+    message_id INT NOT NULL,
+    video_id VARCHAR(255),
+    document_id BIGINT NOT NULL,
+    access_hash BIGINT NOT NULL,
+    file_reference VARBINARY(255),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (content_hash, file_size, phone, chat_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 -- Tabla para almacenar configuraciones (opcional, para múltiples usuarios)
 CREATE TABLE IF NOT EXISTS configurations (
     id INT AUTO_INCREMENT PRIMARY KEY,